@@ -20,7 +20,8 @@ sys.path.insert(0, path)
 import glob
 import numpy as np
 from vlbi_errors.uv_data import UVData
-from vlbi_errors.spydiff import (import_difmap_model, modelfit_difmap)
+from vlbi_errors.spydiff import (import_difmap_model, import_difmap_models,
+                                 modelfit_difmap)
 from vlbi_errors.bootstrap import CleanBootstrap
 from vlbi_errors.model import Model
 from vlbi_errors.utils import hdi_of_mcmc
@@ -93,20 +94,20 @@ def analyze_bootstrap_samples(dfm_model_fname, booted_mdl_paths,
             raise Exception
         comps_params0[i].extend(list(params))
 
-    # Load bootstrap models
-    comps_params = {i: [] for i in range(len(comps_orig))}
-    for booted_mdl_path in booted_mdl_paths:
-        path, booted_mdl_file = os.path.split(booted_mdl_path)
-        comps = import_difmap_model(booted_mdl_file, path)
-        for i, comp in enumerate(comps):
-            # FIXME: Move (x, y) <-> (r, theta) mapping to ``Component``
-            if coordinates == 'xy':
-                params = comp.p
-            elif coordinates == 'rtheta':
-                params = xy_2_rtheta(comp.p)
-            else:
-                raise Exception
-            comps_params[i].extend(list(params))
+    # Load bootstrap models as one (#boot, #comps, #params) table
+    booted_params, _, _ = import_difmap_models(booted_mdl_paths)
+    comps_params = dict()
+    for i, comp in enumerate(comps_orig):
+        # (#boot, #free parameters)
+        params = booted_params[:, i, :len(comp._parnames)][:, ~comp._fixed]
+        # FIXME: Move (x, y) <-> (r, theta) mapping to ``Component``
+        if coordinates == 'xy':
+            pass
+        elif coordinates == 'rtheta':
+            params = np.array(xy_2_rtheta(params.T)).T
+        else:
+            raise Exception
+        comps_params[i] = list(params.ravel())
 
     comps_to_plot = [comps_orig[k] for k in plot_comps]
     # (#boot, #parameters)
@@ -0,0 +1,1696 @@
+#!/usr/bin python
+# -*- coding: utf-8 -*-
+
+import os
+import copy
+import pickle
+import time
+import shutil
+import tempfile
+import numpy as np
+import scipy as sp
+import scipy.stats
+import emcee
+from scipy import signal
+from unittest import TestCase
+import astropy.io.fits as pf
+from vlbi_errors.utils import (hdi_of_mcmc, hdi_of_samples, mas_to_rad,
+                               degree_to_mas, grouped_quantile,
+                               find_outliers_grouped, plugin_bandwidths,
+                               GaussianKDE)
+from vlbi_errors.components import (EGComponent, CGComponent, DeltaComponent,
+                                    DeltaBlockComponent, add_deltas_to_grid)
+from vlbi_errors.model import Model, Jitter
+from vlbi_errors.image import Image
+from vlbi_errors.beam import CleanBeam
+from vlbi_errors.gains import Gains
+from vlbi_errors.difmap_runner import (DifmapRunner, DifmapSession,
+                                       DifmapError, DifmapTimeoutError)
+from vlbi_errors import spydiff
+from vlbi_errors.spydiff import (modelfit_difmap_commands, modelfit_difmap,
+                                 import_difmap_model, import_difmap_models,
+                                 difmap_table_types)
+from vlbi_errors.result_cache import ResultCache
+from vlbi_errors.deconvolution import CleanDeconvolution, clean_uvdatas
+from vlbi_errors.uv_data import UVData
+from vlbi_errors.utils import nested_ddict
+from vlbi_errors.bootstrap import (CleanBootstrap, SelfCalBootstrap,
+                                   SequentialBootstrap, replica_random_state)
+from vlbi_errors.nested import nested_sample
+from vlbi_errors.chains import ChainBackend, run_mcmc
+from vlbi_errors.convergence import ConvergenceMonitor, run_until_converged
+from vlbi_errors.stats import (LnLikelihood, LnPost, BatchPool,
+                               SharedMemoryPool, _stripped_lnpost, rice_lnlik)
+
+
+class Test_utils(TestCase):
+    def test_hdi_of_samples(self):
+        samples = np.random.normal(size=(200, 3))
+        low, high = hdi_of_samples(samples, cred_mass=0.68)
+        for j in range(3):
+            self.assertEqual(hdi_of_mcmc(samples[:, j], cred_mass=0.68),
+                             (low[j], high[j]))
+
+    def test_grouped_quantile(self):
+        rstate = np.random.RandomState(0)
+        # Group 2 is empty, group 3 has one point
+        sizes = [50, 7, 0, 1, 100]
+        groups = np.repeat(np.arange(len(sizes)), sizes)
+        rstate.shuffle(groups)
+        data = rstate.normal(size=len(groups))
+        for q in (0., 0.1, 0.25, 0.5, 0.75, 0.93, 1.):
+            quantiles = grouped_quantile(data, groups, q, n_groups=6)
+            for group in range(6):
+                if group in (2, 5):
+                    self.assertTrue(np.isnan(quantiles[group]))
+                else:
+                    self.assertAlmostEqual(
+                        quantiles[group],
+                        np.percentile(data[groups == group], 100. * q))
+
+    def test_find_outliers_grouped(self):
+        rstate = np.random.RandomState(0)
+        sizes = [500, 300, 200]
+        groups = np.repeat(np.arange(len(sizes)), sizes)
+        # Groups have different centers, scales & correlation of Re & Im
+        re = rstate.normal(size=len(groups))
+        im = 0.8 * re + 0.6 * rstate.normal(size=len(groups))
+        scales = np.array([1., 0.01, 100.])[groups]
+        data = (np.array([0., 5., -300.])[groups] + scales * (re + 1j * im))
+        injected = np.zeros(len(data), dtype=bool)
+        injected[rstate.choice(len(data), 20, replace=False)] = True
+        data[injected] += 20. * scales[injected] *\
+            np.exp(2j * np.pi * rstate.uniform(size=20))
+        for method in ('mad', 'mahalanobis'):
+            outliers = find_outliers_grouped(data, groups, method=method)
+            self.assertTrue(np.all(outliers[injected]))
+            self.assertLess(np.count_nonzero(outliers[~injected]), 5)
+        self.assertRaises(Exception, find_outliers_grouped, data, groups,
+                          method='dbscan')
+
+    @staticmethod
+    def direct_plugin_bandwidth(x):
+        """
+        Two-stage direct plug-in bandwidth with exact sums over all pairs of
+        data points.
+        """
+        n = len(x)
+        iqr = np.subtract(*np.percentile(x, [75, 25]))
+        scale = min(np.std(x, ddof=1), iqr / 1.349)
+        d = x[:, np.newaxis] - x[np.newaxis, :]
+
+        def psi(g, r):
+            u = d / g
+            if r == 4:
+                hermite = u ** 4 - 6. * u ** 2 + 3.
+            else:
+                hermite = u ** 6 - 15. * u ** 4 + 45. * u ** 2 - 15.
+            return np.sum(hermite * np.exp(-0.5 * u ** 2)) /\
+                (np.sqrt(2. * np.pi) * g ** (r + 1) * n ** 2)
+
+        psi8 = 105. / (32. * np.sqrt(np.pi) * scale ** 9)
+        g1 = (30. / (np.sqrt(2. * np.pi) * psi8 * n)) ** (1. / 9.)
+        g2 = (-6. / (np.sqrt(2. * np.pi) * psi(g1, 6) * n)) ** (1. / 7.)
+        return (1. / (2. * np.sqrt(np.pi) * psi(g2, 4) * n)) ** 0.2
+
+    def test_plugin_bandwidths(self):
+        rstate = np.random.RandomState(0)
+        sizes = [1000, 300, 100]
+        scales = [1., 0.01, 50.]
+        groups = np.repeat(np.arange(len(sizes)), sizes)
+        data = np.array(scales)[groups] * rstate.normal(size=len(groups)) +\
+            np.array([0., 3., -100.])[groups]
+        bandwidths = plugin_bandwidths(data, groups)
+        for group in range(len(sizes)):
+            x = data[groups == group]
+            expected = self.direct_plugin_bandwidth(x)
+            self.assertAlmostEqual(bandwidths[group] / expected, 1.,
+                                   delta=0.01)
+            # Close to optimal bandwidth for normal density
+            optimal = 1.06 * np.std(x) * len(x) ** (-0.2)
+            self.assertAlmostEqual(bandwidths[group] / optimal, 1., delta=0.2)
+
+    def test_kde_normalization(self):
+        rstate = np.random.RandomState(0)
+        data = np.hstack((rstate.normal(size=200),
+                          5. + 0.1 * rstate.normal(size=50)))
+        for bandwidth in (0.05, 0.3, 1.):
+            kde = GaussianKDE(data, bandwidth)
+            x = np.linspace(-10., 15., 20001)
+            density = np.exp(kde.score_samples(x[:, np.newaxis]))
+            self.assertAlmostEqual(np.trapz(density, x), 1., places=6)
+        # Samples have the density of KDE: variance of data plus bandwidth
+        samples = kde.sample(100000, random_state=1)
+        self.assertEqual(samples.shape, (100000, 1))
+        self.assertAlmostEqual(np.var(samples) / (np.var(data) + 1.), 1.,
+                               delta=0.02)
+
+
+class Test_components(TestCase):
+    def setUp(self):
+        np.random.seed(1)
+        self.uv = np.random.normal(0., 3. * 10 ** 8, size=(100, 2))
+
+    def _numerical_jacobian(self, component):
+        p0 = np.array(component.p, dtype=float)
+        jac = list()
+        for i in range(len(p0)):
+            h = 10 ** (-6) * max(1., abs(p0[i]))
+            p = p0.copy()
+            p[i] += h
+            component.p = p
+            ft_plus = component.ft(self.uv)
+            p[i] -= 2. * h
+            component.p = p
+            ft_minus = component.ft(self.uv)
+            jac.append((ft_plus - ft_minus) / (2. * h))
+        component.p = p0
+        return np.array(jac).T
+
+    def test_jacobian(self):
+        for component in (EGComponent(1.2, 0.3, -0.5, 0.4, 0.6, 0.7),
+                          EGComponent(1.2, 0.3, -0.5, 0.4, 0.6, 0.7,
+                                      fixed=['x', 'e']),
+                          CGComponent(0.5, 1.0, 0.2, 0.8),
+                          DeltaComponent(0.5, 1.0, 0.2)):
+            jac = component.jacobian(self.uv)
+            self.assertEqual(jac.shape, (len(self.uv), component.size))
+            self.assertTrue(np.allclose(jac,
+                                        self._numerical_jacobian(component),
+                                        rtol=10 ** (-5), atol=10 ** (-8)))
+
+    def test_ft_batch(self):
+        for component in (EGComponent(1.2, 0.3, -0.5, 0.4, 0.6, 0.7),
+                          CGComponent(0.5, 1.0, 0.2, 0.8),
+                          DeltaComponent(0.5, 1.0, 0.2)):
+            p = component._p + 0.1 * np.random.normal(size=(5,
+                                                            len(component._p)))
+            ft = component.ft_batch(p, self.uv)
+            for p_, ft_ in zip(p, ft):
+                component._p[:] = p_
+                self.assertTrue(np.allclose(ft_, component.ft(self.uv)))
+
+
+class Test_Model(TestCase):
+    def setUp(self):
+        self.uv = np.random.RandomState(1).normal(0., 3. * 10 ** 8,
+                                                  size=(50, 2))
+
+    def test_shared_component(self):
+        component = CGComponent(1., 0., 0., 1.)
+        model1 = Model(stokes='I')
+        model2 = Model(stokes='I')
+        model1.add_component(component)
+        model2.add_component(component)
+        # The second model has its own copy of component
+        self.assertIsNot(model2._components[0], component)
+        model1.p = [5., 1., 1., 2.]
+        self.assertTrue(np.array_equal(component.p, [5., 1., 1., 2.]))
+        self.assertTrue(np.array_equal(model2.p, [1., 0., 0., 1.]))
+        self.assertTrue(np.allclose(model1.ft(self.uv),
+                                    CGComponent(5., 1., 1., 2.).ft(self.uv)))
+        self.assertTrue(np.allclose(model2.ft(self.uv),
+                                    CGComponent(1., 0., 0., 1.).ft(self.uv)))
+        # The same component added twice
+        model1.add_component(component)
+        model1.p = np.arange(8.)
+        self.assertTrue(np.array_equal(component.p, np.arange(4.)))
+
+    def test_add(self):
+        model1 = Model(stokes='I')
+        model1.add_component(CGComponent(1., 0., 0., 1.))
+        model2 = Model(stokes='I')
+        model2.add_components(DeltaComponent(0.5, 1., 2.),
+                              EGComponent(0.3, 1., 2., 0.5, 0.5, 1.,
+                                          fixed=['e']))
+        model1 + model2
+        self.assertEqual(model1.size, 4 + 3 + 5)
+        self.assertTrue(np.array_equal(model1.p, [1., 0., 0., 1., 0.5, 1., 2.,
+                                                  0.3, 1., 2., 0.5, 1.]))
+        model1.p = model1.p + 1.
+        self.assertTrue(np.array_equal(model2.p, [0.5, 1., 2., 0.3, 1., 2.,
+                                                  0.5, 1.]))
+        ft = (CGComponent(2., 1., 1., 2.).ft(self.uv) +
+              DeltaComponent(1.5, 2., 3.).ft(self.uv) +
+              EGComponent(1.3, 2., 3., 1.5, 0.5, 2.).ft(self.uv))
+        self.assertTrue(np.allclose(model1.ft(self.uv), ft))
+
+    def test_add_many(self):
+        model = Model(stokes='I')
+        for i in range(1000):
+            model.add_component(DeltaComponent(float(i), 0., 0.))
+        self.assertTrue(np.array_equal(model.p[0::3], np.arange(1000.)))
+        # All components keep views of the same array
+        model.p = np.zeros(3000)
+        self.assertTrue(all(component.p[0] == 0. for component in
+                            model._components))
+
+    def test_remove(self):
+        components = [DeltaComponent(0.5, 1., 2.),
+                      CGComponent(1., 0., 0., 1.),
+                      DeltaComponent(0.1, 3., 4.)]
+        model = Model(stokes='I')
+        model.add_components(*components)
+        model.remove_component(components[1])
+        self.assertTrue(np.array_equal(model.p, [0.5, 1., 2., 0.1, 3., 4.]))
+        # Removed component doesn't change model & vice versa
+        components[1].p = [2., 2., 2., 2.]
+        model.p = np.zeros(6)
+        self.assertTrue(np.array_equal(components[1].p, [2., 2., 2., 2.]))
+        self.assertTrue(np.array_equal(components[2].p, [0., 0., 0.]))
+        # Removed component could be added to other model without copying
+        other = Model(stokes='I')
+        other.add_component(components[1])
+        self.assertIs(other._components[0], components[1])
+        model.clear_components()
+        self.assertEqual(model.size, 0)
+        self.assertTrue(np.array_equal(components[0].p, [0., 0., 0.]))
+
+    def test_pickle(self):
+        model = Model(stokes='I')
+        model.add_components(DeltaComponent(0.5, 1., 2.),
+                             EGComponent(0.3, 1., 2., 0.5, 0.5, 1.,
+                                         fixed=['e']))
+        for model_ in (pickle.loads(pickle.dumps(model, -1)),
+                       copy.deepcopy(model)):
+            self.assertTrue(np.array_equal(model_.p, model.p))
+            model_.p = model_.p + 1.
+            self.assertTrue(np.array_equal(model_._components[1].p,
+                                           [1.3, 2., 3., 1.5, 2.]))
+            self.assertTrue(np.allclose(model_.ft(self.uv),
+                                        model.ft_batch(model.p + 1.,
+                                                       self.uv)[0]))
+        self.assertTrue(np.array_equal(model._components[1].p,
+                                       [0.3, 1., 2., 0.5, 1.]))
+
+
+class Test_DeltaBlockComponent(TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(2)
+        self.uv = random_state.normal(0., 3. * 10 ** 8, size=(50, 2))
+        self.flux = random_state.uniform(0., 1., 300)
+        self.x = random_state.normal(size=300)
+        self.y = random_state.normal(size=300)
+
+    def deltas(self):
+        return [DeltaComponent(flux, x, y) for flux, x, y in
+                zip(self.flux, self.x, self.y)]
+
+    def test_ft(self):
+        block = DeltaBlockComponent(self.flux, self.x, self.y)
+        self.assertEqual(len(block), 300)
+        ft = sum(delta.ft(self.uv) for delta in self.deltas())
+        self.assertTrue(np.allclose(block.ft(self.uv), ft))
+        p = block._p + 0.01 * np.random.normal(size=(3, len(block._p)))
+        ft_batch = block.ft_batch(p, self.uv)
+        for p_, ft_ in zip(p, ft_batch):
+            ft = sum(DeltaComponent(*p_[3 * i: 3 * i + 3]).ft(self.uv) for i
+                     in range(300))
+            self.assertTrue(np.allclose(ft_, ft))
+
+    def test_split(self):
+        block = DeltaBlockComponent(self.flux, self.x, self.y)
+        model = Model(stokes='I')
+        model.add_component(block)
+        components = model.components
+        self.assertEqual(len(components), 300)
+        # Components keep views of parameters of model
+        components[1].p = [1., 2., 3.]
+        self.assertTrue(np.array_equal(model.p[3: 6], [1., 2., 3.]))
+        model.p = np.zeros(900)
+        self.assertTrue(np.array_equal(components[-1].p, [0., 0., 0.]))
+        self.assertEqual(str(model).count('DeltaComponent'), 300)
+
+    def test_filter_components_by_r(self):
+        model = Model(stokes='I')
+        model.add_components(DeltaBlockComponent(self.flux, self.x, self.y,
+                                                 fixed=['flux']),
+                             CGComponent(1., 0.1, 0.1, 1.),
+                             CGComponent(1., 3., 3., 1.))
+        model.filter_components_by_r(r_max_mas=1.)
+        near = np.hypot(self.x, self.y) <= 1.
+        self.assertEqual(len(model._components), 2)
+        self.assertEqual(len(model._components[0]), np.count_nonzero(near))
+        self.assertTrue(np.array_equal(model._components[0]._p[0::3],
+                                       self.flux[near]))
+        # Fluxes are still fixed
+        self.assertEqual(model.size, 2 * np.count_nonzero(near) + 4)
+        self.assertTrue(np.array_equal(model.p[-4:], [1., 0.1, 0.1, 1.]))
+
+    def test_from_hdulist(self):
+        hdu = pf.PrimaryHDU(np.zeros((1, 1, 8, 8)))
+        for key, value in (('CRPIX1', 4), ('CRPIX2', 4), ('CRVAL1', 0.),
+                           ('CRVAL2', 0.), ('CDELT1', -10 ** (-7)),
+                           ('CDELT2', 10 ** (-7)), ('CTYPE3', 'FREQ'),
+                           ('CRVAL3', 15. * 10 ** 9), ('CTYPE4', 'STOKES'),
+                           ('CRVAL4', 1.), ('BMAJ', 10 ** (-7)),
+                           ('BMIN', 10 ** (-7)), ('BPA', 10.)):
+            hdu.header[key] = value
+        columns = [pf.Column(name='FLUX', format='D', array=self.flux),
+                   pf.Column(name='DELTAX', format='D',
+                             array=-self.x / degree_to_mas),
+                   pf.Column(name='DELTAY', format='D',
+                             array=-self.y / degree_to_mas)]
+        cc = pf.BinTableHDU.from_columns(columns, name='AIPS CC')
+        model = Model()
+        model.from_hdulist(pf.HDUList([hdu, cc]))
+        self.assertEqual(model.stokes, 'I')
+        ft = sum(delta.ft(self.uv) for delta in self.deltas())
+        self.assertTrue(np.allclose(model.ft(self.uv), ft))
+
+    def test_from_2darray(self):
+        image = np.zeros((16, 16))
+        image[3, 5] = 1.
+        image[10, 2] = 0.5
+        image[8, 8] = -0.2
+        model = Model()
+        model.from_2darray(image, (0.1, 0.2))
+        deltas = [DeltaComponent(flux, (x - 8) * 0.1, (y - 8) * 0.2) for
+                  (x, y), flux in np.ndenumerate(image) if flux]
+        self.assertEqual(len(model.components), 3)
+        self.assertTrue(np.allclose(model.ft(self.uv),
+                                    sum(delta.ft(self.uv) for delta in
+                                        deltas)))
+
+
+class Test_rasterize(TestCase):
+    def setUp(self):
+        self.image = Image()
+        self.image._construct(pixsize=(0.1 * mas_to_rad, 0.1 * mas_to_rad),
+                              pixref=(64, 64), stokes='I', freq=15e9,
+                              pixrefval=(0., 0.), imsize=(128, 128))
+        self.components = [DeltaComponent(1., 0.31, -0.22),
+                           DeltaComponent(0.5, 0.29, -0.18),
+                           EGComponent(2., 1., 0.5, 0.8, 0.5, 0.3),
+                           CGComponent(0.5, -1., 1., 0.4)]
+
+    def rasterize_each(self, components):
+        image = copy.deepcopy(self.image)
+        for component in components:
+            component.add_to_image(image)
+        return image.image
+
+    def test_add_deltas_to_grid(self):
+        flux = np.random.uniform(size=50)
+        x, y = np.random.uniform(-3., 3., size=(2, 50))
+        # Several components in one pixel
+        x[:10], y[:10] = 0.01, -0.02
+        grid = np.zeros(self.image.imsize)
+        add_deltas_to_grid(grid, self.image, flux, x, y)
+        expected = self.rasterize_each([DeltaComponent(*p) for p in
+                                        zip(flux, x, y)])
+        np.testing.assert_allclose(grid, expected, rtol=1e-12, atol=0.)
+        block = DeltaBlockComponent(flux, x, y)
+        np.testing.assert_allclose(block._rasterize(self.image), expected,
+                                   rtol=1e-12, atol=0.)
+
+    def test_model_rasterize(self):
+        expected = self.rasterize_each(self.components)
+        model = Model(stokes='I')
+        model.add_components(*self.components)
+        grid, others = model._rasterize(self.image)
+        self.assertEqual(others, [])
+        # Gaussians are evaluated only inside boxes of 6 sigma
+        np.testing.assert_allclose(grid, expected, rtol=0.,
+                                   atol=1e-7 * expected.max())
+        model.substract_from_image(self.image)
+        model.add_to_image(self.image)
+        np.testing.assert_allclose(self.image.image, 0., rtol=0., atol=1e-12)
+
+    def test_beam_threshold(self):
+        beam = CleanBeam()
+        beam._construct(bmaj=5., bmin=3., bpa=20., imsize=(128, 128))
+        grid = self.rasterize_each(self.components)
+        np.testing.assert_array_equal(beam.convolve(grid),
+                                      signal.fftconvolve(grid, beam.image,
+                                                         mode='same'))
+        model = Model(stokes='I')
+        model.add_components(*self.components)
+        model.add_to_image(self.image, beam=beam)
+        np.testing.assert_allclose(self.image.image, beam.convolve(grid),
+                                   rtol=0., atol=1e-6 * grid.max())
+
+
+class Test_gains_vectorized(TestCase):
+    def setUp(self):
+        nif, npol = 2, 2
+        n = 20
+        gains = Gains()
+        gains.nif, gains.npol = nif, npol
+        gains.data = np.zeros(3 * n, dtype=[('start', '<f8'),
+                                            ('stop', '<f8'),
+                                            ('antenna', 'int'),
+                                            ('gains', 'complex',
+                                             (nif, npol,)),
+                                            ('weights', '<f8',
+                                             (nif, npol,))])
+        gains.data['start'] = np.tile(np.arange(n) * 60., 3)
+        gains.data['stop'] = gains.data['start'] + 60.
+        gains.data['antenna'] = np.repeat([1, 2, 3], n)
+        gains.data['gains'] = (1. + 0.1 * np.random.normal(size=(3 * n, nif,
+                                                                 npol))) *\
+            np.exp(1j * np.random.uniform(-np.pi, np.pi, size=(3 * n, nif,
+                                                               npol)))
+        gains.data['weights'] = 1.
+        self.gains = gains
+
+    def test_baseline_gains(self):
+        t = np.random.uniform(0., 1200., 50)
+        baselines = np.random.choice([258, 259, 515], 50)
+        gains12 = self.gains.baseline_gains(t, baselines,
+                                            ['RR', 'LL', 'RL', 'LR'])
+        for t_, bl, gains12_ in zip(t, baselines, gains12):
+            self.assertTrue(np.allclose(
+                gains12_, self.gains.find_gains_for_baseline(t_, bl).T))
+
+    def test_resample_gains(self):
+        resampled = self.gains.resample_gains(window=5)
+        self.assertEqual(resampled.shape, self.gains.gains.shape)
+        self.assertTrue(np.all(np.isfinite(resampled)))
+
+    class FakeUVData(object):
+        __mul__ = vars(UVData)['__mul__']
+
+        def __init__(self, t, baselines, uvdata):
+            self.stokes = ['RR', 'LL', 'RL', 'LR']
+            self.uvdata = uvdata
+            self.par_dict = {'DATE': 0, 'BASELINE': 1}
+            self.hdu = type('HDU', (object,), {})()
+            self.hdu.columns = [type('Column', (object,), {'array': t})(),
+                                type('Column', (object,), {'array':
+                                                           baselines})()]
+
+    def uvdata(self, t, baselines, random_state):
+        shape = (len(t), 2, 4)
+        return self.FakeUVData(t, baselines,
+                               random_state.normal(size=shape) +
+                               1j * random_state.normal(size=shape))
+
+    def test_mul(self):
+        random_state = np.random.RandomState(1)
+        t = random_state.uniform(0., 1200., 50)
+        baselines = random_state.choice([258, 259, 515], 50)
+        uvdata = self.uvdata(t, baselines, random_state)
+        result = uvdata * self.gains
+        # Multiplying each visibility as in the loop over visibilities
+        for i, (t_, bl) in enumerate(zip(t, baselines)):
+            self.assertTrue(np.allclose(
+                result.uvdata[i],
+                uvdata.uvdata[i] * self.gains.find_gains_for_baseline(t_,
+                                                                      bl).T))
+
+    def test_selfcal_bootstrap(self):
+        random_state = np.random.RandomState(2)
+        # The last times are not covered by gains solutions
+        t = np.hstack((random_state.uniform(0., 1200., 45),
+                       random_state.uniform(1300., 1400., 5)))
+        baselines = random_state.choice([258, 259, 515], 50)
+        data = self.uvdata(t, baselines, random_state)
+        model = self.uvdata(t, baselines, random_state)
+
+        bootstrap = SelfCalBootstrap.__new__(SelfCalBootstrap)
+        bootstrap.data = data
+        bootstrap.model_data = model
+        bootstrap.gains = self.gains
+        bootstrap.window = 5
+        bootstrap._gains_indxs = (self.gains.get_indexes(t, baselines // 256),
+                                  self.gains.get_indexes(t, baselines % 256))
+
+        gains12 = self.gains.baseline_gains(t, baselines, data.stokes)
+        gains12[np.isnan(gains12)] = 1.
+        self.assertTrue(np.allclose(bootstrap.get_residuals().uvdata,
+                                    data.uvdata - gains12 * model.uvdata))
+
+        resampled = copy.deepcopy(self.gains)
+        resampled.gains = self.gains.resample_gains(
+            window=5, random_state=np.random.RandomState(3))
+        gains12 = resampled.baseline_gains(t, baselines, data.stokes)
+        gains12[np.isnan(gains12)] = 1.
+        self.assertTrue(np.allclose(
+            bootstrap.replica_model(np.random.RandomState(3)),
+            gains12 * model.uvdata))
+
+
+class Test_DifmapRunner(TestCase):
+    def setUp(self):
+        self.fake_difmap = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        'fake_difmap')
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_concurrent_jobs(self):
+        runner = DifmapRunner(executable=self.fake_difmap, n_jobs=4,
+                              work_dir=self.out_dir)
+        jobs = [["sleep 0.5"] +
+                modelfit_difmap_commands('uv.fits', 'model.mdl',
+                                         'mdl_{}.mdl'.format(i),
+                                         out_path=self.out_dir)
+                for i in range(8)]
+        t0 = time.time()
+        logs = runner.map(jobs)
+        self.assertLess(time.time() - t0, 3.)
+        for i, log in enumerate(logs):
+            self.assertIn('mdl_{}.mdl'.format(i), log)
+            self.assertTrue(os.path.exists(os.path.join(self.out_dir,
+                                                        'mdl_{}.mdl'.format(i))))
+        # Temporary directories with ``difmap.log`` are removed
+        self.assertEqual(sorted(os.listdir(self.out_dir)),
+                         sorted('mdl_{}.mdl'.format(i) for i in range(8)))
+
+    def test_timeout(self):
+        runner = DifmapRunner(executable=self.fake_difmap, timeout=0.5)
+        with self.assertRaises(DifmapTimeoutError):
+            runner.run(["sleep 10"])
+
+    def test_failure(self):
+        runner = DifmapRunner(executable=self.fake_difmap)
+        with self.assertRaises(DifmapError):
+            runner.run(["fail"])
+        with self.assertRaises(DifmapError):
+            DifmapRunner(executable='/nonexistent/difmap').run(["exit"])
+
+    def test_session(self):
+        with DifmapSession(executable=self.fake_difmap,
+                           work_dir=self.out_dir) as session:
+            pid = session._process.pid
+            for i in range(3):
+                out = session.run(modelfit_difmap_commands(
+                    'uv.fits', 'model.mdl', 'mdl_{}.mdl'.format(i),
+                    out_path=self.out_dir))
+                self.assertIn('mdl_{}.mdl'.format(i), out)
+                self.assertNotIn('mdl_{}.mdl'.format(i - 1), out)
+                self.assertTrue(os.path.exists(
+                    os.path.join(self.out_dir, 'mdl_{}.mdl'.format(i))))
+            # The same process runs all sets of commands
+            self.assertEqual(session._process.pid, pid)
+            self.assertTrue(session.is_alive)
+        self.assertFalse(session.is_alive)
+
+    def test_session_errors(self):
+        session = DifmapSession(executable=self.fake_difmap, timeout=0.5)
+        with self.assertRaises(DifmapTimeoutError):
+            session.run(["sleep 10"])
+        # Output of each command comes before timeout, but not of all of them
+        t0 = time.time()
+        with self.assertRaises(DifmapTimeoutError):
+            session.run(10 * ["sleep 0.2"])
+        self.assertLess(time.time() - t0, 1.)
+        with self.assertRaises(DifmapError):
+            session.run(["fail"])
+        # Session is restarted after failure
+        self.assertIn('0>clean', session.run(["clean"]))
+        session.close()
+
+    def test_map_sessions(self):
+        runner = DifmapRunner(executable=self.fake_difmap, n_jobs=2,
+                              work_dir=self.out_dir)
+        jobs = [modelfit_difmap_commands('uv.fits', 'model.mdl',
+                                         'mdl_{}.mdl'.format(i),
+                                         out_path=self.out_dir)
+                for i in range(6)]
+        logs = runner.map(jobs, sessions=True)
+        for i, log in enumerate(logs):
+            self.assertIn('mdl_{}.mdl'.format(i), log)
+        self.assertEqual(sorted(os.listdir(self.out_dir)),
+                         sorted('mdl_{}.mdl'.format(i) for i in range(6)))
+
+
+class Test_import_difmap_models(TestCase):
+    models = ["! Flux (Jy) Radius (mas)  Theta (deg)  Major (mas)  Axial ratio"
+              "   Phi (deg) T\n"
+              "1.5v 0.1v 30.0v 0.3v 1.0 0.0 1\n"
+              "0.5v 1.2v -45.0v 0.5v 0.6v 20.0v 1 15.3 0\n"
+              "0.2v 2.0v 100.0v\n",
+              "1.2v 0.05v 10.0v 0.2 1.0 0.0 1\n"
+              "0.3v 1.5v 170.0v\n"]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_fname = os.path.join(self.dir, 'cache.npz')
+        self.fnames = list()
+        for i, model in enumerate(self.models):
+            fname = 'mdl_{}.txt'.format(i)
+            with open(os.path.join(self.dir, fname), 'w') as fo:
+                fo.write(model)
+            self.fnames.append(fname)
+        self.parse = spydiff._parse_difmap_model
+        self.parsed = list()
+
+        def parse(path):
+            self.parsed.append(os.path.basename(path))
+            return self.parse(path)
+        spydiff._parse_difmap_model = parse
+
+    def tearDown(self):
+        spydiff._parse_difmap_model = self.parse
+        shutil.rmtree(self.dir)
+
+    def test_import(self):
+        params, types, fixed = import_difmap_models('mdl_*.txt', self.dir)
+        self.assertEqual(params.shape, (2, 3, 6))
+        for i, fname in enumerate(self.fnames):
+            comps = import_difmap_model(fname, self.dir)
+            self.assertTrue(np.all(types[i, len(comps):] == -1))
+            self.assertTrue(np.all(np.isnan(params[i, len(comps):])))
+            for j, comp in enumerate(comps):
+                self.assertIs(difmap_table_types[types[i, j]], type(comp))
+                np.testing.assert_allclose(params[i, j, :len(comp._p)],
+                                           comp._p, rtol=1e-12)
+                if not isinstance(comp, DeltaComponent):
+                    np.testing.assert_array_equal(
+                        fixed[i, j, :len(comp._p)], comp._fixed)
+
+    def test_cache(self):
+        result = import_difmap_models(self.fnames, self.dir,
+                                      cache_fname=self.cache_fname)
+        cached = import_difmap_models(self.fnames, self.dir,
+                                      cache_fname=self.cache_fname)
+        self.assertEqual(self.parsed, self.fnames)
+        for array, cached_array in zip(result, cached):
+            np.testing.assert_array_equal(array, cached_array)
+
+    def test_cache_invalidation(self):
+        import_difmap_models(self.fnames, self.dir,
+                             cache_fname=self.cache_fname)
+        # New content of the same size & modification time
+        path = os.path.join(self.dir, self.fnames[1])
+        stat = os.stat(path)
+        with open(path, 'w') as fo:
+            fo.write(self.models[1].replace('1.2v', '2.1v'))
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+        self.assertEqual(os.stat(path).st_size, stat.st_size)
+        params, _, _ = import_difmap_models(self.fnames, self.dir,
+                                            cache_fname=self.cache_fname)
+        self.assertEqual(self.parsed, self.fnames + self.fnames[1:])
+        self.assertEqual(params[1, 0, 0], 2.1)
+
+    def test_cache_pruning(self):
+        import_difmap_models(self.fnames, self.dir,
+                             cache_fname=self.cache_fname)
+        import_difmap_models(self.fnames[:1], self.dir,
+                             cache_fname=self.cache_fname)
+        cache = spydiff._load_difmap_models_cache(self.cache_fname)
+        self.assertEqual(sorted(cache.keys()),
+                         [os.path.join(os.path.abspath(self.dir),
+                                       self.fnames[0])])
+        self.assertEqual([fname for fname in os.listdir(self.dir) if
+                          fname.endswith('.tmp')], [])
+
+
+class Test_ResultCache(TestCase):
+    def setUp(self):
+        self.fake_difmap = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        'fake_difmap')
+        self.dir = tempfile.mkdtemp()
+        for fname in ('uv.fits', 'model.mdl'):
+            with open(os.path.join(self.dir, fname), 'w') as fo:
+                fo.write(fname)
+        self.cache = ResultCache(os.path.join(self.dir, 'cache'),
+                                 max_entries=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def modelfit(self, out_fname, executable, uv_fname='uv.fits'):
+        return modelfit_difmap(uv_fname, 'model.mdl', out_fname,
+                               path=self.dir, mdl_path=self.dir,
+                               out_path=self.dir, cache=self.cache,
+                               runner=DifmapRunner(executable=executable))
+
+    def test_hit(self):
+        out = self.modelfit('fit_1.mdl', self.fake_difmap)
+        self.assertEqual(out, os.path.join(self.dir, 'fit_1.mdl'))
+        # Result is found by content, so ``difmap`` is not needed
+        out = self.modelfit('fit_2.mdl', '/nonexistent/difmap')
+        with open(out) as fo:
+            self.assertIn('Fake wmodel', fo.read())
+        # Changed uv-data are fitted again
+        with open(os.path.join(self.dir, 'uv.fits'), 'w') as fo:
+            fo.write('changed uv-data')
+        with self.assertRaises(DifmapError):
+            self.modelfit('fit_3.mdl', '/nonexistent/difmap')
+
+    def test_lru_eviction(self):
+        keys = list()
+        for i in range(3):
+            uv_fname = 'uv_{}.fits'.format(i)
+            with open(os.path.join(self.dir, uv_fname), 'w') as fo:
+                fo.write(uv_fname)
+            keys.append(self.cache.key([os.path.join(self.dir, uv_fname)],
+                                       {'i': i}))
+        out = os.path.join(self.dir, 'out.mdl')
+        for i, key in enumerate(keys[:2]):
+            self.cache.put(key, os.path.join(self.dir, 'model.mdl'))
+            # Times of the last use of entries are set explicitly as they
+            # could be the same for fast runs
+            t = 1000. * (i + 1)
+            os.utime(self.cache._entry_path(key, '.mdl'), (t, t))
+        # The first entry is used after the second one
+        self.assertIsNotNone(self.cache.get(keys[0], out))
+        self.assertGreater(
+            os.path.getmtime(self.cache._entry_path(keys[0], '.mdl')), 2000.)
+        self.cache.put(keys[2], os.path.join(self.dir, 'model.mdl'))
+        self.assertIsNotNone(self.cache.get(keys[0], out))
+        self.assertIsNone(self.cache.get(keys[1], out))
+        self.assertIsNotNone(self.cache.get(keys[2], out))
+
+
+class Test_CleanDeconvolution(TestCase):
+    class FakeUVData(object):
+        def __init__(self, uv, vis):
+            self.uv = uv
+            self.uvdata = np.repeat(vis[:, np.newaxis, np.newaxis], 2, axis=2)
+            self.weights = np.ones(self.uvdata.shape)
+            self.stokes_dict_inv = {'RR': 0, 'LL': 1}
+            self.frequency = 15e9
+
+    def setUp(self):
+        random_state = np.random.RandomState(1)
+        n = 3000
+        r = random_state.uniform(0, 2e8, n)
+        phi = random_state.uniform(0, 2 * np.pi, n)
+        uv = np.vstack((r * np.cos(phi), 0.6 * r * np.sin(phi))).T
+        self.uvdata = self.FakeUVData(uv, np.zeros(n, dtype=complex))
+        self.mapsize = (128, 0.1)
+        # Point source at pixel (40, 90)
+        self.cc = np.zeros((128, 128))
+        self.cc[40, 90] = 1.
+        vis = CleanDeconvolution(self.uvdata, self.mapsize).degrid(self.cc)
+        self.uvdata = self.FakeUVData(uv, vis)
+
+    def test_point_source(self):
+        for algorithm in ('hogbom', 'clark'):
+            deconvolution = CleanDeconvolution(self.uvdata, self.mapsize)
+            dirty_image = deconvolution.dirty_image()
+            self.assertEqual(np.unravel_index(np.argmax(dirty_image),
+                                              (128, 128)), (40, 90))
+            image = deconvolution.clean(niter=500, algorithm=algorithm)
+            self.assertAlmostEqual(image.total_flux, 1., places=2)
+            self.assertLess(np.abs(image.residuals).max(), 0.01)
+            self.assertEqual(np.unravel_index(np.argmax(image.cc),
+                                              (128, 128)), (40, 90))
+            # Model of CC has the same FT as degridded CC
+            model = deconvolution.model(image)
+            self.assertTrue(np.allclose(model.ft(deconvolution.uv),
+                                        deconvolution.degrid(image.cc)))
+        # Major axis of beam is along DEC
+        self.assertGreater(deconvolution.beam[0], deconvolution.beam[1])
+        self.assertAlmostEqual(deconvolution.beam[2], 0., places=5)
+
+    def test_windows(self):
+        deconvolution = CleanDeconvolution(self.uvdata, self.mapsize)
+        x = -deconvolution._x[90] / mas_to_rad
+        y = -deconvolution._y[40] / mas_to_rad
+        image = deconvolution.clean(niter=500,
+                                    clean_box=(x - 0.3, x + 0.3,
+                                               y - 0.3, y + 0.3))
+        mask = deconvolution.window_mask(clean_box=(x - 0.3, x + 0.3,
+                                                    y - 0.3, y + 0.3))
+        self.assertTrue(mask[40, 90])
+        self.assertFalse(np.any(image.cc[~mask]))
+        self.assertAlmostEqual(image.total_flux, 1., places=2)
+        # Window outside of image
+        self.assertRaises(Exception, deconvolution.clean,
+                          clean_box=(100., 101., 100., 101.))
+
+    def test_threads(self):
+        images = clean_uvdatas([self.uvdata] * 3, 'I', self.mapsize,
+                               n_jobs=3, niter=200)
+        for image in images:
+            self.assertTrue(np.array_equal(image.cc, images[0].cc))
+
+
+class Test_noise_model_cache(TestCase):
+    class FakeUVData(object):
+        def __init__(self, uvdata):
+            self.uvdata = uvdata
+            self.weights = np.ones(uvdata.shape)
+
+    def bootstrap(self, cls, residuals):
+        bootstrap = cls.__new__(cls)
+        bootstrap.data = self.FakeUVData(self.data)
+        bootstrap.residuals = self.FakeUVData(residuals)
+        return bootstrap
+
+    def setUp(self):
+        random_state = np.random.RandomState(1)
+        self.data = random_state.normal(size=(10, 2, 2)) + 0j
+        self.residuals = random_state.normal(size=(10, 2, 2)) + 0j
+
+    def key(self, cls=CleanBootstrap, residuals=None, **options):
+        if residuals is None:
+            residuals = self.residuals
+        return self.bootstrap(cls, residuals).noise_model_key(**options)
+
+    def test_key(self):
+        options = {'nonparametric': False, 'recenter': True, 'use_v': True}
+        key = self.key(**options)
+        self.assertEqual(key, self.key(residuals=self.residuals.copy(),
+                                       **options))
+        # Residuals of other bootstrap class
+        self.assertNotEqual(key, self.key(cls=SelfCalBootstrap, **options))
+        self.assertNotEqual(key, self.key(residuals=self.residuals + 1.,
+                                          **options))
+        # Other options of fitting
+        for option in ('recenter', 'use_v'):
+            changed = dict(options)
+            changed[option] = False
+            self.assertNotEqual(key, self.key(**changed))
+
+
+class Test_scan_bootstrap(TestCase):
+    class FakeUVData(object):
+        scan_index = UVData.scan_index
+
+        def __init__(self, baselines, times, uvdata):
+            self.baselines = sorted(set(baselines))
+            self.nif, self.nstokes = uvdata.shape[1:]
+            self._indxs_baselines = {baseline: baselines == baseline for
+                                     baseline in self.baselines}
+            self._pw_indxs = np.ones(uvdata.shape, dtype=bool)
+            self.uvdata = uvdata
+            self.hdu = type('HDU', (object,), {})()
+            self.hdu.data = {'DATE': times, '_DATE': np.zeros(len(times)),
+                             'BASELINE': baselines}
+            self._scan_index = None
+
+        def sync(self):
+            pass
+
+    def setUp(self):
+        # Lengths of scans of two baselines. Scans are separated by 10 min
+        self.scan_lengths = {258: [4, 6], 259: [5, 3, 4]}
+        baselines, times, self.expected_scans = list(), list(), list()
+        for baseline in sorted(self.scan_lengths):
+            t0 = 0.
+            for n in self.scan_lengths[baseline]:
+                self.expected_scans += n * [len(set(self.expected_scans))]
+                baselines += n * [baseline]
+                times += list(t0 + np.arange(n) * 10. / 86400)
+                t0 += (n * 10. + 600.) / 86400
+        # Visibilities are not sorted by baselines
+        order = np.random.RandomState(1).permutation(len(baselines))
+        self.baselines = np.array(baselines)[order]
+        self.times = np.array(times)[order]
+        self.expected_scans = np.array(self.expected_scans)[order]
+
+    def bootstrap(self, residuals):
+        bootstrap = CleanBootstrap.__new__(CleanBootstrap)
+        bootstrap.residuals = self.FakeUVData(self.baselines, self.times,
+                                              residuals)
+        bootstrap.model_data = self.FakeUVData(self.baselines, self.times,
+                                               np.zeros_like(residuals))
+        bootstrap._resampling_pools = dict()
+        bootstrap._residuals_outliers = nested_ddict()
+        for baseline in self.scan_lengths:
+            n = np.count_nonzero(self.baselines == baseline)
+            for if_ in range(residuals.shape[1]):
+                for stokes in range(residuals.shape[2]):
+                    bootstrap._residuals_outliers[baseline][if_][stokes] =\
+                        np.zeros(n, dtype=bool)
+        return bootstrap
+
+    def test_scan_index(self):
+        uvdata = self.FakeUVData(self.baselines, self.times,
+                                 np.zeros((len(self.times), 1, 1)))
+        self.assertTrue(np.array_equal(uvdata.scan_index, self.expected_scans))
+
+    def test_whole_scans(self):
+        scans = self.expected_scans
+        # Position of each visibility in its scan
+        positions = np.empty(len(scans), dtype=int)
+        for scan in set(scans):
+            in_scan = scans == scan
+            positions[in_scan] = np.argsort(np.argsort(self.times[in_scan]))
+        residuals = (1000. * scans + positions)[:, None, None] *\
+            np.ones((1, 2, 2)) + 0j
+        bootstrap = self.bootstrap(residuals)
+        random_state = np.random.RandomState(2)
+        for _ in range(20):
+            replica = bootstrap.model_data
+            replica.uvdata = np.zeros_like(residuals)
+            bootstrap.resample_residuals_scans(replica, recenter=False,
+                                               whole_scans=True,
+                                               random_state=random_state)
+            values = replica.uvdata.real
+            # The same rows of source scan are used for all IFs & Stokes
+            self.assertTrue(np.all(values == values[:, :1, :1]))
+            for scan in set(scans):
+                in_scan = scans == scan
+                scan_values = values[in_scan, 0, 0][
+                    np.argsort(self.times[in_scan])]
+                sources = (scan_values // 1000).astype(int)
+                source = sources[0]
+                self.assertTrue(np.all(sources == source))
+                self.assertEqual(self.baselines[scans == source][0],
+                                 self.baselines[in_scan][0])
+                # Circular shift of the source scan
+                n_source = np.count_nonzero(scans == source)
+                shift = scan_values[0] % 1000
+                self.assertTrue(np.array_equal(
+                    scan_values % 1000,
+                    (shift + np.arange(len(scan_values))) % n_source))
+
+    def test_within_scans(self):
+        scans = self.expected_scans
+        random_state = np.random.RandomState(3)
+        residuals = (10. * scans)[:, None, None] +\
+            0.1 * random_state.normal(size=(len(scans), 2, 2)) + 0j
+        bootstrap = self.bootstrap(residuals)
+        replica = bootstrap.model_data
+        bootstrap.resample_residuals_scans(replica, recenter=False,
+                                           random_state=random_state)
+        # Residuals are drawn from the same baseline/scan/IF/Stokes
+        for scan in set(scans):
+            for if_ in range(2):
+                for stokes in range(2):
+                    in_scan = scans == scan
+                    self.assertTrue(
+                        set(replica.uvdata[in_scan, if_, stokes]).issubset(
+                            residuals[in_scan, if_, stokes]))
+
+        replica.uvdata = np.zeros_like(residuals)
+        bootstrap.resample_residuals_scans_parametric(
+            replica, recenter=False, use_kde=False, random_state=random_state)
+        # Noise of each scan is centered on the mean of scan
+        deviations = replica.uvdata - (10. * scans)[:, None, None]
+        self.assertTrue(np.all(np.abs(deviations) < 1.))
+
+    def test_whole_scans_parametric(self):
+        bootstrap = self.bootstrap(np.zeros((len(self.times), 1, 1)) + 0j)
+        with self.assertRaises(Exception):
+            bootstrap._prepare_resampling(nonparametric=False,
+                                          split_scans=True,
+                                          recenter=False, use_kde=False,
+                                          use_v=False, combine_scans=False,
+                                          pairs=False, whole_scans=True)
+
+
+class Test_resample_residuals(TestCase):
+    FakeUVData = Test_scan_bootstrap.FakeUVData
+
+    def setUp(self):
+        rstate = np.random.RandomState(0)
+        self.baselines = np.repeat([258, 259], [3000, 2000])
+        n = len(self.baselines)
+        # Residuals of baseline/Stokes groups have different centers & stds
+        self.residuals = np.empty((n, 1, 2), dtype=complex)
+        self.centers = nested_ddict()
+        self.outliers = nested_ddict()
+        self.pools = dict()
+        for baseline, scale in ((258, 1.), (259, 3.)):
+            rows = np.flatnonzero(self.baselines == baseline)
+            for stokes in range(2):
+                center = (stokes + 1.) * scale * (1. - 2j)
+                values = center + scale * (rstate.normal(size=len(rows)) +
+                                           1j * rstate.normal(size=len(rows)))
+                outliers = np.zeros(len(rows), dtype=bool)
+                outliers[:20] = True
+                values[outliers] = 10 ** 6
+                self.residuals[rows, 0, stokes] = values
+                self.outliers[baseline][0][stokes] = outliers
+                self.centers[baseline][0][stokes] = (center.real, center.imag)
+                self.pools[(baseline, stokes)] = values[~outliers]
+
+    def bootstrap(self):
+        bootstrap = CleanBootstrap.__new__(CleanBootstrap)
+        times = np.zeros(len(self.baselines))
+        bootstrap.residuals = self.FakeUVData(self.baselines, times,
+                                              self.residuals)
+        bootstrap._resampling_pools = dict()
+        bootstrap._residuals_outliers = self.outliers
+        bootstrap._residuals_centers = self.centers
+        bootstrap._residuals_fits = nested_ddict()
+        return bootstrap
+
+    def resample(self, method, bootstrap, n_replicas=10, **kwargs):
+        random_state = np.random.RandomState(1)
+        replicas = list()
+        for _ in range(n_replicas):
+            replica = self.FakeUVData(self.baselines, self.baselines,
+                                      np.zeros_like(self.residuals))
+            method(bootstrap, replica, random_state=random_state, **kwargs)
+            replicas.append(replica.uvdata)
+        return np.array(replicas)
+
+    def check_moments(self, replicas, recenter, bandwidths=None):
+        """
+        Check that mean & variance of resampled residuals of groups are those
+        of inliers (plus variance of KDE kernel with ``bandwidths`` - dict with
+        keys - groups & values - bandwidths of Re & Im).
+        """
+        if bandwidths is None:
+            bandwidths = {key: (0., 0.) for key in self.pools}
+        for (baseline, stokes), hs in bandwidths.items():
+            pool = self.pools[(baseline, stokes)]
+            values = replicas[:, self.baselines == baseline, 0, stokes].ravel()
+            center = 0.
+            if recenter:
+                center = complex(*self.centers[baseline][0][stokes])
+            n = len(values)
+            for part, h in zip((np.real, np.imag), hs):
+                std = np.sqrt(np.var(part(pool)) + h ** 2)
+                self.assertLess(abs(np.mean(part(values)) -
+                                    np.mean(part(pool - center))),
+                                5. * std / np.sqrt(n))
+                self.assertAlmostEqual(np.std(part(values)) / std, 1.,
+                                       delta=0.05)
+
+    def test_nonparametric(self):
+        for recenter in (True, False):
+            replicas = self.resample(CleanBootstrap.resample_residuals,
+                                     self.bootstrap(), recenter=recenter)
+            self.check_moments(replicas, recenter)
+
+    def test_pairs(self):
+        bootstrap = self.bootstrap()
+        bootstrap.data = bootstrap.residuals
+        replica = self.FakeUVData(self.baselines, self.baselines,
+                                  np.zeros_like(self.residuals))
+        bootstrap.resample_residuals(replica, pairs=True,
+                                     random_state=np.random.RandomState(1))
+        # Data points are replaced by inliers of the same group
+        for (baseline, stokes), pool in self.pools.items():
+            values = replica.uvdata[self.baselines == baseline, 0, stokes]
+            self.assertTrue(set(values).issubset(pool))
+
+    def test_kde(self):
+        fit = type('Fit', (object,), {})
+        bandwidths = dict()
+        bootstrap = self.bootstrap()
+        for baseline, stokes in self.pools:
+            if (baseline, stokes) == (259, 1):
+                continue
+            fits = (fit(), fit())
+            fits[0].bandwidth, fits[1].bandwidth = 0.3 * stokes + 0.2, 0.5
+            bootstrap._residuals_fits[baseline][0][stokes] = fits
+            bandwidths[(baseline, stokes)] = (fits[0].bandwidth,
+                                              fits[1].bandwidth)
+
+        replicas = self.resample(CleanBootstrap.resample_residuals_kde,
+                                 bootstrap, recenter=True)
+        self.check_moments(replicas, True, bandwidths=bandwidths)
+        # Group without fit is only resampled: Re & Im are taken from
+        # (independently drawn) inliers
+        center = complex(*self.centers[259][0][1])
+        values = replicas[:, self.baselines == 259, 0, 1].ravel()
+        pool = self.pools[(259, 1)] - center
+        self.assertTrue(set(values.real).issubset(pool.real))
+        self.assertTrue(set(values.imag).issubset(pool.imag))
+
+
+class Test_run(TestCase):
+    class FakeModelData(Test_scan_bootstrap.FakeUVData):
+        """
+        Saves visibilities to ``.npy`` files instead of FITS-files.
+        """
+        def sync(self):
+            self.hdu.data['DATA'] = self.uvdata.copy()
+
+        def save(self, data, fname):
+            np.save(fname, data['DATA'])
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        data = Test_resample_residuals('test_nonparametric')
+        data.setUp()
+        self.bootstrap = data.bootstrap()
+        self.bootstrap.model_data = self.FakeModelData(
+            data.baselines, np.zeros(len(data.baselines)),
+            np.ones_like(data.residuals))
+        self.bootstrap.sigma_ampl_scale = None
+        self.bootstrap.additional_noise = None
+        self.bootstrap.noise_residuals = None
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def sample(self, name, n, **kwargs):
+        outname = [os.path.join(self.tmp_dir, name), '.npy']
+        self.bootstrap.run(n, True, outname=outname, seed=1, **kwargs)
+        return [np.load(outname[0] + '_' + str(i + 1).zfill(3) + outname[1])
+                for i in range(kwargs.get('start', 0),
+                               kwargs.get('start', 0) + n)]
+
+    def assertSameReplicas(self, replicas, other):
+        self.assertEqual(len(replicas), len(other))
+        for replica, other_replica in zip(replicas, other):
+            self.assertTrue(np.array_equal(replica, other_replica))
+
+    def test_n_jobs(self):
+        replicas = self.sample('serial', 4, n_jobs=1)
+        self.assertSameReplicas(self.sample('parallel', 4, n_jobs=2), replicas)
+        # Replicas differ
+        self.assertFalse(np.array_equal(replicas[0], replicas[1]))
+
+    def test_start(self):
+        replicas = self.sample('whole', 4)
+        split = self.sample('split', 2, start=0) +\
+            self.sample('split', 2, start=2)
+        self.assertSameReplicas(split, replicas)
+
+    def test_iter_replicas(self):
+        replicas = self.sample('saved', 4, start=1)
+        for arrays in (False, True):
+            iterated = list(self.bootstrap.iter_replicas(4, True, seed=1,
+                                                         start=1,
+                                                         arrays=arrays))
+            if not arrays:
+                iterated = [replica.uvdata for replica in iterated]
+            self.assertSameReplicas(iterated, replicas)
+
+
+class Test_SequentialBootstrap(TestCase):
+    class StubBootstrap(object):
+        """
+        Makes "replicas" of normal random statistics instead of FITS-files.
+        """
+        def __init__(self):
+            self.replicas = dict()
+            self.starts = list()
+
+        def run(self, n, nonparametric, split_scans, recenter, use_kde, use_v,
+                combine_scans, outname, seed, start=0, **kwargs):
+            self.starts.append(start)
+            for i in range(start, start + n):
+                fname = outname[0] + '_' + str(i + 1).zfill(3) + outname[1]
+                self.replicas[fname] =\
+                    replica_random_state(seed, i).normal(size=3)
+
+    def sequential(self, **kwargs):
+        bootstrap = self.StubBootstrap()
+        return SequentialBootstrap(bootstrap,
+                                   lambda fname, i: bootstrap.replicas[fname],
+                                   **kwargs)
+
+    def test_stopping(self):
+        sequential = self.sequential(batch_size=50, min_n=100, max_n=5000,
+                                     tol=0.1)
+        low, high = sequential.run(True, seed=1)
+        self.assertTrue(sequential.converged)
+        self.assertTrue(sequential.min_n <= sequential.n < sequential.max_n)
+        self.assertEqual(sequential.bootstrap.starts,
+                         range(0, sequential.n, 50))
+        # The same replicas as for one run of ``n`` replicas with this seed
+        one_shot = self.StubBootstrap()
+        one_shot.run(sequential.n, True, False, True, True, True, False,
+                     ['bootstrapped_data', '.fits'], seed=1)
+        samples = np.array([one_shot.replicas[fname] for fname in
+                            sequential.fnames])
+        self.assertTrue(np.array_equal(sequential.samples, samples))
+        expected_low, expected_high = hdi_of_samples(samples, cred_mass=0.68)
+        self.assertTrue(np.array_equal(low, expected_low))
+        self.assertTrue(np.array_equal(high, expected_high))
+        # Intervals of standard normal statistics
+        self.assertTrue(np.allclose(low, -1., atol=0.3))
+        self.assertTrue(np.allclose(high, 1., atol=0.3))
+
+    def test_max_n(self):
+        sequential = self.sequential(batch_size=30, min_n=100, max_n=200,
+                                     tol=0.)
+        sequential.run(True, seed=2)
+        self.assertFalse(sequential.converged)
+        self.assertEqual(sequential.n, 200)
+        self.assertEqual(sequential.bootstrap.starts,
+                         [0, 30, 60, 90, 120, 150, 180])
+
+
+class _Interrupt(Exception):
+    pass
+
+
+class Test_nested(TestCase):
+    # Normalized gaussian likelihoods & uniform prior on [-10, 10]^2 have
+    # evidence 1/400
+    sigma = 0.5
+    logz_true = -np.log(400.)
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.dir, 'nested.pkl')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def lnlik(self, v):
+        return (-0.5 * np.sum(v ** 2, axis=1) / self.sigma ** 2 -
+                np.log(2. * np.pi * self.sigma ** 2))
+
+    def lnlik_bimodal(self, v):
+        return (np.logaddexp(self.lnlik(v - 3.), self.lnlik(v + 3.)) -
+                np.log(2.))
+
+    @staticmethod
+    def prior_transform(u):
+        return 20. * u - 10.
+
+    def test_evidence(self):
+        for lnlik, method in ((self.lnlik, 'single'),
+                              (self.lnlik_bimodal, 'multi')):
+            result = nested_sample(lnlik, self.prior_transform, 2,
+                                   npoints=100, dlogz=0.1, method=method,
+                                   rstate=np.random.RandomState(0))
+            self.assertLess(abs(result['logz'] - self.logz_true),
+                            3. * result['logzerr'])
+            self.assertAlmostEqual(np.sum(result['weights']), 1.)
+
+    def test_multi_ellipsoid_efficiency(self):
+        ncalls = dict()
+        for method in ('single', 'multi'):
+            result = nested_sample(self.lnlik_bimodal, self.prior_transform,
+                                   2, npoints=100, dlogz=0.1, method=method,
+                                   rstate=np.random.RandomState(0))
+            ncalls[method] = result['ncall']
+        self.assertLess(ncalls['multi'], 0.5 * ncalls['single'])
+
+    def run_sampler(self, **kwargs):
+        return nested_sample(self.lnlik, self.prior_transform, 2, npoints=50,
+                             update_interval=7, method='multi', **kwargs)
+
+    def interrupt(self, state):
+        if state['it'] == 55:
+            raise _Interrupt
+
+    def test_resume(self):
+        result = self.run_sampler(rstate=np.random.RandomState(1))
+        with self.assertRaises(_Interrupt):
+            self.run_sampler(rstate=np.random.RandomState(1),
+                             checkpoint_file=self.checkpoint,
+                             checkpoint_every=20, callback=self.interrupt)
+        self.assertTrue(os.path.exists(self.checkpoint))
+        # State of generator is restored from checkpoint
+        resumed = self.run_sampler(rstate=np.random.RandomState(2),
+                                   checkpoint_file=self.checkpoint,
+                                   checkpoint_every=20)
+        self.assertFalse(os.path.exists(self.checkpoint))
+        for key in ('samples', 'logl', 'weights'):
+            np.testing.assert_array_equal(resumed[key], result[key])
+        for key in ('logz', 'h', 'niter', 'ncall'):
+            self.assertEqual(resumed[key], result[key])
+
+    def test_checkpoint_of_other_inputs(self):
+        with self.assertRaises(_Interrupt):
+            self.run_sampler(rstate=np.random.RandomState(1),
+                             checkpoint_file=self.checkpoint,
+                             checkpoint_key='source1', checkpoint_every=20,
+                             callback=self.interrupt)
+        result = self.run_sampler(rstate=np.random.RandomState(2))
+        restarted = self.run_sampler(rstate=np.random.RandomState(2),
+                                     checkpoint_file=self.checkpoint,
+                                     checkpoint_key='source2',
+                                     checkpoint_every=20)
+        np.testing.assert_array_equal(restarted['samples'], result['samples'])
+        self.assertEqual(restarted['logz'], result['logz'])
+
+
+class Test_ChainBackend(TestCase):
+    nwalkers = 8
+    ndim = 2
+    iterations = 100
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.p0 = np.random.RandomState(0).normal(size=(self.nwalkers,
+                                                        self.ndim))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    @staticmethod
+    def lnprob(p):
+        return -0.5 * np.sum(p ** 2)
+
+    def sampler(self, seed=1):
+        sampler = emcee.EnsembleSampler(self.nwalkers, self.ndim, self.lnprob)
+        sampler.random_state = np.random.RandomState(seed).get_state()
+        return sampler
+
+    def backend(self, name='chain'):
+        return ChainBackend(self.dir, name=name, checkpoint_every=30)
+
+    def test_chain(self):
+        sampler = self.sampler()
+        sampler.run_mcmc(self.p0, self.iterations)
+        backend = self.backend()
+        run_mcmc(self.sampler(), self.p0, self.iterations, backend=backend)
+        self.assertEqual(backend.iteration, self.iterations)
+        # Chunks of 30, 30, 30 & 10 steps
+        self.assertEqual(backend.load_state()['n_chunks'], 4)
+        np.testing.assert_array_equal(backend.chain, sampler.chain)
+        np.testing.assert_array_equal(backend.lnprobability,
+                                      sampler.lnprobability)
+        np.testing.assert_array_equal(backend.flatchain, sampler.flatchain)
+
+    def test_resume(self):
+        backend = self.backend('uninterrupted')
+        run_mcmc(self.sampler(), self.p0, self.iterations, backend=backend)
+
+        def interrupt(pos, lnprob, iteration):
+            if iteration == 45:
+                raise KeyboardInterrupt
+
+        def stop(pos, lnprob, iteration):
+            return iteration == 70
+
+        interrupted = self.backend('interrupted')
+        with self.assertRaises(KeyboardInterrupt):
+            run_mcmc(self.sampler(), self.p0, self.iterations,
+                     backend=interrupted, callback=interrupt)
+        # Steps after the last checkpoint are lost
+        self.assertEqual(interrupted.iteration, 30)
+        # Positions & state of RNG are restored from checkpoint
+        run_mcmc(self.sampler(seed=2), None, self.iterations,
+                 backend=interrupted, callback=stop)
+        self.assertEqual(interrupted.iteration, 70)
+        run_mcmc(self.sampler(seed=3), None, self.iterations,
+                 backend=interrupted)
+        self.assertEqual(interrupted.iteration, self.iterations)
+        np.testing.assert_array_equal(interrupted.chain, backend.chain)
+        np.testing.assert_array_equal(interrupted.lnprobability,
+                                      backend.lnprobability)
+
+    def test_partial_chunk(self):
+        backend = self.backend()
+        self.assertIsNone(backend.chain)
+        self.assertEqual(backend.iteration, 0)
+        rstate = np.random.RandomState(0).get_state()
+        chain = np.random.normal(size=(30, self.nwalkers, self.ndim))
+        lnprob = np.random.normal(size=(30, self.nwalkers))
+        backend.append(chain, lnprob, rstate)
+        # Chunk written by process that was killed before saving state
+        with open(backend._chunk_fname(1), 'wb') as fo:
+            np.savez(fo, chain=chain[:10], lnprob=lnprob[:10])
+        np.testing.assert_array_equal(backend.chain,
+                                      np.swapaxes(chain, 0, 1))
+        np.testing.assert_array_equal(backend.lnprobability, lnprob.T)
+        self.assertEqual(backend.iteration, 30)
+        # Next checkpoint overwrites it
+        backend.append(chain[:5], lnprob[:5], rstate)
+        self.assertEqual(backend.chain.shape, (self.nwalkers, 35, self.ndim))
+        np.testing.assert_array_equal(backend.chain[:, 30:],
+                                      np.swapaxes(chain[:5], 0, 1))
+        backend.reset()
+        self.assertIsNone(backend.load_state())
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+class Test_ConvergenceMonitor(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_ar1(self):
+        # AR(1) process x(t) = phi * x(t - 1) + noise has integrated
+        # autocorrelation time (1 + phi) / (1 - phi)
+        n_walkers, n_steps = 32, 5000
+        phis = np.array([0., 0.5, 0.8])
+        taus = (1. + phis) / (1. - phis)
+        rstate = np.random.RandomState(0)
+        monitor = ConvergenceMonitor(n_walkers, len(phis), max_lag=200)
+        pos = rstate.normal(size=(n_walkers, len(phis))) / np.sqrt(1. -
+                                                                 phis ** 2)
+        for _ in range(n_steps):
+            pos = phis * pos + rstate.normal(size=pos.shape)
+            monitor.update(pos)
+        np.testing.assert_allclose(monitor.integrated_time(), taus,
+                                   rtol=0.1)
+        np.testing.assert_allclose(monitor.ess, n_walkers * n_steps / taus,
+                                   rtol=0.1)
+        np.testing.assert_allclose(monitor.rhat, 1., atol=0.01)
+
+    def sample(self, iterations, backend, monitor):
+        sampler = emcee.EnsembleSampler(16, 2, Test_ChainBackend.lnprob)
+        sampler.random_state = np.random.RandomState(1).get_state()
+        p0 = np.random.RandomState(0).normal(size=(16, 2))
+        return run_until_converged(sampler, p0, iterations, monitor,
+                                   backend=backend)
+
+    def monitor(self):
+        return ConvergenceMonitor(16, 2, tau_factor=20., tau_rtol=0.2,
+                                  check_every=50)
+
+    def test_early_stopping(self):
+        backend = ChainBackend(self.dir, name='full')
+        monitor = self.monitor()
+        self.sample(5000, backend, monitor)
+        self.assertTrue(monitor.converged)
+        self.assertLess(monitor.n_steps, 5000)
+        self.assertEqual(monitor.n_steps % monitor.check_every, 0)
+        self.assertEqual(backend.iteration, monitor.n_steps)
+        self.assertTrue(np.all(monitor.n_steps > 20. * monitor.tau))
+        self.assertGreater(monitor.time_saved(5000), 0.)
+
+        # Run interrupted before convergence & resumed with new monitor
+        interrupted = ChainBackend(self.dir, name='interrupted')
+        self.sample(monitor.n_steps - 70, interrupted, self.monitor())
+        resumed = self.monitor()
+        self.sample(5000, interrupted, resumed)
+        self.assertEqual(resumed.n_steps, monitor.n_steps)
+        np.testing.assert_array_equal(resumed.tau, monitor.tau)
+        self.assertEqual(len(resumed.history), len(monitor.history))
+        np.testing.assert_array_equal(interrupted.chain, backend.chain)
+        # Converged chain is not continued
+        self.sample(5000, interrupted, self.monitor())
+        self.assertEqual(interrupted.iteration, monitor.n_steps)
+
+
+class Test_LnLikelihood(TestCase):
+    class FakeUVData(object):
+        """
+        Visibilities of model with gaussian noise on baselines of 4 antennas.
+        """
+        def __init__(self, model, n=300, nif=2, seed=0):
+            rstate = np.random.RandomState(seed)
+            self.antennas = [1, 2, 3, 4]
+            baselines = np.array([256 * i + j for i in self.antennas for j in
+                                  self.antennas if i < j])
+            self.hdu = type('HDU', (object,), {})()
+            self.hdu.data = {'BASELINE': rstate.choice(baselines, n)}
+            self.baselines = sorted(set(self.hdu.data['BASELINE']))
+            self.uv = rstate.uniform(-10 ** 8, 10 ** 8, size=(n, 2))
+            self.sigma = rstate.uniform(0.05, 0.2, size=(n, nif, 2))
+            # Noise of the last baseline is underestimated
+            scale = np.where(self.hdu.data['BASELINE'] == baselines[-1], 3.,
+                             1.)[:, np.newaxis, np.newaxis]
+            noise = scale * self.sigma * (
+                rstate.normal(size=self.sigma.shape) +
+                1j * rstate.normal(size=self.sigma.shape))
+            uvdata = model.ft(self.uv)[:, np.newaxis, np.newaxis] + noise
+            mask = np.zeros(uvdata.shape, dtype=bool)
+            mask[rstate.choice(n, 10), 0, :] = True
+            self.uvdata = np.ma.array(uvdata, mask=mask)
+            self.uvdata_freq_averaged = np.ma.array(uvdata.mean(axis=1),
+                                                    mask=mask.any(axis=1))
+
+        def error(self, average_freq=True, use_V=False):
+            if average_freq:
+                return (np.sqrt(np.sum(self.sigma ** 2, axis=1)) /
+                        self.sigma.shape[1])
+            return self.sigma
+
+    def setUp(self):
+        self.model = Model(stokes='I')
+        self.model.add_components(EGComponent(1., 0.1, 0.05, 0.5, 0.6, 0.3),
+                                  CGComponent(0.5, 1., -0.5, 0.8),
+                                  DeltaComponent(0.2, 2., 1.))
+        for component in self.model._components:
+            component.add_prior(flux=(sp.stats.uniform.logpdf, [0., 3.],
+                                      dict()))
+        self.p = self.model.p.copy()
+        self.uvdata = self.FakeUVData(self.model)
+
+    def params(self, n, seed=1):
+        rstate = np.random.RandomState(seed)
+        return self.p + 0.05 * rstate.normal(size=(n, len(self.p)))
+
+    def test_batch(self):
+        p = self.params(10)
+        for kwargs in ({}, {'average_freq': False}, {'amp_only': True}):
+            lnlik = LnLikelihood(self.uvdata, self.model, **kwargs)
+            expected = [lnlik(p_) for p_ in p]
+            for chunk_size in (1, 3, 10, 32):
+                np.testing.assert_allclose(lnlik.batch(p, chunk_size),
+                                           expected, rtol=1e-10)
+            np.testing.assert_allclose(lnlik(p), expected, rtol=1e-10)
+
+    def test_lnpost_batch(self):
+        p = self.params(10)
+        # Prior of flux is zero
+        p[3, 0] = -1.
+        lnpost = LnPost(self.uvdata, self.model)
+        expected = [lnpost(p_) for p_ in p]
+        self.assertEqual(expected[3], -np.inf)
+        np.testing.assert_allclose(lnpost.batch(p), expected, rtol=1e-10)
+
+        pool = BatchPool()
+        np.testing.assert_allclose(
+            pool.map(emcee.ensemble._function_wrapper(lnpost, [], {}), p),
+            expected, rtol=1e-10)
+        likeprior = emcee.ptsampler.PTLikePrior(lnpost.lnlik, lnpost.lnpr)
+        lnlik, lnpr = np.array(pool.map(likeprior, p)).T
+        np.testing.assert_allclose(lnlik + lnpr, expected, rtol=1e-10)
+        # Likelihood is not evaluated for sets of parameters with zero prior
+        self.assertEqual(lnlik[3], -np.inf)
+
+    def test_shared_memory_pool(self):
+        jitter = Jitter(self.uvdata, per='antenna')
+        jitter.set_priors()
+        n = self.model.size
+        p = np.hstack((self.params(9),
+                       np.random.RandomState(2).uniform(-1., 0., size=(
+                           9, jitter.size))))
+        p[3, 0] = -1.
+        for kwargs in ({}, {'average_freq': False}, {'jitter': jitter}):
+            lnpost = LnPost(self.uvdata, self.model, **kwargs)
+            p_ = p[:, :lnpost.lnlik.size]
+            expected = [lnpost(p__) for p__ in p_]
+            pool = SharedMemoryPool(lnpost.lnlik, lnpost.lnpr, processes=2,
+                                    chunk_size=2)
+            try:
+                np.testing.assert_allclose(
+                    pool.map(emcee.ensemble._function_wrapper(lnpost, [], {}),
+                             p_), expected, rtol=1e-10)
+                likeprior = emcee.ptsampler.PTLikePrior(lnpost.lnlik,
+                                                        lnpost.lnpr)
+                lnlik, lnpr = np.array(pool.map(likeprior, p_)).T
+                np.testing.assert_allclose(lnlik + lnpr, expected, rtol=1e-10)
+            finally:
+                pool.close()
+
+        lnlik = LnLikelihood(self.uvdata, self.model, amp_only=True)
+        pool = SharedMemoryPool(lnlik, processes=2)
+        try:
+            np.testing.assert_allclose(pool.map(lnlik, p[:, :n]),
+                                       [lnlik(p_) for p_ in p[:, :n]],
+                                       rtol=1e-10)
+        finally:
+            pool.close()
+
+    def test_pickle(self):
+        p = self.params(3)
+        # Bound methods of ``scipy.stats`` distributions used as priors are
+        # not picklable in Python 2
+        for component in self.model._components:
+            component._lnprior.clear()
+        lnpost = LnPost(self.uvdata, self.model)
+        # ``UVData`` instance is not pickled
+        lnlik = pickle.loads(pickle.dumps(lnpost.lnlik,
+                                          pickle.HIGHEST_PROTOCOL))
+        self.assertIsNone(lnlik.data)
+        np.testing.assert_array_equal(lnlik.batch(p), lnpost.lnlik.batch(p))
+        # Workers of pool get neither ``UVData`` nor arrays of visibilities
+        stripped = _stripped_lnpost(lnpost.lnlik, lnpost.lnpr)
+        for attr in ('data', 'uv', 'uvdata', 'error'):
+            self.assertIsNone(getattr(stripped.lnlik, attr))
+            self.assertIsNotNone(getattr(lnpost.lnlik, attr))
+        n_bytes = len(pickle.dumps(stripped, pickle.HIGHEST_PROTOCOL))
+        self.assertLess(n_bytes, lnpost.lnlik.uvdata.nbytes)
+
+    def test_amp_only(self):
+        lnlik = LnLikelihood(self.uvdata, self.model, amp_only=True)
+        mask = np.ma.getmaskarray(lnlik.uvdata)
+        sigma = lnlik.error[~mask]
+        model_amp = np.absolute(self.model.ft(lnlik.uv))
+        expected = sp.stats.rice.logpdf(np.absolute(lnlik.uvdata[~mask]),
+                                        model_amp[~mask] / sigma,
+                                        scale=sigma).sum()
+        self.assertAlmostEqual(lnlik(self.p), expected, places=8)
+
+    def jitter_params(self, jitter, seed=2):
+        return np.random.RandomState(seed).uniform(-0.5, 1.5, size=jitter.size)
+
+    def test_jitter(self):
+        baselines = np.array(self.uvdata.baselines)
+        ants = [baselines // 256, baselines % 256]
+        for per in ('baseline', 'antenna'):
+            jitter = Jitter(self.uvdata, per=per)
+            q = self.jitter_params(jitter)
+            if per == 'baseline':
+                log_scales = q
+            else:
+                log_scales = (q[np.searchsorted(jitter.names, ants[0])] +
+                              q[np.searchsorted(jitter.names, ants[1])])
+            groups = np.searchsorted(baselines,
+                                     self.uvdata.hdu.data['BASELINE'])
+            for average_freq in (True, False):
+                lnlik = LnLikelihood(self.uvdata, self.model, jitter=jitter,
+                                     average_freq=average_freq)
+                # Likelihood without jitter & with explicitly scaled noise
+                scaled = LnLikelihood(self.uvdata, self.model,
+                                      average_freq=average_freq)
+                scale = np.exp(log_scales[groups])
+                if not average_freq:
+                    scale = scale[:, np.newaxis]
+                scaled.error = scaled.error * scale
+                p = np.hstack((self.p, q))
+                self.assertAlmostEqual(lnlik(p), scaled(self.p), places=8)
+                np.testing.assert_allclose(
+                    lnlik.batch(np.vstack((p, p))), [scaled(self.p)] * 2,
+                    rtol=1e-12)
+
+    def test_gradient(self):
+        jitter = Jitter(self.uvdata, per='antenna')
+        p0 = self.params(1)[0]
+        for kwargs in ({}, {'average_freq': False}, {'amp_only': True},
+                       {'jitter': Jitter(self.uvdata)}, {'jitter': jitter}):
+            lnlik = LnLikelihood(self.uvdata, self.model, **kwargs)
+            p = p0
+            if 'jitter' in kwargs:
+                p = np.hstack((p0, self.jitter_params(kwargs['jitter'])))
+            gradient = lnlik.gradient(p)
+            numerical = np.empty(len(p))
+            for i in range(len(p)):
+                dp = np.zeros(len(p))
+                dp[i] = 1e-6
+                numerical[i] = (lnlik(p + dp) - lnlik(p - dp)) / 2e-6
+            np.testing.assert_allclose(gradient, numerical, rtol=1e-4,
+                                       atol=1e-4 * np.abs(numerical).max())
+
+
+class Test_rice_lnlik(TestCase):
+    def logpdf(self, model_amp, data_amp, sigma):
+        # Full ln of Rice density
+        return (rice_lnlik(model_amp, data_amp, sigma ** -2.) +
+                np.log(data_amp) - 2. * np.log(sigma))
+
+    def test_logpdf(self):
+        rstate = np.random.RandomState(0)
+        model_amp = rstate.uniform(0., 5., size=100)
+        sigma = rstate.uniform(0.1, 2., size=100)
+        data_amp = sp.stats.rice.rvs(model_amp / sigma, scale=sigma,
+                                     random_state=rstate)
+        np.testing.assert_allclose(self.logpdf(model_amp, data_amp, sigma),
+                                   sp.stats.rice.logpdf(data_amp,
+                                                        model_amp / sigma,
+                                                        scale=sigma),
+                                   rtol=1e-10)
+
+    def test_bright(self):
+        # Amplitudes of thousands of sigma
+        model_amp = np.array([10., 30., 100.])
+        sigma = np.array([0.01, 0.001, 0.01])
+        data_amp = model_amp + sigma * np.array([0.5, -1., 2.])
+        x = model_amp * data_amp / sigma ** 2
+        with np.errstate(over='ignore'):
+            self.assertTrue(np.all(np.isinf(np.log(sp.special.i0(x)))))
+        lnlik = self.logpdf(model_amp, data_amp, sigma)
+        self.assertTrue(np.all(np.isfinite(lnlik)))
+        np.testing.assert_allclose(lnlik,
+                                   sp.stats.rice.logpdf(data_amp,
+                                                        model_amp / sigma,
+                                                        scale=sigma),
+                                   rtol=1e-8)
+        # Rice density approaches normal one for bright sources
+        np.testing.assert_allclose(lnlik,
+                                   sp.stats.norm.logpdf(data_amp, model_amp,
+                                                        sigma),
+                                   atol=1e-3)
+
+    def test_masked(self):
+        # Zero inverse variance of masked data
+        self.assertEqual(rice_lnlik(np.array([1e5]), np.array([1.]),
+                                    np.array([0.]))[0], 0.)
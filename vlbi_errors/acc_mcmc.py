@@ -1,7 +1,7 @@
 import os
 from uv_data import UVData
 from model import Model
-from stats import LnPost
+from stats import LnPost, SharedMemoryPool
 from components import EGComponent
 import emcee
 import corner
@@ -26,7 +26,8 @@ uvdata = UVData(os.path.join(data_dir, uv_fits))
 lnpost = LnPost(uvdata, model, use_V=True, average_freq=True)
 ndim = model.size
 nwalkers = 200
-sampler = emcee.EnsembleSampler(nwalkers, ndim, lnpost)
+pool = SharedMemoryPool(lnpost.lnlik, lnpost.lnpr)
+sampler = emcee.EnsembleSampler(nwalkers, ndim, lnpost, pool=pool)
 p_std = [1., 0.1, 0.1, 0.03, 0.05, 0.2]
 p0 = emcee.utils.sample_ball(model.p, p_std, size=nwalkers)
 pos, prob, state = sampler.run_mcmc(p0, 100)
@@ -38,6 +39,7 @@ sampler.reset()
 p_std = [0.1, 0.01, 0.01, 0.01, 0.01, 0.01]
 p0 = emcee.utils.sample_ball(p_map, p_std, size=nwalkers)
 pos, prob, state = sampler.run_mcmc(p0, 500)
+pool.close()
 # Plot corner
 fig, axes = plt.subplots(nrows=ndim, ncols=ndim)
 fig.set_size_inches(19.5, 19.5)
@@ -8,7 +8,8 @@ import matplotlib.pyplot as plt
 from scipy.stats import mode
 from astropy.time import Time
 from uv_data import UVData
-from spydiff import clean_difmap
+from spydiff import clean_difmap, clean_difmap_commands, clean_difmap_key
+from difmap_runner import DifmapRunner
 from from_fits import (create_clean_image_from_fits_file,
                        create_image_from_fits_file, create_model_from_fits_file)
 from image import find_shift, find_bbox
@@ -67,7 +68,8 @@ class MFObservations(object):
     def __init__(self, fits_files, imsizes=None, n_boot=100, common_imsize=None,
                  common_beam=None, find_shifts=False, path_to_script=None,
                  data_dir=None, clear_difmap_logs=True, rotm_slices=None,
-                 sigma_evpa=None, sigma_d_term=None, n_scans=None):
+                 sigma_evpa=None, sigma_d_term=None, n_scans=None,
+                 difmap_runner=None, result_cache=None):
         """
         :param fits_files:
             Iterable of FITS files with self-calibrated simultaneous
@@ -110,6 +112,18 @@ class MFObservations(object):
             Iterable of numbers of independend scans for each band. If ``None``
             then number of scans is determined from data (some of them may be
             dependent). (default: ``None``)
+        :param difmap_runner: (optional)
+            Instance of ``difmap_runner.DifmapRunner`` used for CLEANing. Its
+            ``n_jobs`` bootstrap replications are CLEANed concurrently (by
+            persistent ``difmap`` sessions if its ``sessions`` is ``True``).
+            If ``None`` then use default ``difmap`` executable and CLEAN
+            serially. (default: ``None``)
+        :param result_cache: (optional)
+            Instance of ``result_cache.ResultCache`` with CLEAN images. If
+            given then images are taken from it instead of checking existence
+            of output files, so CLEAN is repeated for changed uv-data, script
+            or parameters. If ``None`` then existing output files are used.
+            (default: ``None``)
 
         """
         self.original_fits_files = fits_files
@@ -156,6 +170,10 @@ class MFObservations(object):
             data_dir = os.getcwd()
         self.data_dir = data_dir
         self.clear_difmap_logs = clear_difmap_logs
+        if difmap_runner is None:
+            difmap_runner = DifmapRunner()
+        self.difmap_runner = difmap_runner
+        self.result_cache = result_cache
 
         # Container for original CLEAN-images of self-calibrated uv-data
         self.cc_image_dict = dict()
@@ -215,10 +233,6 @@ class MFObservations(object):
             n_sigma_mask=None, rotm_slices=None, pxls_plot=None,
             plot_points=None, model_generator=None, slice_ylim=None):
         self._t0 = Time.now()
-        date, time = str(self._t0.utc.datetime).split()
-        self._difmap_commands_file =\
-            os.path.join(self.data_dir,
-                         "difmap_commands_{}_{}".format(date, time))
         self.clean_original_native(freq_stokes_dict=None)
         self.clean_original_common(freq_stokes_dict=None)
         if self.find_shifts:
@@ -320,12 +334,14 @@ class MFObservations(object):
                     outfname = '{}_{}_cc.fits'.format(freq, stokes)
                     outpath = os.path.join(self.data_dir, outfname)
                     # Check if it is already done
-                    if not os.path.exists(outpath):
+                    if (self.result_cache is not None or
+                            not os.path.exists(outpath)):
                         clean_difmap(uv_fname, outfname, stokes,
                                      self.imsizes_dict[freq], path=uv_dir,
                                      path_to_script=self.path_to_script,
                                      outpath=self.data_dir,
-                                     command_file=self._difmap_commands_file)
+                                     runner=self.difmap_runner,
+                                     cache=self.result_cache)
                     else:
                         print("Found CLEAN model in file {}".format(outfname))
                     self.cc_fits_dict[freq].update({stokes: os.path.join(self.data_dir,
@@ -367,13 +383,15 @@ class MFObservations(object):
                 outfname = 'cs_{}_{}_cc.fits'.format(freq, stokes)
                 outpath = os.path.join(self.data_dir, outfname)
                 # Check if it is already done
-                if not os.path.exists(outpath):
+                if (self.result_cache is not None or
+                        not os.path.exists(outpath)):
                     clean_difmap(uv_fname, outfname, stokes, self.common_imsize,
                                  path=uv_dir,
                                  path_to_script=self.path_to_script,
                                  beam_restore=self.common_beam,
                                  outpath=self.data_dir,
-                                 command_file=self._difmap_commands_file)
+                                 runner=self.difmap_runner,
+                                 cache=self.result_cache)
                 else:
                     print("Found CLEAN model in file {}".format(outfname))
                 self.cc_cs_fits_dict[freq].update({stokes: os.path.join(self.data_dir,
@@ -443,7 +461,8 @@ class MFObservations(object):
                 curdir = os.getcwd()
                 os.chdir(self.data_dir)
                 boot.run(n=self.n_boot, nonparametric=False, use_v=False,
-                         use_kde=True, outname=['boot_{}'.format(freq), '.uvf'])
+                         use_kde=True, outname=['boot_{}'.format(freq), '.uvf'],
+                         cache_dir=self.data_dir)
                 os.chdir(curdir)
 
                 files = glob.glob(os.path.join(self.data_dir,
@@ -458,21 +477,39 @@ class MFObservations(object):
             self.cc_boot_fits_dict.update({freq: dict()})
             uv_fits_paths = self.uvfits_boot_dict[freq]
             for stokes in self.stokes:
+                jobs = list()
+                # Keys of CLEANed replications to put in cache
+                cached = list()
                 for i, uv_fits_path in enumerate(uv_fits_paths):
                     uv_dir, uv_fname = os.path.split(uv_fits_path)
                     outfname = 'boot_{}_{}_cc_{}.fits'.format(freq, stokes,
                                                               str(i + 1).zfill(3))
+                    outpath = os.path.join(self.data_dir, outfname)
                     # Check if it is already done
-                    if not os.path.exists(os.path.join(self.data_dir,
-                                                       outfname)):
-                        clean_difmap(uv_fname, outfname, stokes,
-                                     self.common_imsize, path=uv_dir,
-                                     path_to_script=self.path_to_script,
-                                     beam_restore=self.common_beam,
-                                     outpath=self.data_dir,
-                                     command_file=self._difmap_commands_file)
-                    else:
+                    if self.result_cache is not None:
+                        key = clean_difmap_key(self.result_cache, uv_fname,
+                                               stokes, self.common_imsize,
+                                               path=uv_dir,
+                                               path_to_script=self.path_to_script,
+                                               beam_restore=self.common_beam)
+                        if self.result_cache.get(key, outpath) is not None:
+                            print("Found CLEAN model of {} in"
+                                  " cache".format(outfname))
+                            continue
+                        cached.append((key, outpath))
+                    elif os.path.exists(outpath):
                         print("Found CLEAN model in file {}".format(outfname))
+                        continue
+                    jobs.append(clean_difmap_commands(uv_fname, outfname,
+                                                      stokes,
+                                                      self.common_imsize,
+                                                      path=uv_dir,
+                                                      path_to_script=self.path_to_script,
+                                                      beam_restore=self.common_beam,
+                                                      outpath=self.data_dir))
+                self.difmap_runner.map(jobs)
+                for key, outpath in cached:
+                    self.result_cache.put(key, outpath)
                 files = sorted(glob.glob(os.path.join(self.data_dir,
                                                       'boot_{}_{}_cc_*.fits'.format(freq, stokes))))
                 self.cc_boot_fits_dict[freq].update({stokes: files})
@@ -490,21 +527,39 @@ class MFObservations(object):
             self.cc_boot_cs_fits_dict.update({freq: dict()})
             uv_fits_paths = self.uvfits_boot_dict[freq]
             for stokes in self.stokes:
+                jobs = list()
+                # Keys of CLEANed replications to put in cache
+                cached = list()
                 for i, uv_fits_path in enumerate(uv_fits_paths):
                     uv_dir, uv_fname = os.path.split(uv_fits_path)
                     outfname = 'cs_boot_{}_{}_cc_{}.fits'.format(freq, stokes,
                                                               str(i + 1).zfill(3))
+                    outpath = os.path.join(self.data_dir, outfname)
                     # Check if it is already done
-                    if not os.path.exists(os.path.join(self.data_dir,
-                                                       outfname)):
-                        clean_difmap(uv_fname, outfname, stokes,
-                                     self.common_imsize, path=uv_dir,
-                                     path_to_script=self.path_to_script,
-                                     beam_restore=self.common_beam,
-                                     outpath=self.data_dir,
-                                     command_file=self._difmap_commands_file)
-                    else:
+                    if self.result_cache is not None:
+                        key = clean_difmap_key(self.result_cache, uv_fname,
+                                               stokes, self.common_imsize,
+                                               path=uv_dir,
+                                               path_to_script=self.path_to_script,
+                                               beam_restore=self.common_beam)
+                        if self.result_cache.get(key, outpath) is not None:
+                            print("Found CLEAN model of {} in"
+                                  " cache".format(outfname))
+                            continue
+                        cached.append((key, outpath))
+                    elif os.path.exists(outpath):
                         print("Found CLEAN model in file {}".format(outfname))
+                        continue
+                    jobs.append(clean_difmap_commands(uv_fname, outfname,
+                                                      stokes,
+                                                      self.common_imsize,
+                                                      path=uv_dir,
+                                                      path_to_script=self.path_to_script,
+                                                      beam_restore=self.common_beam,
+                                                      outpath=self.data_dir))
+                self.difmap_runner.map(jobs)
+                for key, outpath in cached:
+                    self.result_cache.put(key, outpath)
                 files = sorted(glob.glob(os.path.join(self.data_dir,
                                                       'cs_boot_{}_{}_cc_*.fits'.format(freq, stokes))))
                 self.cc_boot_cs_fits_dict[freq].update({stokes: files})
@@ -28,18 +28,48 @@ class Beam(object):
 
     # FIXME: This code almost repeat ``Image.convolve``! Beam wants to inherit
     # from ``BasicImage``!
-    def convolve(self, image):
+    def convolve(self, image, threshold=None):
         """
         Convolve ``Image`` array with image-like instance or 2D array-like.
 
         :param image:
             Instance of ``BasicImage`` or 2D array-like.
+        :param threshold: (optional)
+            Fraction of beam peak below which beam is considered to be zero.
+            Beam image is cropped to the central box that contains all pixels
+            above this level before convolution. If ``None`` then use the
+            whole beam image. (default: ``None``)
         """
         try:
             to_convolve = image.image
         except AttributeError:
             to_convolve = np.atleast_2d(image)
-        return signal.fftconvolve(to_convolve, self.image, mode='same')
+        return signal.fftconvolve(to_convolve, self.support(threshold),
+                                  mode='same')
+
+    def support(self, threshold=None):
+        """
+        Returns central part of beam image that contains all pixels with
+        absolute values above ``threshold`` of peak value. Cropping is
+        symmetric around the center of beam image so convolution with returned
+        array in ``same`` mode is aligned with convolution with the whole beam
+        image.
+
+        :param threshold: (optional)
+            Fraction of peak value. If ``None`` then return the whole beam
+            image. (default: ``None``)
+        """
+        if threshold is None:
+            return self.image
+        beam = np.abs(self.image)
+        rows, cols = np.nonzero(beam > threshold * beam.max())
+        slices = list()
+        for size, indxs in zip(self.image.shape, (rows, cols)):
+            center = size // 2
+            half = max(center - indxs.min(), indxs.max() - center) + 1
+            half = min(half, center)
+            slices.append(slice(center - half, center + half + size % 2))
+        return self.image[slices[0], slices[1]]
 
 
 class DirtyBeam(Beam):
@@ -1,18 +1,26 @@
 import os
 import copy
 import glob
+import pickle
+import hashlib
+import itertools
+import multiprocessing
 import numpy as np
-from gains import Absorber
+from gains import Absorber, baseline_gains
 import corner
 from utils import (fit_2d_gmm, vcomplex, nested_ddict, make_ellipses,
                    baselines_2_ants, find_outliers_2d_mincov,
-                   find_outliers_2d_dbscan, find_outliers_dbscan, fit_kde,
-                   fit_2d_kde, hdi_of_mcmc)
+                   find_outliers_2d_dbscan, find_outliers_dbscan,
+                   find_outliers_grouped, fit_kde, GaussianKDE,
+                   plugin_bandwidths, silverman_bandwidths,
+                   fit_2d_kde, hdi_of_mcmc, hdi_of_samples)
 import matplotlib
 from uv_data import UVData
 from model import Model
-from spydiff import import_difmap_model, modelfit_difmap
+from spydiff import (import_difmap_model, import_difmap_models,
+                     modelfit_difmap)
 from spydiff import modelfit_difmap
+from chains import _atomic_save
 matplotlib.use('Agg')
 label_size = 12
 matplotlib.rcParams['xtick.labelsize'] = label_size
@@ -75,20 +83,20 @@ def analyze_bootstrap_samples(dfm_model_fname, booted_mdl_paths,
             raise Exception
         comps_params0[i].extend(list(params))
 
-    # Load bootstrap models
-    comps_params = {i: [] for i in range(len(comps_orig))}
-    for booted_mdl_path in booted_mdl_paths:
-        path, booted_mdl_file = os.path.split(booted_mdl_path)
-        comps = import_difmap_model(booted_mdl_file, path)
-        for i, comp in enumerate(comps):
-            # FIXME: Move (x, y) <-> (r, theta) mapping to ``Component``
-            if coordinates == 'xy':
-                params = comp.p
-            elif coordinates == 'rtheta':
-                params = xy_2_rtheta(comp.p)
-            else:
-                raise Exception
-            comps_params[i].extend(list(params))
+    # Load bootstrap models as one (#boot, #comps, #params) table
+    booted_params, _, _ = import_difmap_models(booted_mdl_paths)
+    comps_params = dict()
+    for i, comp in enumerate(comps_orig):
+        # (#boot, #free parameters)
+        params = booted_params[:, i, :len(comp._parnames)][:, ~comp._fixed]
+        # FIXME: Move (x, y) <-> (r, theta) mapping to ``Component``
+        if coordinates == 'xy':
+            pass
+        elif coordinates == 'rtheta':
+            params = np.array(xy_2_rtheta(params.T)).T
+        else:
+            raise Exception
+        comps_params[i] = list(params.ravel())
 
     comps_to_plot = [comps_orig[k] for k in plot_comps]
     # (#boot, #parameters)
@@ -195,6 +203,68 @@ def analyze_bootstrap_samples(dfm_model_fname, booted_mdl_paths,
     return fig
 
 
+def replica_random_state(seed, i):
+    """
+    Returns instance of ``np.random.RandomState`` for ``i``-th bootstrap
+    replica. It depends only on ``seed`` & ``i``, so replicas are the same
+    however they are split between processes or machines.
+
+    :param seed:
+        Integer seed of the whole bootstrap run.
+    :param i:
+        Index of replica.
+    """
+    # ``SeedSequence`` is available for numpy >= 1.17. Its child with
+    # ``spawn_key=(i,)`` is the ``i``-th result of ``SeedSequence.spawn``
+    if hasattr(np.random, 'SeedSequence'):
+        seed_seq = np.random.SeedSequence(seed, spawn_key=(i,))
+        return np.random.RandomState(np.random.MT19937(seed_seq))
+    return np.random.RandomState([seed, i])
+
+
+def _get_seed(seed):
+    if seed is None:
+        seed = np.random.randint(0, 2 ** 31 - 1)
+        print "Using seed {} for bootstrap replicas".format(seed)
+    return seed
+
+
+def _find_outliers_dbscan(data_pw):
+    outliers_re = find_outliers_dbscan(data_pw.real, 1., 5)
+    outliers_im = find_outliers_dbscan(data_pw.imag, 1., 5)
+    outliers_1d = np.logical_or(outliers_re, outliers_im)
+    outliers_2d = find_outliers_2d_dbscan(data_pw, 1.5, 5)
+    return np.logical_or(outliers_1d, outliers_2d)
+
+
+def _iter_fits(fits):
+    """
+    Iterate over fits in nested dictionary with keys - baseline, #IF, #Stokes.
+    """
+    for baseline_fits in fits.values():
+        for if_fits in baseline_fits.values():
+            for fit in if_fits.values():
+                if not isinstance(fit, dict):
+                    yield fit
+
+
+def _get_nested(ddict, key):
+    for key_ in key:
+        ddict = ddict[key_]
+    return ddict
+
+
+# Bootstrap instance inherited by worker processes of ``Bootstrap.run``
+_bootstrap = None
+
+
+def _resample_replica(args):
+    i, seed, outname, kwargs = args
+    _bootstrap.resample(outname=outname,
+                        random_state=replica_random_state(seed, i), **kwargs)
+    return outname
+
+
 # TODO: Check that numbering of bootstrapped data and their models is OK
 def bootstrap_uvfits_with_difmap_model(uv_fits_path, dfm_model_path,
                                        nonparametric=False, use_kde=True,
@@ -205,26 +275,55 @@ def bootstrap_uvfits_with_difmap_model(uv_fits_path, dfm_model_path,
                                        out_plot_file='plot.png',
                                        pairs=False, niter=100,
                                        bootstrapped_uv_fits=None,
-                                       additional_noise=None):
+                                       additional_noise=None, ci_tol=None,
+                                       batch_size=50):
+    """
+    :param n_boot: (optional)
+        Number of replicas. Maximal number of replicas if ``ci_tol`` is not
+        ``None``. (default: ``100``)
+    :param ci_tol: (optional)
+        If not ``None`` then use ``SequentialBootstrap`` that stops when HDIs
+        of parameters of components change less than ``ci_tol`` of their
+        widths after batch of ``batch_size`` replicas. (default: ``None``)
+    """
     dfm_model_dir, dfm_model_fname = os.path.split(dfm_model_path)
     comps = import_difmap_model(dfm_model_fname, dfm_model_dir)
     if boot_dir is None:
         boot_dir = os.getcwd()
+
+    def modelfit(bootstrapped_fits, j):
+        modelfit_difmap(bootstrapped_fits, dfm_model_fname,
+                        'mdl_booted_{}.mdl'.format(j),
+                        path=boot_dir, mdl_path=dfm_model_dir,
+                        out_path=boot_dir, niter=niter)
+        booted_comps = import_difmap_model('mdl_booted_{}.mdl'.format(j),
+                                           boot_dir)
+        return np.hstack([comp.p for comp in booted_comps])
+
     if bootstrapped_uv_fits is None:
         uvdata = UVData(uv_fits_path)
         model = Model(stokes=stokes)
         model.add_components(*comps)
         boot = CleanBootstrap([model], uvdata, additional_noise=additional_noise)
         os.chdir(boot_dir)
-        boot.run(nonparametric=nonparametric, use_kde=use_kde, recenter=recenter,
-                 use_v=use_v, n=n_boot, pairs=pairs)
-        bootstrapped_uv_fits = sorted(glob.glob(os.path.join(boot_dir,
-                                                             'bootstrapped_data*.fits')))
-    for j, bootstrapped_fits in enumerate(bootstrapped_uv_fits):
-        modelfit_difmap(bootstrapped_fits, dfm_model_fname,
-                        'mdl_booted_{}.mdl'.format(j),
-                        path=boot_dir, mdl_path=dfm_model_dir,
-                        out_path=boot_dir, niter=niter)
+        if ci_tol is not None:
+            sequential = SequentialBootstrap(boot, modelfit,
+                                             batch_size=batch_size,
+                                             min_n=min(2 * batch_size, n_boot),
+                                             max_n=n_boot, tol=ci_tol)
+            sequential.run(nonparametric=nonparametric, use_kde=use_kde,
+                           recenter=recenter, use_v=use_v, pairs=pairs)
+            bootstrapped_uv_fits = sequential.fnames
+        else:
+            boot.run(nonparametric=nonparametric, use_kde=use_kde,
+                     recenter=recenter, use_v=use_v, n=n_boot, pairs=pairs)
+            bootstrapped_uv_fits = sorted(glob.glob(os.path.join(boot_dir,
+                                                                 'bootstrapped_data*.fits')))
+            for j, bootstrapped_fits in enumerate(bootstrapped_uv_fits):
+                modelfit(bootstrapped_fits, j)
+    else:
+        for j, bootstrapped_fits in enumerate(bootstrapped_uv_fits):
+            modelfit(bootstrapped_fits, j)
     booted_mdl_paths = glob.glob(os.path.join(boot_dir, 'mdl_booted*'))
     fig = analyze_bootstrap_samples(dfm_model_fname, booted_mdl_paths, dfm_model_dir,
                                     plot_comps=range(len(comps)),
@@ -281,6 +380,73 @@ class Bootstrap(object):
         # Dictionary with keys - baseline, #scan, #IF, #Stokes and value -
         # boolean numpy array with outliers
         self._residuals_outliers_scans = nested_ddict()
+        # Dictionary with keys - tuples (``pairs``, ``recenter``) and values -
+        # indexes used to resample all baselines/IFs/Stokes at once
+        self._resampling_pools = dict()
+
+    # Attributes with fitted noise model of residuals that are cached
+    _noise_model_attrs = ('_residuals_outliers', '_residuals_centers',
+                          '_residuals_fits', 'noise_residuals')
+
+    def noise_model_key(self, **kwargs):
+        """
+        Returns hash that identifies fitted noise model of residuals. It
+        depends on class of bootstrap (that defines residuals), data &
+        residuals visibilities and options of fitting.
+
+        :param kwargs:
+            Options of fitting (arguments of ``_prepare_resampling``).
+        """
+        sha = hashlib.sha1()
+        sha.update(self.__class__.__name__)
+        for array in (self.data.uvdata, self.residuals.uvdata,
+                      self.residuals.weights):
+            sha.update(np.ascontiguousarray(array).tostring())
+        sha.update(repr(sorted(kwargs.items())))
+        return sha.hexdigest()
+
+    def _noise_model_fname(self, cache_dir, **kwargs):
+        return os.path.join(cache_dir, "noise_model_{}.pkl".format(
+            self.noise_model_key(**kwargs)))
+
+    def save_noise_model(self, cache_dir, **kwargs):
+        """
+        Save fitted noise model of residuals (outliers, centers, KDE fits &
+        noise std) to file in ``cache_dir`` named by ``noise_model_key``.
+
+        :param kwargs:
+            Options of fitting (arguments of ``_prepare_resampling``).
+        :return:
+            Path to saved file.
+        """
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        fname = self._noise_model_fname(cache_dir, **kwargs)
+        state = {attr: getattr(self, attr) for attr in self._noise_model_attrs}
+        _atomic_save(fname, lambda fo: pickle.dump(state, fo,
+                                                   pickle.HIGHEST_PROTOCOL))
+        return fname
+
+    def load_noise_model(self, cache_dir, **kwargs):
+        """
+        Load noise model of residuals saved by ``save_noise_model`` for the
+        same bootstrap class, data, model & options of fitting.
+
+        :param kwargs:
+            Options of fitting (arguments of ``_prepare_resampling``).
+        :return:
+            Boolean - was noise model found?
+        """
+        fname = self._noise_model_fname(cache_dir, **kwargs)
+        if not os.path.exists(fname):
+            return False
+        with open(fname, 'rb') as fo:
+            state = pickle.load(fo)
+        for attr, value in state.items():
+            setattr(self, attr, value)
+        self._resampling_pools = dict()
+        print "Loaded noise model of residuals from {}".format(fname)
+        return True
 
     def get_residuals(self):
         """
@@ -500,78 +666,88 @@ class Bootstrap(object):
                                 bbox_inches='tight', dpi=400)
                             matplotlib.pyplot.close()
 
-    def find_outliers_in_residuals(self, split_scans=False):
+    def _residuals_groups(self, split_scans):
         """
-        Method that search outliers in residuals
-
-        :param split_scans:
-            Boolean. Find outliers on each scan separately?
+        Returns list of keys (baseline[, #scan], #IF, #Stokes) and list of
+        complex numpy arrays with residuals of positive weight for each
+        baseline[/scan]/IF/Stokes with not all zero data.
         """
-        print "Searching for outliers in residuals..."
+        keys = list()
+        groups_data = list()
         for baseline in self.residuals.baselines:
-            indxs = self.residuals._indxs_baselines[baseline]
-            baseline_data = self.residuals.uvdata[indxs]
-            # If searching outliers in baseline data
             if not split_scans:
-                for if_ in range(baseline_data.shape[1]):
-                    for stokes in range(baseline_data.shape[2]):
-                        # Complex array with visibilities for given baseline,
-                        # #IF, Stokes
-                        data = baseline_data[:, if_, stokes]
-                        # weigths = self.residuals.weights[indxs, if_, stokes]
-
-                        # Use only valid data with positive weight
-                        data_pw = data[self.residuals._pw_indxs[indxs, if_, stokes]]
-                        data_nw = data[self.residuals._nw_indxs[indxs, if_, stokes]]
-                        print "NW {}".format(np.count_nonzero(data_nw))
-
-                        # If data are zeros
-                        if not np.any(data_pw):
-                            continue
-
-                        print "Baseline {}, IF {}, Stokes {}".format(baseline,
-                                                                     if_,
-                                                                     stokes)
-                        outliers_re = find_outliers_dbscan(data_pw.real, 1., 5)
-                        outliers_im = find_outliers_dbscan(data_pw.imag, 1., 5)
-                        outliers_1d = np.logical_or(outliers_re, outliers_im)
-                        outliers_2d = find_outliers_2d_dbscan(data_pw, 1.5, 5)
-                        self._residuals_outliers[baseline][if_][stokes] =\
-                            np.logical_or(outliers_1d, outliers_2d)
-
-            # If searching outliers on each scan
+                indxs = self.residuals._indxs_baselines[baseline]
+                chunks = [((baseline,), indxs)]
             else:
-                # Searching each scan on current baseline
                 # FIXME: Use zero centers for shitty scans?
                 if self.residuals.scans_bl[baseline] is None:
                     continue
-                for i, scan_indxs in enumerate(self.residuals.scans_bl[baseline]):
-                    scan_uvdata = self.residuals.uvdata[scan_indxs]
-                    for if_ in range(scan_uvdata.shape[1]):
-                        for stokes in range(scan_uvdata.shape[2]):
-                            # Complex array with visibilities for given
-                            # baseline, #scan, #IF, Stokes
-                            data = scan_uvdata[:, if_, stokes]
-                            # weigths = self.residuals.weights[scan_indxs, if_,
-                            #                                  stokes]
-
-                            # Use only valid data with positive weight
-                            data_pw = data[self.residuals._pw_indxs[scan_indxs, if_, stokes]]
-                            data_nw = data[self.residuals._nw_indxs[scan_indxs, if_, stokes]]
-                            print "NW {}".format(np.count_nonzero(data_nw))
+                chunks = [((baseline, i), scan_indxs) for i, scan_indxs in
+                          enumerate(self.residuals.scans_bl[baseline])]
+            for key, indxs in chunks:
+                uvdata = self.residuals.uvdata[indxs]
+                for if_ in range(uvdata.shape[1]):
+                    for stokes in range(uvdata.shape[2]):
+                        # Use only valid data with positive weight
+                        data_pw = uvdata[:, if_, stokes][self.residuals._pw_indxs[indxs, if_, stokes]]
+                        # If data are zeros
+                        if not np.any(data_pw):
+                            continue
+                        keys.append(key + (if_, stokes))
+                        groups_data.append(data_pw)
+        return keys, groups_data
 
-                            # If data are zeros
-                            if not np.any(data_pw):
-                                continue
+    def find_outliers_in_residuals(self, split_scans=False, method='dbscan',
+                                   n_jobs=1, threshold=5.):
+        """
+        Method that search outliers in residuals
 
-                            print "Baseline {}, scan {}, IF {}," \
-                                  " Stokes {}".format(baseline, i, if_, stokes)
-                            outliers_re = find_outliers_dbscan(data_pw.real, 1., 5)
-                            outliers_im = find_outliers_dbscan(data_pw.imag, 1., 5)
-                            outliers_1d = np.logical_or(outliers_re, outliers_im)
-                            outliers_2d = find_outliers_2d_dbscan(data_pw, 1.5, 5)
-                            self._residuals_outliers_scans[baseline][i][if_][stokes] = \
-                                np.logical_or(outliers_1d, outliers_2d)
+        :param split_scans:
+            Boolean. Find outliers on each scan separately?
+        :param method: (optional)
+            ``dbscan`` - use DBSCAN clustering of Re, Im & both for each
+            baseline[/scan]/IF/Stokes. ``mad`` or ``mahalanobis`` - use robust
+            statistics calculated for all groups at once (see
+            ``utils.find_outliers_grouped``). (default: ``dbscan``)
+        :param n_jobs: (optional)
+            Number of processes for ``dbscan`` method. (default: ``1``)
+        :param threshold: (optional)
+            Threshold in units of robust std for ``mad`` & ``mahalanobis``
+            methods. (default: ``5``)
+        """
+        print "Searching for outliers in residuals..."
+        self._resampling_pools = dict()
+        keys, groups_data = self._residuals_groups(split_scans)
+        if not keys:
+            return
+        if method == 'dbscan':
+            if n_jobs > 1:
+                pool = multiprocessing.Pool(n_jobs)
+                try:
+                    outliers = pool.map(_find_outliers_dbscan, groups_data)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                outliers = map(_find_outliers_dbscan, groups_data)
+        else:
+            sizes = [len(data) for data in groups_data]
+            groups = np.repeat(np.arange(len(sizes)), sizes)
+            outliers = find_outliers_grouped(np.hstack(groups_data), groups,
+                                             method=method,
+                                             threshold=threshold)
+            outliers = np.split(outliers, np.cumsum(sizes)[:-1])
+        for key, outliers_ in zip(keys, outliers):
+            if not split_scans:
+                baseline, if_, stokes = key
+                self._residuals_outliers[baseline][if_][stokes] = outliers_
+            else:
+                baseline, i, if_, stokes = key
+                self._residuals_outliers_scans[baseline][i][if_][stokes] =\
+                    outliers_
+        print "Found {} outliers in {} groups".format(
+            sum(np.count_nonzero(outliers_) for outliers_ in outliers),
+            len(keys))
 
     # TODO: Use only data without outliers
     def find_residuals_centers(self, split_scans):
@@ -579,6 +755,8 @@ class Bootstrap(object):
         Calculate centers of residuals for each baseline[/scan]/IF/stokes.
         """
         print "Finding centers"
+        self._resampling_pools = dict()
+        n_groups = 0
         for baseline in self.residuals.baselines:
             # Find centers for baselines only
             if not split_scans:
@@ -598,13 +776,11 @@ class Bootstrap(object):
                         if not np.any(data_pw):
                             continue
 
-                        print "Baseline {}, IF {}, Stokes {}".format(baseline, if_,
-                                                                     stokes)
                         outliers = self._residuals_outliers[baseline][if_][stokes]
                         x_c = np.sum(data_pw.real[~outliers]) / np.count_nonzero(~outliers)
                         y_c = np.sum(data_pw.imag[~outliers]) / np.count_nonzero(~outliers)
-                        print "Center: ({:.4f}, {:.4f})".format(x_c, y_c)
                         self._residuals_centers[baseline][if_][stokes] = (x_c, y_c)
+                        n_groups += 1
             # Find residuals centers on each scan
             else:
                 # Searching each scan on current baseline
@@ -627,13 +803,12 @@ class Bootstrap(object):
                             if not np.any(data_pw):
                                 continue
 
-                            print "Baseline {}, #scan {}, IF {}," \
-                                  " Stokes {}".format(baseline, i, if_, stokes)
                             outliers = self._residuals_outliers_scans[baseline][i][if_][stokes]
                             x_c = np.sum(data_pw.real[~outliers]) / np.count_nonzero(~outliers)
                             y_c = np.sum(data_pw.imag[~outliers]) / np.count_nonzero(~outliers)
-                            print "Center: ({:.4f}, {:.4f})".format(x_c, y_c)
                             self._residuals_centers_scans[baseline][i][if_][stokes] = (x_c, y_c)
+                            n_groups += 1
+        print "Found centers of residuals in {} groups".format(n_groups)
 
     # FIXME: Use real Stokes parameters as keys.
     def fit_residuals_gmm(self):
@@ -666,7 +841,8 @@ class Bootstrap(object):
                     self._residuals_fits[baseline][if_][stokes] = clf
 
     # FIXME: Use real Stokes parameters as keys.
-    def fit_residuals_kde(self, split_scans, combine_scans, recenter):
+    def fit_residuals_kde(self, split_scans, combine_scans, recenter,
+                          bandwidth='plugin'):
         """
         Fit residuals with Gaussian Kernel Density.
 
@@ -676,6 +852,14 @@ class Bootstrap(object):
             Boolean. Combine re-centered scans on each baseline before fit?
         :param recenter:
             Boolean. Recenter residuals before fit?
+        :param bandwidth: (optional)
+            Method of bandwidth selection. ``plugin`` - direct plug-in
+            bandwidth (``utils.plugin_bandwidths``), ``silverman`` - rule of
+            thumb (``utils.silverman_bandwidths``). Both are calculated for
+            all baselines[/scans]/IFs/Stokes at once and give
+            ``utils.GaussianKDE`` instances. ``cv`` - 5-fold CV search for each
+            baseline[/scan]/IF/Stokes (``utils.fit_kde``). (default:
+            ``plugin``)
 
         :note:
             At each baseline/scan residuals are fitted with Kernel Density
@@ -685,6 +869,10 @@ class Bootstrap(object):
         if combine_scans:
             raise NotImplementedError
 
+        if bandwidth != 'cv':
+            self._fit_residuals_kde_grouped(split_scans, recenter, bandwidth)
+            return
+
         for baseline in self.residuals.baselines:
             # If fitting baseline data
             if not split_scans:
@@ -753,6 +941,45 @@ class Bootstrap(object):
                                 continue
                             self._residuals_fits_scans[baseline][i][if_][stokes] = (clf_re, clf_im)
 
+    def _fit_residuals_kde_grouped(self, split_scans, recenter, bandwidth):
+        if bandwidth == 'plugin':
+            get_bandwidths = plugin_bandwidths
+        elif bandwidth == 'silverman':
+            get_bandwidths = silverman_bandwidths
+        else:
+            raise Exception("Bandwidth could be plugin, silverman or cv!")
+        if not split_scans:
+            outliers, centers, fits = (self._residuals_outliers,
+                                       self._residuals_centers,
+                                       self._residuals_fits)
+        else:
+            outliers, centers, fits = (self._residuals_outliers_scans,
+                                       self._residuals_centers_scans,
+                                       self._residuals_fits_scans)
+        keys, groups_data = self._residuals_groups(split_scans)
+        for j, key in enumerate(keys):
+            # Don't count outliers
+            data_pw = groups_data[j][~_get_nested(outliers, key)]
+            if recenter:
+                x_c, y_c = _get_nested(centers, key)
+                data_pw = data_pw - (x_c + 1j * y_c)
+            groups_data[j] = data_pw
+        if not keys:
+            return
+        sizes = [len(data) for data in groups_data]
+        groups = np.repeat(np.arange(len(sizes)), sizes)
+        data = np.hstack(groups_data)
+        bandwidths_re = get_bandwidths(data.real, groups)
+        bandwidths_im = get_bandwidths(data.imag, groups)
+        for j, key in enumerate(keys):
+            # This occurs when group has 1 point only
+            if not (np.isfinite(bandwidths_re[j]) and
+                    np.isfinite(bandwidths_im[j])):
+                continue
+            fit = (GaussianKDE(groups_data[j].real, bandwidths_re[j]),
+                   GaussianKDE(groups_data[j].imag, bandwidths_im[j]))
+            _get_nested(fits, key[:-1])[key[-1]] = fit
+
     # # FIXME: Use real Stokes parameters as keys.
     # def fit_residuals_kde_2d(self, split_scans, combine_scans, recenter):
     #     """
@@ -1023,119 +1250,246 @@ class Bootstrap(object):
                         bbox_inches='tight', dpi=400)
             matplotlib.pyplot.close()
 
-    def resample(self, outname, nonparametric, split_scans, recenter, use_kde,
-                 use_v, combine_scans):
+    def replica(self, nonparametric, split_scans, recenter, use_kde, use_v,
+                combine_scans=False, pairs=False, whole_scans=False,
+                random_state=None, copy_of_model_data=None):
         """
         Sample from residuals with replacement or sample from normal random
-        noise fitted to residuals and add samples to model to form n bootstrap
-        samples of data.
+        noise fitted to residuals and add samples to model to form one
+        bootstrap sample of data.
 
-        :param outname:
-            Output file name to save bootstrapped data.
         :param nonparametric (optional):
             If ``True`` then use actual residuals between model and data. If
             ``False`` then use gaussian noise fitted to actual residuals for
             parametric bootstrapping. (default: ``False``)
+        :param split_scans:
+            Resample residuals within scans of baselines (see
+            ``UVData.scan_index``) to keep time-correlated noise?
+        :param whole_scans: (optional)
+            Resample whole scans of baselines (block bootstrap) instead of
+            residuals within scans. Used only for nonparametric bootstrap with
+            ``split_scans=True``. (default: ``False``)
+        :param random_state: (optional)
+            Instance of ``np.random.RandomState`` used for resampling. If
+            ``None`` then use global state. (default: ``None``)
+        :param copy_of_model_data: (optional)
+            Instance of ``UVData`` (e.g. previous replica) to reuse instead of
+            copying model data. Its visibilities are overwritten. If ``None``
+            then use new copy. (default: ``None``)
         :return:
-            Just save bootstrapped data to file with specified ``outname``.
+            Instance of ``UVData`` with bootstrapped data.
         """
         raise NotImplementedError
 
-    # FIXME: Implement arbitrary output directory for bootstrapped data
-    def run(self, n, nonparametric, split_scans, recenter, use_kde, use_v,
-            combine_scans, outname=['bootstrapped_data', '.FITS'],
-            pairs=False):
+    def resample(self, outname, nonparametric, split_scans, recenter, use_kde,
+                 use_v, combine_scans=False, pairs=False, whole_scans=False,
+                 random_state=None):
         """
-        Generate ``n`` data sets.
-
-        :note:
-            Several steps are made before re-sampling ``n`` times:
-
-            * First, outliers are found for each baseline or even scan (using
-            DBSCAN clustering algorithm).
-            * Centers of the residuals for each baselines or optionally
-            scans (when ``split_scans=True``) are found excluding outliers.
-            * In parametric bootstrap (when ``nonparameteric=False``) noise
-            density estimates for each baseline/scan are maid using
-            ``sklearn.neighbors.KernelDensity`` fits to Re & Im re-centered
-            visibility data with gaussian kernel and bandwidth optimized by
-            ``sklearn.grid_search.GridSearchCV`` with 5-fold CV.
-            This is when ``use_kde=True``. Otherwise residuals are supposed to
-            be distributed with gaussian density and it's std is estimated
-            directly.
-
-            Then, in parametric bootstrap re-sampling is maid by adding samples
-            from fitted KDE (for ``use_kde=True``) or zero-mean Gaussian
-            distribution with std of the residuals to model visibility data
-            ``n`` times. In non-parametric case re-sampling is maid by sampling
-            with replacement from re-centered residuals (with outliers
-            excluded).
+        Make one bootstrap sample of data using ``replica`` and save it.
 
+        :param outname:
+            Output file name to save bootstrapped data.
+        :return:
+            Just save bootstrapped data to file with specified ``outname``.
         """
-        # Find outliers in baseline/scan data
-        if not split_scans:
-            if not self._residuals_outliers:
-                print "Finding outliers in baseline's data..."
-                self.find_outliers_in_residuals(split_scans=False)
-            else:
-                print "Already found outliers in baseline's data..."
+        replica = self.replica(nonparametric, split_scans, recenter, use_kde,
+                               use_v, combine_scans=combine_scans, pairs=pairs,
+                               whole_scans=whole_scans,
+                               random_state=random_state)
+        self.model_data.save(data=replica.hdu.data, fname=outname)
+
+    def _prepare_resampling(self, nonparametric, split_scans, recenter,
+                            use_kde, use_v, combine_scans, pairs,
+                            whole_scans=False):
+        """
+        Find outliers & centers of residuals and fit their density before
+        resampling. Outliers & centers are found on each baseline also for
+        ``split_scans=True``. Then noise of scans is estimated from inliers of
+        each scan during resampling.
+        """
+        if whole_scans and not (nonparametric and split_scans):
+            raise Exception("Resampling of whole scans is implemented only for"
+                            " nonparametric bootstrap with split_scans=True!")
+
+        # Find outliers in baseline data
+        if not self._residuals_outliers:
+            print "Finding outliers in baseline's data..."
+            self.find_outliers_in_residuals(split_scans=False)
         else:
-            if not self._residuals_centers_scans:
-                print "Finding outliers in scan's data..."
-                self.find_outliers_in_residuals(split_scans=True)
-            else:
-                print "Already found outliers in scan's data..."
+            print "Already found outliers in baseline's data..."
 
         # Find residuals centers
-        if recenter:
-            self.find_residuals_centers(split_scans=split_scans)
+        if recenter and not self._residuals_centers:
+            self.find_residuals_centers(split_scans=False)
 
-        if not pairs:
+        if not pairs and not split_scans:
             # Fit residuals for parametric case
             if not nonparametric:
                 # Using KDE estimate of residuals density
                 if use_kde:
                     print "Using parametric bootstrap"
-                    if not split_scans and not self._residuals_fits:
+                    if not self._residuals_fits:
                         print "Fitting residuals with KDE for each" \
                               " baseline/IF/Stokes..."
-                        self.fit_residuals_kde(split_scans=split_scans,
+                        self.fit_residuals_kde(split_scans=False,
                                                combine_scans=combine_scans,
                                                recenter=recenter)
-                    if split_scans and not self._residuals_fits_scans:
-                        print "Fitting residuals with KDE for each" \
-                              " baseline/scan/IF/Stokes..."
-                        self.fit_residuals_kde(split_scans=split_scans,
-                                               combine_scans=combine_scans,
-                                               recenter=recenter)
-                    if not split_scans and self._residuals_fits:
+                    else:
                         print "Residuals were already fitted with KDE on each" \
                               " baseline/IF/Stokes"
-                    if split_scans and self._residuals_fits_scans:
-                        print "Residuals were already fitted with KDE on each" \
-                              " baseline/scan/IF/Stokes"
                 # Use parametric gaussian estimate of residuals density
                 else:
                     # FIXME: This is needed only for cycle after!!!
-                    self.fit_residuals_kde(split_scans=split_scans,
-                                           combine_scans=combine_scans,
-                                           recenter=recenter)
+                    if not self._residuals_fits:
+                        self.fit_residuals_kde(split_scans=False,
+                                               combine_scans=combine_scans,
+                                               recenter=recenter)
                     print "only for cycle"
                     if not self.noise_residuals:
-                        print "Estimating gaussian STDs on each baseline[/scan]..."
-                        self.noise_residuals = self.get_residuals_noise(split_scans,
+                        print "Estimating gaussian STDs on each baseline..."
+                        self.noise_residuals = self.get_residuals_noise(False,
                                                                         use_v)
                     else:
-                        print "Gaussian STDs for each baseline[/scan] are already" \
+                        print "Gaussian STDs for each baseline are already" \
                               " estimated"
 
+    def _prepare_resampling_cached(self, cache_dir, **kwargs):
+        if cache_dir is not None:
+            self.load_noise_model(cache_dir, **kwargs)
+        self._prepare_resampling(**kwargs)
+        if cache_dir is not None:
+            self.save_noise_model(cache_dir, **kwargs)
+
+    def _iter_replicas(self, n, seed, start, arrays, kwargs):
+        copy_of_model_data = None
+        for i in range(start, start + n):
+            replica = self.replica(random_state=replica_random_state(seed, i),
+                                   copy_of_model_data=copy_of_model_data,
+                                   **kwargs)
+            if arrays:
+                # The same ``UVData`` instance is reused for the next replica
+                copy_of_model_data = replica
+                yield replica.uvdata.copy()
+            else:
+                yield replica
+
+    def iter_replicas(self, n, nonparametric, split_scans=False,
+                      recenter=True, use_kde=True, use_v=True,
+                      combine_scans=False, pairs=False, whole_scans=False,
+                      seed=None, start=0, arrays=False, cache_dir=None):
+        """
+        Generator of ``n`` bootstrap replicas of data kept in memory. Replicas
+        are the same as saved to files by ``run`` with the same arguments.
+
+        :param seed: (optional)
+            Integer seed of the run. See ``run``. (default: ``None``)
+        :param start: (optional)
+            Index of the first replica. See ``run``. (default: ``0``)
+        :param arrays: (optional)
+            Yield numpy arrays of visibilities with shape (#, #IF, #Stokes)
+            instead of ``UVData`` instances. Then only one copy of ``UVData``
+            is made for all replicas. (default: ``False``)
+        :param cache_dir: (optional)
+            Directory with cached noise models. See ``run``. (default:
+            ``None``)
+        :return:
+            Generator of ``UVData`` instances or numpy arrays.
+        """
+        kwargs = {'nonparametric': nonparametric, 'split_scans': split_scans,
+                  'recenter': recenter, 'use_kde': use_kde, 'use_v': use_v,
+                  'combine_scans': combine_scans, 'pairs': pairs,
+                  'whole_scans': whole_scans}
+        self._prepare_resampling_cached(cache_dir, **kwargs)
+        seed = _get_seed(seed)
+        return self._iter_replicas(n, seed, start, arrays, kwargs)
+
+    # FIXME: Implement arbitrary output directory for bootstrapped data
+    def run(self, n, nonparametric, split_scans, recenter, use_kde, use_v,
+            combine_scans, outname=['bootstrapped_data', '.FITS'],
+            pairs=False, whole_scans=False, seed=None, start=0, n_jobs=1,
+            cache_dir=None):
+        """
+        Generate ``n`` data sets.
+
+        :param whole_scans: (optional)
+            Resample whole scans of baselines instead of residuals within
+            scans for nonparametric bootstrap with ``split_scans=True``.
+            (default: ``False``)
+        :param seed: (optional)
+            Integer seed of the run. Replica ``i`` is resampled with
+            ``replica_random_state(seed, i)``, so it doesn't depend on
+            ``n_jobs`` & ``start``. If ``None`` then it is chosen randomly and
+            printed. (default: ``None``)
+        :param start: (optional)
+            Index of the first replica. Use it to split large run between
+            machines, e.g. ``n=500, start=0`` & ``n=500, start=500`` with the
+            same ``seed`` give the same replicas as ``n=1000``. Replicas are
+            numbered by their indexes in the output file names. (default:
+            ``0``)
+        :param n_jobs: (optional)
+            Number of processes to use. (default: ``1``)
+        :param cache_dir: (optional)
+            Directory to keep fitted noise models of residuals. If it has
+            noise model for the same data & model then fitting steps that it
+            covers are skipped. Updated noise model is saved there. If
+            ``None`` then don't cache. (default: ``None``)
+
+        :note:
+            Several steps are made before re-sampling ``n`` times:
+
+            * First, outliers are found for each baseline (using DBSCAN
+            clustering algorithm).
+            * Centers of the residuals for each baselines are found excluding
+            outliers.
+            * In parametric bootstrap (when ``nonparameteric=False``) noise
+            density estimates for each baseline/scan are maid using
+            ``sklearn.neighbors.KernelDensity`` fits to Re & Im re-centered
+            visibility data with gaussian kernel and bandwidth optimized by
+            ``sklearn.grid_search.GridSearchCV`` with 5-fold CV.
+            This is when ``use_kde=True``. Otherwise residuals are supposed to
+            be distributed with gaussian density and it's std is estimated
+            directly.
+
+            Then, in parametric bootstrap re-sampling is maid by adding samples
+            from fitted KDE (for ``use_kde=True``) or zero-mean Gaussian
+            distribution with std of the residuals to model visibility data
+            ``n`` times. In non-parametric case re-sampling is maid by sampling
+            with replacement from re-centered residuals (with outliers
+            excluded). With ``split_scans=True`` residuals are resampled
+            within scans of ``UVData.scan_index`` (or whole scans are resampled
+            for ``whole_scans=True``) and parametric noise uses KDE bandwidths
+            or stds of each scan.
+
+        """
+        kwargs = {'nonparametric': nonparametric, 'split_scans': split_scans,
+                  'recenter': recenter, 'use_kde': use_kde, 'use_v': use_v,
+                  'combine_scans': combine_scans, 'pairs': pairs,
+                  'whole_scans': whole_scans}
+        self._prepare_resampling_cached(cache_dir, **kwargs)
+        seed = _get_seed(seed)
+        outnames = [outname[0] + '_' + str(i + 1).zfill(3) + outname[1] for i
+                    in range(start, start + n)]
+
         # Resampling is done in subclasses
-        for i in range(n):
-            outname_ = outname[0] + '_' + str(i + 1).zfill(3) + outname[1]
-            self.resample(outname=outname_, nonparametric=nonparametric,
-                          split_scans=split_scans, recenter=recenter,
-                          use_kde=use_kde, use_v=use_v,
-                          combine_scans=combine_scans, pairs=pairs)
+        if n_jobs > 1:
+            global _bootstrap
+            _bootstrap = self
+            # Workers are forked after ``_bootstrap`` is set and inherit
+            # fitted residuals
+            pool = multiprocessing.Pool(n_jobs)
+            try:
+                pool.map(_resample_replica,
+                         [(i, seed, outname_, kwargs) for i, outname_ in
+                          zip(range(start, start + n), outnames)])
+            finally:
+                pool.close()
+                pool.join()
+                _bootstrap = None
+        else:
+            # Files are just a sink for replicas generated in memory
+            replicas = self._iter_replicas(n, seed, start, False, kwargs)
+            for outname_, replica in itertools.izip(outnames, replicas):
+                self.model_data.save(data=replica.hdu.data, fname=outname_)
 
 
 class CleanBootstrap(Bootstrap):
@@ -1161,98 +1515,351 @@ class CleanBootstrap(Bootstrap):
     def get_residuals(self):
         return self.data - self.model_data
 
-    def resample_baseline_pairs(self, baseline, copy_of_model_data):
-        # Boolean array that defines indexes of current baseline data
-        baseline_indxs = self.data._indxs_baselines[baseline]
-        # FIXME: Here iterate over keys with not None values
-        for if_ in range(self.data.nif):
-            for stokes in range(self.data.nstokes):
-                baseline_indxs_ = baseline_indxs.copy()
-                # Boolean array that defines indexes of outliers in indexes of
-                # current baseline data
-                outliers = self._residuals_outliers[baseline][if_][stokes]
-                pw_indxs = self.data._pw_indxs[baseline_indxs, if_, stokes]
-                # If some Stokes parameter has no outliers calculation - pass it
-                if isinstance(outliers, dict):
-                    continue
-                # Baseline indexes of inliers
-                indxs = np.where(baseline_indxs_)[0][pw_indxs][~outliers]
-                # If for some combinations baseline/IF/Stokes no data to
-                # resample - pass it
-                if not indxs.size:
-                    continue
-                # Resample them
-                indxs_ = np.random.choice(indxs,
-                                          np.count_nonzero(baseline_indxs))
-                # Add to residuals.substitute(model)
-                copy_of_model_data.uvdata[baseline_indxs, if_, stokes] = \
-                    self.data.uvdata[indxs_, if_, stokes]
-
-                copy_of_model_data.sync()
-
-    def resample_baseline_nonparametric(self, baseline, copy_of_model_data,
-                                        recenter):
-        # Boolean array that defines indexes of current baseline data
-        baseline_indxs = self.residuals._indxs_baselines[baseline]
-        # FIXME: Here iterate over keys with not None values
-        for if_ in range(self.residuals.nif):
-            for stokes in range(self.residuals.nstokes):
-                baseline_indxs_ = baseline_indxs.copy()
-                # Boolean array that defines indexes of outliers in indexes of
-                # current baseline data
-                outliers = self._residuals_outliers[baseline][if_][stokes]
-                pw_indxs = self.residuals._pw_indxs[baseline_indxs, if_, stokes]
-                # If some Stokes parameter has no outliers calculation - pass it
-                if isinstance(outliers, dict):
-                    continue
-                # Baseline indexes of inliers
-                indxs = np.where(baseline_indxs_)[0][pw_indxs][~outliers]
-                # If for some combinations baseline/IF/Stokes no data to
-                # resample - pass it
-                if not indxs.size:
-                    continue
-                # Resample them
-                indxs_ = np.random.choice(indxs,
-                                          np.count_nonzero(baseline_indxs))
-
-                # Add to residuals.substitute(model)
-                copy_of_model_data.uvdata[baseline_indxs, if_, stokes] = \
-                    copy_of_model_data.uvdata[baseline_indxs, if_, stokes] + \
-                    self.residuals.uvdata[indxs_, if_, stokes]
-                if recenter:
-                    x_c, y_c = self._residuals_centers[baseline][if_][stokes]
-                    copy_of_model_data.uvdata[baseline_indxs, if_, stokes] -=\
-                        x_c + 1j*y_c
-
-                copy_of_model_data.sync()
-
-    def resample_baseline_nonparametric_splitting_scans(self, baseline,
-                                                        copy_of_model_data,
-                                                        recenter):
-        # Find indexes of data from current baseline
-        scan_indxs = self.residuals._indxs_baselines_scans[baseline]
-        for i, scan_indx in enumerate(scan_indxs):
-            for if_ in range(self.residuals.nif):
-                for stokes in range(self.residuals.nstokes):
-                    outliers = self._residuals_outliers_scans[baseline][i][if_][stokes]
-                    pw_indxs = self.residuals._pw_indxs[scan_indx, if_, stokes]
-                    # Find what int indexes corresponds to `inliers`
-                    indxs = np.where(scan_indx)[0][pw_indxs][~outliers]
-                    # Resample them
-                    indxs_ = np.random.choice(indxs, np.count_nonzero(scan_indx))
-
-                    # Add to residuals.substitute(model)
-                    copy_of_model_data.uvdata[scan_indx, if_, stokes] = \
-                        copy_of_model_data.uvdata[scan_indx, if_, stokes] + \
-                        self.residuals.uvdata[indxs_, if_, stokes]
-                    if recenter:
-                        x_c, y_c = self._residuals_centers_scans[baseline][i][if_][stokes]
-                        copy_of_model_data.uvdata[scan_indx, if_, stokes] -= \
-                            x_c + 1j*y_c
-            copy_of_model_data.sync()
+    def replica_model(self, random_state=np.random):
+        """
+        Returns model visibilities of bootstrap replica to add resampled
+        residuals to.
+        """
+        return self.model_data.uvdata.copy()
+
+    def _get_resampling_pool(self, pairs, recenter):
+        """
+        Returns indexes used to resample residuals (or data for ``pairs=True``)
+        of all baselines, IFs & Stokes at once. They are found once for each
+        combination of ``pairs`` & ``recenter``.
+
+        :return:
+            Tuple of numpy arrays: rows, IFs & Stokes of resampled data points,
+            index of group (baseline/IF/Stokes) of each point, rows of inliers
+            of all groups concatenated, offsets & sizes of groups in that
+            array, complex centers of groups (or ``None`` if not
+            ``recenter``) and list of keys (baseline, #IF, #Stokes) of groups.
+        """
+        key = (pairs, recenter)
+        if key in self._resampling_pools:
+            return self._resampling_pools[key]
+        source = self.data if pairs else self.residuals
+        keys = list()
+        rows, ifs, stokes, groups = list(), list(), list(), list()
+        pool, sizes, centers = list(), list(), list()
+        for baseline in source.baselines:
+            baseline_indxs = source._indxs_baselines[baseline]
+            baseline_rows = np.where(baseline_indxs)[0]
+            for if_ in range(source.nif):
+                for stokes_ in range(source.nstokes):
+                    outliers = self._residuals_outliers[baseline][if_][stokes_]
+                    # If some Stokes parameter has no outliers calculation -
+                    # pass it
+                    if isinstance(outliers, dict):
+                        continue
+                    pw_indxs = source._pw_indxs[baseline_indxs, if_, stokes_]
+                    # Rows of inliers
+                    indxs = baseline_rows[pw_indxs][~outliers]
+                    # If for some combinations baseline/IF/Stokes no data to
+                    # resample - pass it
+                    if not indxs.size:
+                        continue
+                    n = len(baseline_rows)
+                    keys.append((baseline, if_, stokes_))
+                    rows.append(baseline_rows)
+                    ifs.append(np.repeat(if_, n))
+                    stokes.append(np.repeat(stokes_, n))
+                    groups.append(np.repeat(len(sizes), n))
+                    pool.append(indxs)
+                    sizes.append(indxs.size)
+                    if recenter and not pairs:
+                        center = self._residuals_centers[baseline][if_][stokes_]
+                        if isinstance(center, dict):
+                            center = (0., 0.)
+                        centers.append(center[0] + 1j * center[1])
+        sizes = np.array(sizes, dtype=int)
+        offsets = np.cumsum(sizes) - sizes
+        result = (np.hstack(rows), np.hstack(ifs), np.hstack(stokes),
+                  np.hstack(groups), np.hstack(pool), offsets, sizes,
+                  np.array(centers) if recenter and not pairs else None, keys)
+        self._resampling_pools[key] = result
+        return result
+
+    def resample_residuals(self, copy_of_model_data, pairs=False,
+                           recenter=True, random_state=np.random):
+        """
+        Nonparametric resampling of residuals (or of data for ``pairs=True``)
+        with replacement on each baseline/IF/Stokes. Indexes of all data
+        points are drawn with one call of RNG and ``copy_of_model_data`` is
+        synced once.
+
+        :param copy_of_model_data:
+            Instance of ``UVData`` with model visibilities to add resampled
+            residuals to.
+        :param pairs: (optional)
+            Replace data points with resampled data instead of adding
+            resampled residuals. (default: ``False``)
+        :param recenter: (optional)
+            Subtract centers of residuals of each baseline/IF/Stokes? Ignored
+            for ``pairs=True``. (default: ``True``)
+        :param random_state: (optional)
+            Instance of ``np.random.RandomState``. (default: ``np.random``)
+        """
+        rows, ifs, stokes, groups, pool, offsets, sizes, centers, _ =\
+            self._get_resampling_pool(pairs, recenter)
+        draws = (random_state.random_sample(len(rows)) *
+                 sizes[groups]).astype(int)
+        resampled_rows = pool[offsets[groups] + draws]
+        if pairs:
+            copy_of_model_data.uvdata[rows, ifs, stokes] =\
+                self.data.uvdata[resampled_rows, ifs, stokes]
+        else:
+            to_add = self.residuals.uvdata[resampled_rows, ifs, stokes]
+            if centers is not None:
+                to_add -= centers[groups]
+            copy_of_model_data.uvdata[rows, ifs, stokes] += to_add
+        copy_of_model_data.sync()
+
+    def resample_residuals_kde(self, copy_of_model_data, recenter=True,
+                               random_state=np.random):
+        """
+        Parametric resampling of residuals from fitted
+        ``utils.GaussianKDE`` densities of Re & Im on each baseline/IF/Stokes.
+        Samples of all data points are drawn at once as resampled residuals
+        plus gaussian noise with bandwidth of the group.
+
+        :param copy_of_model_data:
+            Instance of ``UVData`` with model visibilities to add resampled
+            residuals to.
+        :param recenter: (optional)
+            Were residuals re-centered before fitting? (default: ``True``)
+        :param random_state: (optional)
+            Instance of ``np.random.RandomState``. (default: ``np.random``)
+        """
+        rows, ifs, stokes, groups, pool, offsets, sizes, centers, keys =\
+            self._get_resampling_pool(False, recenter)
+        # Bandwidths of Re & Im for each group. Groups without fit are only
+        # resampled.
+        bandwidths = np.zeros((len(keys), 2))
+        for j, key in enumerate(keys):
+            fit = _get_nested(self._residuals_fits, key)
+            if not isinstance(fit, dict):
+                bandwidths[j] = fit[0].bandwidth, fit[1].bandwidth
+        n = len(rows)
+        draws = (random_state.random_sample((2, n)) *
+                 sizes[groups]).astype(int)
+        noise = random_state.normal(size=(2, n)) * bandwidths[groups].T
+        resampled_rows = pool[offsets[groups] + draws]
+        to_add = (self.residuals.uvdata[resampled_rows[0], ifs, stokes].real +
+                  noise[0]) +\
+            1j * (self.residuals.uvdata[resampled_rows[1], ifs, stokes].imag +
+                  noise[1])
+        if centers is not None:
+            to_add -= centers[groups]
+        copy_of_model_data.uvdata[rows, ifs, stokes] += to_add
+        copy_of_model_data.sync()
+
+    def _get_scan_resampling_pool(self, recenter):
+        """
+        Returns indexes used to resample residuals within scans of all
+        baselines, IFs & Stokes at once. Blocks are baseline/scan/IF/Stokes
+        with scans of ``UVData.scan_index``. Data points of blocks with less
+        than 2 inliers are resampled from inliers of the whole
+        baseline/IF/Stokes.
+
+        :return:
+            Tuple of numpy arrays: rows, IFs & Stokes of resampled data points,
+            index of group (baseline/IF/Stokes) & block of each point, rows of
+            inliers of all blocks concatenated, offsets & sizes of blocks in
+            that array, groups of blocks and complex centers of groups (or
+            ``None`` if not ``recenter``).
+        """
+        key = ('scans', recenter)
+        if key in self._resampling_pools:
+            return self._resampling_pools[key]
+        rows, ifs, stokes, groups, pool, offsets, sizes, centers, _ =\
+            self._get_resampling_pool(False, recenter)
+        scan_index = self.residuals.scan_index
+        n_scans = scan_index.max() + 1
+        # Inliers sorted by labels of their (group, scan) blocks
+        pool_labels = np.repeat(np.arange(len(sizes)), sizes) * n_scans +\
+            scan_index[pool]
+        order = np.argsort(pool_labels, kind='mergesort')
+        labels, block_sizes = np.unique(pool_labels, return_counts=True)
+
+        point_labels = groups * n_scans + scan_index[rows]
+        blocks = np.searchsorted(labels, point_labels)
+        found = labels[np.minimum(blocks, len(labels) - 1)] == point_labels
+        found[found] = block_sizes[blocks[found]] > 1
+        # Blocks of the whole baselines follow blocks of scans
+        blocks[~found] = len(labels) + groups[~found]
+
+        block_pool = np.hstack((pool[order], pool))
+        block_sizes = np.hstack((block_sizes, sizes))
+        block_offsets = np.cumsum(block_sizes) - block_sizes
+        block_groups = np.hstack((labels // n_scans, np.arange(len(sizes))))
+        result = (rows, ifs, stokes, groups, blocks, block_pool, block_offsets,
+                  block_sizes, block_groups, centers)
+        self._resampling_pools[key] = result
+        return result
+
+    def _get_scan_blocks(self):
+        """
+        Returns arrays used to resample whole scans of baselines: rows of
+        scans ordered by time, position of each row in its scan, sizes &
+        offsets of scans in rows, first scan & number of scans of baseline
+        of each scan and boolean mask of inliers with shape of ``uvdata``.
+        """
+        key = 'scan_blocks'
+        if key in self._resampling_pools:
+            return self._resampling_pools[key]
+        scan_index = self.residuals.scan_index
+        times = self.residuals.hdu.data['DATE'] +\
+            self.residuals.hdu.data['_DATE']
+        order = np.lexsort((times, scan_index))
+        scan_sizes = np.bincount(scan_index)
+        scan_offsets = np.cumsum(scan_sizes) - scan_sizes
+        positions = np.empty(len(order), dtype=int)
+        positions[order] = np.arange(len(order)) -\
+            scan_offsets[scan_index[order]]
+        # Scans of each baseline have successive numbers
+        scan_baselines = self.residuals.hdu.data['BASELINE'][order[scan_offsets]]
+        first_scans = np.searchsorted(scan_baselines, scan_baselines)
+        n_baseline_scans = np.searchsorted(scan_baselines, scan_baselines,
+                                           side='right') - first_scans
+
+        _, _, _, _, pool, _, sizes, _, keys = self._get_resampling_pool(False,
+                                                                         False)
+        pool_groups = np.repeat(np.arange(len(sizes)), sizes)
+        keys = np.array([key_[1:] for key_ in keys], dtype=int).reshape(-1, 2)
+        inliers = np.zeros(self.residuals.uvdata.shape, dtype=bool)
+        inliers[pool, keys[pool_groups, 0], keys[pool_groups, 1]] = True
+        result = (order, positions, scan_sizes, scan_offsets, first_scans,
+                  n_baseline_scans, inliers)
+        self._resampling_pools[key] = result
+        return result
+
+    def resample_residuals_scans(self, copy_of_model_data, recenter=True,
+                                 whole_scans=False, random_state=np.random):
+        """
+        Nonparametric resampling of residuals within scans (see
+        ``UVData.scan_index``) of all baselines, IFs & Stokes at once.
+
+        :param copy_of_model_data:
+            Instance of ``UVData`` with model visibilities to add resampled
+            residuals to.
+        :param recenter: (optional)
+            Subtract centers of residuals of each baseline/IF/Stokes?
+            (default: ``True``)
+        :param whole_scans: (optional)
+            Block bootstrap of scans. Each scan is replaced by scan of the
+            same baseline drawn with replacement. It is cycled from random
+            position to the length of the replaced scan, so time correlation
+            of residuals (also between IFs & Stokes) is kept. Outliers are
+            replaced by residuals resampled within scan. If ``False`` then
+            resample residuals within each scan. (default: ``False``)
+        :param random_state: (optional)
+            Instance of ``np.random.RandomState``. (default: ``np.random``)
+        """
+        rows, ifs, stokes, groups, blocks, pool, offsets, sizes, _, centers =\
+            self._get_scan_resampling_pool(recenter)
+        draws = (random_state.random_sample(len(rows)) *
+                 sizes[blocks]).astype(int)
+        resampled_rows = pool[offsets[blocks] + draws]
+        if whole_scans:
+            order, positions, scan_sizes, scan_offsets, first_scans,\
+                n_baseline_scans, inliers = self._get_scan_blocks()
+            n = len(scan_sizes)
+            sources = first_scans + (random_state.random_sample(n) *
+                                     n_baseline_scans).astype(int)
+            shifts = (random_state.random_sample(n) *
+                      scan_sizes[sources]).astype(int)
+            scans = sources[self.residuals.scan_index]
+            source_rows = order[scan_offsets[scans] +
+                                (shifts[self.residuals.scan_index] +
+                                 positions) % scan_sizes[scans]]
+            block_rows = source_rows[rows]
+            use_block = inliers[block_rows, ifs, stokes]
+            resampled_rows[use_block] = block_rows[use_block]
+        to_add = self.residuals.uvdata[resampled_rows, ifs, stokes]
+        if centers is not None:
+            to_add -= centers[groups]
+        copy_of_model_data.uvdata[rows, ifs, stokes] += to_add
+        copy_of_model_data.sync()
+
+    def _get_scan_noise(self, recenter, use_kde):
+        """
+        Returns means & stds (``use_kde=False``) or KDE bandwidths of Re & Im
+        (``use_kde=True``) of inliers of each block of
+        ``_get_scan_resampling_pool``.
+        """
+        key = ('scan_noise', recenter, use_kde)
+        if key in self._resampling_pools:
+            return self._resampling_pools[key]
+        _, _, _, _, _, pool, _, sizes, block_groups, _ =\
+            self._get_scan_resampling_pool(recenter)
+        _, _, _, _, _, _, _, _, keys = self._get_resampling_pool(False, False)
+        keys = np.array([key_[1:] for key_ in keys], dtype=int).reshape(-1, 2)
+        pool_blocks = np.repeat(np.arange(len(sizes)), sizes)
+        pool_keys = keys[block_groups[pool_blocks]]
+        values = self.residuals.uvdata[pool, pool_keys[:, 0], pool_keys[:, 1]]
+        if use_kde:
+            result = np.nan_to_num(np.vstack((
+                silverman_bandwidths(values.real, pool_blocks),
+                silverman_bandwidths(values.imag, pool_blocks))))
+        else:
+            n = sizes.astype(float)
+            means = (np.bincount(pool_blocks, values.real) +
+                     1j * np.bincount(pool_blocks, values.imag)) / n
+            # Std of Re & Im
+            var = np.bincount(pool_blocks,
+                              np.abs(values - means[pool_blocks]) ** 2) /\
+                (2. * np.maximum(n - 1., 1.))
+            result = means, np.sqrt(var)
+        self._resampling_pools[key] = result
+        return result
+
+    def resample_residuals_scans_parametric(self, copy_of_model_data,
+                                            recenter=True, use_kde=True,
+                                            random_state=np.random):
+        """
+        Parametric resampling of residuals within scans (see
+        ``UVData.scan_index``) of all baselines, IFs & Stokes at once. Noise
+        of each baseline/scan/IF/Stokes is estimated from its inliers.
+
+        :param copy_of_model_data:
+            Instance of ``UVData`` with model visibilities to add resampled
+            residuals to.
+        :param recenter: (optional)
+            Subtract centers of residuals of each baseline/IF/Stokes?
+            (default: ``True``)
+        :param use_kde: (optional)
+            Sample from gaussian KDE of Re & Im of each scan with Silverman's
+            bandwidth (``utils.silverman_bandwidths``). If ``False`` then
+            sample from gaussian with mean & std of each scan. (default:
+            ``True``)
+        :param random_state: (optional)
+            Instance of ``np.random.RandomState``. (default: ``np.random``)
+        """
+        rows, ifs, stokes, groups, blocks, pool, offsets, sizes, _, centers =\
+            self._get_scan_resampling_pool(recenter)
+        n = len(rows)
+        noise = random_state.normal(size=(2, n))
+        if use_kde:
+            bandwidths = self._get_scan_noise(recenter, use_kde)
+            draws = (random_state.random_sample((2, n)) *
+                     sizes[blocks]).astype(int)
+            resampled_rows = pool[offsets[blocks] + draws]
+            to_add = (self.residuals.uvdata[resampled_rows[0], ifs, stokes].real +
+                      noise[0] * bandwidths[0, blocks]) +\
+                1j * (self.residuals.uvdata[resampled_rows[1], ifs, stokes].imag +
+                      noise[1] * bandwidths[1, blocks])
+        else:
+            means, stds = self._get_scan_noise(recenter, use_kde)
+            to_add = means[blocks] + stds[blocks] * (noise[0] + 1j * noise[1])
+        if centers is not None:
+            to_add -= centers[groups]
+        copy_of_model_data.uvdata[rows, ifs, stokes] += to_add
+        copy_of_model_data.sync()
 
     def resample_baseline_parametric(self, baseline, copy_of_model_data,
-                                     recenter, use_kde):
+                                     recenter, use_kde,
+                                     random_state=np.random):
         indxs = self.residuals._indxs_baselines[baseline]
         shape = self.residuals._shapes_baselines[baseline]
         to_add = np.zeros(shape, complex)
@@ -1265,7 +1872,7 @@ class CleanBootstrap(Bootstrap):
 
                     # FIXME: For zero scans std - use IF's averages!
                     try:
-                        sample = np.random.normal(loc=0., scale=std,
+                        sample = random_state.normal(loc=0., scale=std,
                                                   size=2 * len(to_add))
                     except ValueError:
                         continue
@@ -1285,8 +1892,10 @@ class CleanBootstrap(Bootstrap):
                                       sample[len(to_add):])
                 else:
                     kde_re, kde_im = self._residuals_fits[baseline][if_][stokes]
-                    sample_re = kde_re.sample(len(to_add))
-                    sample_im = kde_im.sample(len(to_add))
+                    sample_re = kde_re.sample(len(to_add),
+                                              random_state=random_state)
+                    sample_im = kde_im.sample(len(to_add),
+                                              random_state=random_state)
                     sample = sample_re[:, 0] + 1j * sample_im[:, 0]
 
                 to_add[:, if_, stokes] = sample
@@ -1295,138 +1904,113 @@ class CleanBootstrap(Bootstrap):
         copy_of_model_data.uvdata[indxs] += to_add
         copy_of_model_data.sync()
 
-    def resample_baseline_parametric_splitting_scans(self, baseline,
-                                                     copy_of_model_data,
-                                                     recenter, use_kde):
-        for baseline in self.residuals.baselines:
-            scan_indxs = self.residuals._indxs_baselines_scans[baseline]
-            # FIXME: Use baseline's noise when scan is shitty!
-            if scan_indxs is None:
-                continue
-            scan_shapes = self.residuals._shapes_baselines_scans[baseline]
-            for i, scan_indx in enumerate(scan_indxs):
-                to_add = np.zeros(scan_shapes[i], complex)
-                for if_ in range(self.residuals.nif):
-                    for stokes in range(self.residuals.nstokes):
-                        if not use_kde:
-                            std = self.noise_residuals[baseline][i, if_, stokes]
-
-                            # FIXME: For zero scans std - use IF's averages!
-                            try:
-                                sample = np.random.normal(loc=0., scale=std,
-                                                          size=2 * len(to_add))
-                            except ValueError:
-                                continue
-                            # Add center coordinates if not re-centering
-                            if not recenter:
-                                # Center residuals
-                                centers = \
-                                    self._residuals_centers_scans[baseline][i][if_][stokes]
-                                # FIXME: Handle shitty scans
-                                try:
-                                    sample[: len(to_add)] += centers[0]
-                                    sample[len(to_add):] += centers[1]
-                                except TypeError:
-                                    pass
-
-                            sample = vcomplex(sample[: len(to_add)],
-                                              sample[len(to_add):])
-                        else:
-                            kde_re, kde_im =\
-                                self._residuals_fits_scans[baseline][i][if_][stokes]
-                            # If no KDE was fitted for some IF/Stokes - pass it
-                            try:
-                                sample_re = kde_re.sample(len(to_add))
-                                sample_im = kde_im.sample(len(to_add))
-                            except AttributeError:
-                                continue
-                            sample = sample_re[:, 0] + 1j * sample_im[:, 0]
-
-                        to_add[:, if_, stokes] = sample
-
-                # Add random variables to data on current scan
-                copy_of_model_data.uvdata[scan_indx] += to_add
-                copy_of_model_data.sync()
-
-    def resample(self, outname, nonparametric, split_scans, recenter,
-                 use_kde, use_v, combine_scans=False, pairs=False):
+    def replica(self, nonparametric, split_scans, recenter, use_kde, use_v,
+                combine_scans=False, pairs=False, whole_scans=False,
+                random_state=None, copy_of_model_data=None):
         """
         Sample from residuals with replacement or sample from normal random
-        noise and adds samples to model to form n bootstrap samples.
-
+        noise and adds samples to model to form one bootstrap sample.
+
+        :param random_state: (optional)
+            Instance of ``np.random.RandomState`` used for resampling. If
+            ``None`` then use global state. (default: ``None``)
+        :param copy_of_model_data: (optional)
+            Instance of ``UVData`` to reuse instead of copying model data. If
+            ``None`` then use new copy. (default: ``None``)
         :return:
-            Just save bootstrapped data to file with specified ``outname``.
+            Instance of ``UVData`` with bootstrapped data.
         """
+        if random_state is None:
+            random_state = np.random
 
         # Model to add resamples
-        copy_of_model_data = copy.deepcopy(self.model_data)
+        if copy_of_model_data is None:
+            copy_of_model_data = copy.deepcopy(self.model_data)
+        copy_of_model_data.uvdata = self.replica_model(random_state)
 
-        # If do resampling for different scans independently
+        # If do resampling for different scans independently. All baselines
+        # at once.
         if split_scans:
             # Do parametric bootstrap
             if not nonparametric:
-                for baseline in self.residuals.baselines:
-                    self.resample_baseline_parametric_splitting_scans(baseline,
-                                                                      copy_of_model_data,
-                                                                      recenter,
-                                                                      use_kde)
+                self.resample_residuals_scans_parametric(copy_of_model_data,
+                                                         recenter=recenter,
+                                                         use_kde=use_kde,
+                                                         random_state=random_state)
             # Do nonparametric bootstrap
             else:
-                # Bootstrap from self.residuals._data. For each baseline.
-                for baseline in self.residuals.baselines:
-                    self.resample_baseline_nonparametric_splitting_scans(baseline,
-                                                                         copy_of_model_data)
+                self.resample_residuals_scans(copy_of_model_data,
+                                              recenter=recenter,
+                                              whole_scans=whole_scans,
+                                              random_state=random_state)
 
         # If do resampling for baselines
         else:
             # If resampling pairs
             if pairs:
-                for baseline in self.residuals.baselines:
-                    self.resample_baseline_pairs(baseline, copy_of_model_data)
+                self.resample_residuals(copy_of_model_data, pairs=True,
+                                        random_state=random_state)
 
             else:
                 # Do parametric bootstrap
                 if not nonparametric:
-                    for baseline in self.residuals.baselines:
-                        self.resample_baseline_parametric(baseline,
-                                                          copy_of_model_data,
-                                                          recenter, use_kde)
+                    # All densities were fitted with grouped bandwidths
+                    if use_kde and self._residuals_fits and all(
+                            isinstance(fit[0], GaussianKDE) for fit in
+                            _iter_fits(self._residuals_fits)):
+                        self.resample_residuals_kde(copy_of_model_data,
+                                                    recenter=recenter,
+                                                    random_state=random_state)
+                    else:
+                        for baseline in self.residuals.baselines:
+                            self.resample_baseline_parametric(baseline,
+                                                              copy_of_model_data,
+                                                              recenter,
+                                                              use_kde,
+                                                              random_state)
                 # Do nonparametric bootstrap
                 else:
-                    # Bootstrap from self.residuals._data. For each baseline.
-                    for baseline in self.residuals.baselines:
-                        self.resample_baseline_nonparametric(baseline,
-                                                             copy_of_model_data,
-                                                             recenter)
+                    # Bootstrap from self.residuals._data. All baselines at
+                    # once.
+                    self.resample_residuals(copy_of_model_data,
+                                            recenter=recenter,
+                                            random_state=random_state)
 
         if self.sigma_ampl_scale is not None:
-            scale_factor = 1. + np.random.normal(0., self.sigma_ampl_scale)
+            scale_factor = 1. + random_state.normal(0., self.sigma_ampl_scale)
             print "Scaling amplitudes on {}".format(scale_factor)
             copy_of_model_data.scale_amplitude(scale_factor)
 
         if self.additional_noise is not None:
             nif = copy_of_model_data.nif
             copy_of_model_data.noise_add({baseline: nif*[self.additional_noise]
-                                          for baseline in copy_of_model_data.baselines})
+                                          for baseline in copy_of_model_data.baselines},
+                                         random_state=random_state)
 
-        self.model_data.save(data=copy_of_model_data.hdu.data, fname=outname)
+        return copy_of_model_data
 
     def run(self, n, nonparametric, split_scans=False, recenter=True,
             use_kde=True, use_v=True, combine_scans=False,
-            outname=['bootstrapped_data', '.fits'], pairs=False):
+            outname=['bootstrapped_data', '.fits'], pairs=False,
+            whole_scans=False, seed=None, start=0, n_jobs=1, cache_dir=None):
         super(CleanBootstrap, self).run(n, nonparametric,
                                         split_scans=split_scans,
                                         recenter=recenter, use_kde=use_kde,
                                         use_v=use_v,
                                         combine_scans=combine_scans,
-                                        outname=outname, pairs=pairs)
+                                        outname=outname, pairs=pairs,
+                                        whole_scans=whole_scans, seed=seed,
+                                        start=start, n_jobs=n_jobs,
+                                        cache_dir=cache_dir)
 
 
-class SelfCalBootstrap(object):
+class SelfCalBootstrap(CleanBootstrap):
     """
     Class that implements bootstrapping of uv-data using model and residuals
     between data and model. Residuals are difference between un-selfcalibrated
-    uv-data and model visibilities multiplied by gains.
+    uv-data and model visibilities multiplied by gains. Bootstrap replicas are
+    model visibilities multiplied by resampled gains plus resampled residuals,
+    so uncertainty of self-calibration is propagated.
 
     :param models:
         Iterable of ``Model`` subclass instances that represent model used for
@@ -1435,7 +2019,7 @@ class SelfCalBootstrap(object):
         using ``Model.__add__``.
 
     :param data:
-        Path to FITS-file with uv-data (self-calibrated or not).
+        Instance of ``UVData`` class with un-selfcalibrated uv-data.
 
     :param calibs:
         Iterable of paths to self-calibration sequence of FITS-files. That is
@@ -1446,28 +2030,274 @@ class SelfCalBootstrap(object):
         Sequence must be in order of self-calibration (longer solution times
         go first).
 
+    :param window: (optional)
+        Number of successive gains solutions of antenna in moving average
+        that is used as smooth gain curve. Deviations of solutions from it are
+        resampled. See ``gains.Gains.resample_gains``. (default: ``5``)
+
     :note:
         data argument is always data that is subject of substraction. So, it
         could be that first element of calibs argument is the same data.
+        Visibilities at times without gains solutions are not multiplied by
+        gains.
     """
-    # TODO: use super
-    def __init__(self, models, data, calibs):
-        self.models = models
-        self.data = data
+    def __init__(self, models, data, calibs, window=5, sigma_ampl_scale=None,
+                 additional_noise=None):
         self.calibs = calibs
         # Last self-calibrated data
-        last_calib = UVData(calibs[-1])
-        self.last_calib = last_calib
+        self.last_calib = UVData(calibs[-1])
+        absorber = Absorber()
+        absorber.absorb(calibs)
+        self.gains = absorber.absorbed_gains
+        self.window = window
+        # Indexes of gains solutions of both antennas of each visibility
+        t = data.hdu.columns[data.par_dict['DATE']].array
+        baselines = np.abs(data.hdu.columns[data.par_dict['BASELINE']].array)
+        ant1 = (baselines // 256).astype(int)
+        ant2 = (baselines - 256 * ant1).astype(int)
+        self._gains_indxs = (self.gains.get_indexes(t, ant1),
+                             self.gains.get_indexes(t, ant2))
+        super(SelfCalBootstrap, self).__init__(models, data,
+                                               sigma_ampl_scale=sigma_ampl_scale,
+                                               additional_noise=additional_noise)
+
+    def baseline_gains(self, gains=None):
+        """
+        Returns gains of correlations of all visibilities.
 
-        model_data = copy.deepcopy(self.data)
-        model_data.substitute(models)
-        self.model_data = model_data
-        self.residuals = self.get_residuals()
+        :param gains: (optional)
+            Complex numpy array with the same shape as ``Gains.gains`` (e.g.
+            result of ``Gains.resample_gains``). If ``None`` then use absorbed
+            gains. (default: ``None``)
+        :return:
+            Complex numpy array with shape of ``UVData.uvdata``.
+        """
+        if gains is None:
+            gains = self.gains.gains
+        antennas_gains = list()
+        for indxs in self._gains_indxs:
+            gains_ = gains[np.maximum(indxs, 0)]
+            gains_[indxs < 0] = 1.
+            antennas_gains.append(gains_)
+        return baseline_gains(antennas_gains[0], antennas_gains[1],
+                              self.data.stokes)
 
     def get_residuals(self):
-        absorber = Absorber()
-        absorber.absorb(self.calibs)
-        return self.data - absorber * self.model_data
+        residuals = copy.deepcopy(self.data)
+        residuals.uvdata = self.data.uvdata -\
+            self.baseline_gains() * self.model_data.uvdata
+        return residuals
+
+    def replica_model(self, random_state=np.random):
+        """
+        Returns model visibilities multiplied by resampled gains.
+        """
+        gains = self.gains.resample_gains(window=self.window,
+                                          random_state=random_state)
+        return self.baseline_gains(gains) * self.model_data.uvdata
+
+    def replica(self, nonparametric, split_scans, recenter, use_kde, use_v,
+                combine_scans=False, pairs=False, whole_scans=False,
+                random_state=None, copy_of_model_data=None):
+        if pairs:
+            raise Exception("Resampling pairs is not implemented for"
+                            " self-calibration bootstrap!")
+        return super(SelfCalBootstrap, self).replica(nonparametric,
+                                                     split_scans, recenter,
+                                                     use_kde, use_v,
+                                                     combine_scans=combine_scans,
+                                                     whole_scans=whole_scans,
+                                                     random_state=random_state,
+                                                     copy_of_model_data=copy_of_model_data)
+
+
+class SequentialBootstrap(object):
+    """
+    Sequential bootstrap. Replicas are generated in batches and statistics
+    of each replica (e.g. parameters of components fitted by difmap or
+    flattened image) are calculated. Intervals of statistics are updated
+    after each batch and replicas are generated until endpoints of intervals
+    are stable, so expensive calculation of statistics is made for minimal
+    number of replicas.
+
+    :param bootstrap:
+        Instance of ``Bootstrap`` subclass (e.g. ``CleanBootstrap``).
+    :param statistic:
+        Callable that takes path to FITS-file with bootstrapped data and index
+        of replica and returns 1D numpy array of statistics.
+    :param batch_size: (optional)
+        Number of replicas in batch. (default: ``50``)
+    :param min_n: (optional)
+        Minimal number of replicas. (default: ``100``)
+    :param max_n: (optional)
+        Maximal number of replicas. (default: ``1000``)
+    :param tol: (optional)
+        Endpoints are stable if they changed after batch less than ``tol``
+        widths of intervals for all statistics. (default: ``0.05``)
+    :param n_stable: (optional)
+        Number of successive batches with stable endpoints before stopping.
+        (default: ``2``)
+    :param cred_mass: (optional)
+        Credible mass of intervals. (default: ``0.68``)
+    :param interval: (optional)
+        ``hdi`` - highest density intervals (``utils.hdi_of_samples``) of
+        statistics of all replicas kept in memory. ``std`` - mean -/+ std
+        updated from running sums (for large number of statistics, e.g.
+        pixels of images) with ``cred_mass`` ignored. (default: ``hdi``)
+    """
+    def __init__(self, bootstrap, statistic, batch_size=50, min_n=100,
+                 max_n=1000, tol=0.05, n_stable=2, cred_mass=0.68,
+                 interval='hdi'):
+        if interval not in ('hdi', 'std'):
+            raise Exception("interval should be ``hdi`` or ``std``!")
+        self.bootstrap = bootstrap
+        self.statistic = statistic
+        self.batch_size = batch_size
+        self.min_n = min_n
+        self.max_n = max_n
+        self.tol = tol
+        self.n_stable = n_stable
+        self.cred_mass = cred_mass
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.fnames = list()
+        self._samples = list()
+        # Running means & sums of squared deviations (Welford)
+        self._mean = None
+        self._m2 = None
+        self._endpoints = None
+        self._n_stable = 0
+        self.converged = False
+        self.history = list()
+
+    def update(self, values):
+        """
+        Add statistics of one replica.
+
+        :param values:
+            1D numpy array.
+        """
+        values = np.asarray(values, dtype=float)
+        self.n += 1
+        if self.interval == 'hdi':
+            self._samples.append(values)
+        if self._mean is None:
+            self._mean = np.zeros(values.shape)
+            self._m2 = np.zeros(values.shape)
+        delta = values - self._mean
+        self._mean += delta / self.n
+        self._m2 += delta * (values - self._mean)
+
+    @property
+    def samples(self):
+        """
+        Numpy array of statistics with shape (#replicas, #statistics) for
+        ``interval='hdi'``.
+        """
+        return np.array(self._samples)
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def std(self):
+        return np.sqrt(self._m2 / (self.n - 1))
+
+    def endpoints(self):
+        """
+        Returns numpy arrays of lower & upper endpoints of intervals.
+        """
+        if self.interval == 'hdi':
+            return hdi_of_samples(self.samples, cred_mass=self.cred_mass)
+        std = self.std
+        return self._mean - std, self._mean + std
+
+    def check(self):
+        """
+        Check stability of endpoints with current replicas. Updates
+        ``converged`` and ``history``.
+
+        :return:
+            Boolean - are endpoints stable?
+        """
+        low, high = self.endpoints()
+        change = np.inf
+        if self._endpoints is not None:
+            width = high - low
+            width[width <= 0] = np.finfo(float).tiny
+            change = np.max(np.maximum(np.abs(low - self._endpoints[0]),
+                                       np.abs(high - self._endpoints[1])) /
+                            width)
+        self._endpoints = low, high
+        if change < self.tol:
+            self._n_stable += 1
+        else:
+            self._n_stable = 0
+        self.converged = self.n >= self.min_n and\
+            self._n_stable >= self.n_stable
+        self.history.append({'n': self.n, 'change': change, 'low': low,
+                             'high': high})
+        return self.converged
+
+    def run(self, nonparametric, split_scans=False, recenter=True,
+            use_kde=True, use_v=True, combine_scans=False, pairs=False,
+            whole_scans=False, outname=['bootstrapped_data', '.fits'],
+            seed=None, n_jobs=1, cache_dir=None, keep_files=True):
+        """
+        Generate replicas in batches with ``Bootstrap.run`` and calculate
+        their statistics until endpoints of intervals are stable or
+        ``max_n`` replicas are made.
+
+        :param seed: (optional)
+            Integer seed of the run. Replicas are the same as made by
+            ``Bootstrap.run`` with the same seed. If ``None`` then it is
+            chosen randomly and printed. (default: ``None``)
+        :param n_jobs: (optional)
+            Number of processes used to generate replicas of batch. (default:
+            ``1``)
+        :param keep_files: (optional)
+            Keep FITS-files with replicas after calculation of their
+            statistics? (default: ``True``)
+
+        Other arguments are passed to ``Bootstrap.run``.
+
+        :return:
+            Lower & upper endpoints of intervals.
+        """
+        seed = _get_seed(seed)
+        while self.n < self.max_n:
+            start = self.n
+            n = min(self.batch_size, self.max_n - start)
+            self.bootstrap.run(n, nonparametric, split_scans, recenter,
+                               use_kde, use_v, combine_scans, outname=outname,
+                               pairs=pairs, whole_scans=whole_scans, seed=seed,
+                               start=start, n_jobs=n_jobs, cache_dir=cache_dir)
+            for i in range(start, start + n):
+                fname = outname[0] + '_' + str(i + 1).zfill(3) + outname[1]
+                self.update(self.statistic(fname, i))
+                if keep_files:
+                    self.fnames.append(fname)
+                else:
+                    os.unlink(fname)
+            if self.check():
+                break
+        self.report()
+        return self._endpoints
+
+    def report(self):
+        """
+        Print summary of the run.
+        """
+        print "Replicas : {} of maximum {}, stable : {}".format(self.n,
+                                                               self.max_n,
+                                                               self.converged)
+        if self.history:
+            print "Last change of endpoints (in widths of intervals) :" \
+                  " {}".format(self.history[-1]['change'])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+import os
+import glob
+import pickle
+import numpy as np
+
+
+def _atomic_save(fname, save, mode='wb'):
+    """
+    Write file using temporary file in the same directory and rename it, so
+    killed process never leaves half-written file.
+
+    :param fname:
+        Path to file.
+    :param save:
+        Callable that writes to given file object.
+    """
+    tmp_fname = "{}.{}.tmp".format(fname, os.getpid())
+    try:
+        with open(tmp_fname, mode) as fo:
+            save(fo)
+            fo.flush()
+            os.fsync(fo.fileno())
+        os.rename(tmp_fname, fname)
+    except:
+        if os.path.exists(tmp_fname):
+            os.unlink(tmp_fname)
+        raise
+
+
+class ChainBackend(object):
+    """
+    On-disk store of ``emcee.EnsembleSampler`` chains. Samples and ln of
+    probabilities are appended as chunk files every ``checkpoint_every`` steps
+    together with the state (positions, ln of probabilities & state of RNG) of
+    the last step, so interrupted run could be resumed exactly from the last
+    checkpoint.
+
+    :param path:
+        Directory to keep chains.
+    :param name: (optional)
+        Name of the chain. Different stages of sampling (e.g. burn-in &
+        production) could be kept in the same directory with different names.
+        (default: ``chain``)
+    :param checkpoint_every: (optional)
+        Number of steps between checkpoints. (default: ``50``)
+    """
+    def __init__(self, path, name='chain', checkpoint_every=50):
+        self.path = path
+        self.name = name
+        self.checkpoint_every = checkpoint_every
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    @property
+    def _state_fname(self):
+        return os.path.join(self.path, "{}_state.pkl".format(self.name))
+
+    def _chunk_fname(self, i):
+        return os.path.join(self.path, "{}_{:05d}.npz".format(self.name, i))
+
+    @property
+    def _chunk_fnames(self):
+        # Chunks written after the last saved state are not valid
+        state = self.load_state()
+        n_chunks = 0 if state is None else state['n_chunks']
+        return [self._chunk_fname(i) for i in range(n_chunks)]
+
+    def load_state(self):
+        """
+        Returns dictionary with state of the last checkpoint (keys ``pos``,
+        ``lnprob``, ``rstate``, ``iteration`` & ``n_chunks``) or ``None`` if
+        there is no checkpoint.
+        """
+        try:
+            with open(self._state_fname, 'rb') as fo:
+                return pickle.load(fo)
+        except IOError:
+            return None
+
+    @property
+    def iteration(self):
+        """
+        Number of steps saved.
+        """
+        state = self.load_state()
+        return 0 if state is None else state['iteration']
+
+    def append(self, chain, lnprob, rstate):
+        """
+        Append chunk of samples and save state of the last step.
+
+        :param chain:
+            Numpy array of positions with shape (#steps, #walkers, #dim).
+        :param lnprob:
+            Numpy array of ln of probabilities with shape (#steps, #walkers).
+        :param rstate:
+            State of sampler's RNG after the last step.
+        """
+        state = self.load_state() or {'iteration': 0, 'n_chunks': 0}
+        chain = np.asarray(chain)
+        lnprob = np.asarray(lnprob)
+        _atomic_save(self._chunk_fname(state['n_chunks']),
+                     lambda fo: np.savez(fo, chain=chain, lnprob=lnprob))
+        state = {'pos': chain[-1], 'lnprob': lnprob[-1], 'rstate': rstate,
+                 'iteration': state['iteration'] + len(chain),
+                 'n_chunks': state['n_chunks'] + 1}
+        _atomic_save(self._state_fname,
+                     lambda fo: pickle.dump(state, fo,
+                                            pickle.HIGHEST_PROTOCOL))
+
+    def _load(self, key):
+        arrays = list()
+        for fname in self._chunk_fnames:
+            with np.load(fname) as npz:
+                arrays.append(npz[key])
+        return arrays
+
+    @property
+    def chain(self):
+        """
+        Numpy array of samples with shape (#walkers, #steps, #dim) as
+        ``emcee.EnsembleSampler.chain``.
+        """
+        chunks = self._load('chain')
+        if not chunks:
+            return None
+        return np.swapaxes(np.concatenate(chunks), 0, 1)
+
+    @property
+    def flatchain(self):
+        """
+        Numpy array of samples with shape (#walkers * #steps, #dim) as
+        ``emcee.EnsembleSampler.flatchain``.
+        """
+        chain = self.chain
+        if chain is None:
+            return None
+        return chain.reshape((-1, chain.shape[-1]))
+
+    @property
+    def lnprobability(self):
+        """
+        Numpy array of ln of probabilities with shape (#walkers, #steps) as
+        ``emcee.EnsembleSampler.lnprobability``.
+        """
+        chunks = self._load('lnprob')
+        if not chunks:
+            return None
+        return np.concatenate(chunks).T
+
+    def reset(self):
+        """
+        Remove all saved samples & state.
+        """
+        fnames = glob.glob(os.path.join(self.path,
+                                        "{}_[0-9]*.npz".format(self.name)))
+        if os.path.exists(self._state_fname):
+            os.unlink(self._state_fname)
+        for fname in fnames:
+            os.unlink(fname)
+
+
+def run_mcmc(sampler, p0, iterations, backend=None, callback=None):
+    """
+    Run ``emcee.EnsembleSampler`` for ``iterations`` steps keeping chain in
+    ``backend``. If ``backend`` already has samples then continue from its last
+    checkpoint (positions, ln of probabilities & RNG state) to reach the total
+    number of ``iterations``.
+
+    :param sampler:
+        Instance of ``emcee.EnsembleSampler``.
+    :param p0:
+        Initial positions of walkers. Ignored if ``backend`` has checkpoint.
+    :param iterations:
+        Total number of steps.
+    :param backend: (optional)
+        Instance of ``ChainBackend``. If ``None`` then samples are kept only by
+        ``sampler``. (default: ``None``)
+    :param callback: (optional)
+        Callable that is called with positions, ln of probabilities and number
+        of steps after each step. If it returns ``True`` then sampling is
+        stopped (after saving checkpoint). (default: ``None``)
+    :return:
+        Positions, ln of probabilities & RNG state after the last step as
+        ``emcee.EnsembleSampler.run_mcmc``.
+    """
+    state = None
+    if backend is not None:
+        state = backend.load_state()
+    if state is None:
+        pos, lnprob, rstate, iteration = p0, None, None, 0
+    else:
+        pos, lnprob, rstate = state['pos'], state['lnprob'], state['rstate']
+        iteration = state['iteration']
+        print "Resuming chain {} from step {}".format(backend.name, iteration)
+
+    chain = list()
+    lnprobs = list()
+    for result in sampler.sample(pos, lnprob0=lnprob, rstate0=rstate,
+                                 iterations=max(iterations - iteration, 0),
+                                 storechain=backend is None):
+        pos, lnprob, rstate = result[:3]
+        iteration += 1
+        stop = False
+        if callback is not None:
+            stop = callback(pos, lnprob, iteration)
+        if backend is not None:
+            chain.append(pos.copy())
+            lnprobs.append(lnprob.copy())
+            if (len(chain) == backend.checkpoint_every or
+                    iteration == iterations or stop):
+                backend.append(chain, lnprobs, rstate)
+                chain = list()
+                lnprobs = list()
+        if stop:
+            break
+    return pos, lnprob, rstate
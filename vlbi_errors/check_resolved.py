@@ -8,23 +8,14 @@ from uv_data import UVData
 from spydiff import import_difmap_model
 from model import Model
 from stats import LnLikelihood
-import nestle
+from nested import (BatchPriorTransform, compare_hypotheses, resample_equal,
+                    share_likelihood)
 from utils import _function_wrapper
 from collections import OrderedDict
-from functools import partial
-
-
-def hypercube_full(u, ppfs):
-    assert len(u) == len(ppfs)
-    return [ppf(u_) for ppf, u_ in zip(ppfs, u)]
-
-
-def hypercube_partial(ppfs):
-    return partial(hypercube_full, ppfs=ppfs)
 
 
 def check_resolved(uv_fits, mdl_dict, components_priors, stokes='I',
-                   outdir=None, **nestle_kwargs):
+                   outdir=None, processes=None, **sampler_kwargs):
     """
     :param uv_fits:
         Path to uv-fits file with self-calibrated visibilities.
@@ -45,29 +36,36 @@ def check_resolved(uv_fits, mdl_dict, components_priors, stokes='I',
         First key will result in calling: scipy.stats.uniform.ppf(u, 0, 10) as
         value from prior for ``flux`` parameter.
     :param outdir: (optional)
-        Directory to output results. If ``None`` then use cwd. (default:
+        Directory to output results & checkpoints of evidence calculation. If
+        ``None`` then use cwd. (default: ``None``)
+    :param processes: (optional)
+        Number of processes to run hypotheses in parallel. If ``None`` then
+        one for each hypothesis but not more than number of cores. (default:
         ``None``)
-    :param nestle_kwargs: (optional)
-        Any arguments passed to ``nestle.sample`` function.
+    :param sampler_kwargs: (optional)
+        Any arguments passed to ``nested.nested_sample`` function.
 
     :return
         Dictionary with keys - model types and values - results of
-        ``nestle.sample`` work on that model.
+        ``nested.nested_sample`` work on that model.
     """
     if outdir is None:
         outdir = os.getcwd()
-
-    evidences = {}
-    result_dict = OrderedDict()
-
+    sampler_kwargs.setdefault('npoints', 50)
+    sampler_kwargs.setdefault('method', 'multi')
+
+    # All hypotheses share one compacted dataset
+    uv_data = UVData(uv_fits)
+    lnlik = None
+    lnliks = OrderedDict()
+    prior_transforms = dict()
+    labels = dict()
     for comp_type in ('pt', 'cg', 'el'):
 
         try:
             mdl_file = mdl_dict[comp_type]
-            print("\nWorking on component type: {}\n".format(comp_type))
         except KeyError:
             continue
-        uv_data = UVData(uv_fits)
         mdl_dir, mdl_fname = os.path.split(mdl_file)
         comps = import_difmap_model(mdl_fname, mdl_dir)
 
@@ -75,43 +73,46 @@ def check_resolved(uv_fits, mdl_dict, components_priors, stokes='I',
         comps = sorted(comps, key=lambda x: np.sqrt(x.p[1]**2 + x.p[2]**2))
 
         ppfs = list()
-        labels = list()
+        labels[comp_type] = list()
         components_prior = components_priors[comp_type]
         for component_prior in components_prior:
             for comp_name in ('flux', 'x', 'y', 'bmaj', 'e', 'bpa'):
                 try:
                     ppfs.append(_function_wrapper(*component_prior[comp_name]))
-                    labels.append(comp_name)
+                    labels[comp_type].append(comp_name)
                 except KeyError:
                     pass
 
-        for ppf in ppfs:
-            print(ppf.args)
-
-        hypercube = hypercube_partial(ppfs)
-
         # Create model
         mdl = Model(stokes=stokes)
         # Add components to model
         mdl.add_components(*comps)
-        loglike = LnLikelihood(uv_data, mdl)
-        time0 = time.time()
-        result = nestle.sample(loglikelihood=loglike, prior_transform=hypercube,
-                               ndim=mdl.size, npoints=50, method='multi',
-                               callback=nestle.print_progress, **nestle_kwargs)
-        print("Time spent : {}".format(time.time()-time0))
-        samples = nestle.resample_equal(result.samples, result.weights)
+        if lnlik is None:
+            lnlik = LnLikelihood(uv_data, mdl)
+        lnliks[comp_type] = share_likelihood(lnlik, mdl)
+        prior_transforms[comp_type] = BatchPriorTransform(ppfs)
+
+    time0 = time.time()
+    result_dict = compare_hypotheses(lnliks, prior_transforms,
+                                     processes=processes, outdir=outdir,
+                                     **sampler_kwargs)
+    print("Time spent : {}".format(time.time()-time0))
+
+    evidences = {}
+    for comp_type in lnliks:
+        result = result_dict[comp_type]
+        samples = resample_equal(result['samples'], result['weights'])
         # Save re-weighted samples from posterior to specified ``outdir``
         # directory
         np.savetxt(os.path.join(outdir, '{}_samples.txt'.format(comp_type)),
                    samples)
-        fig = corner.corner(samples, show_titles=True, labels=labels,
+        fig = corner.corner(samples, show_titles=True,
+                            labels=labels[comp_type],
                             quantiles=[0.16, 0.5, 0.84], title_fmt='.3f')
         # Save corner plot os samples from posterior to specified ``outdir``
         # directory
         fig.savefig(os.path.join(outdir, "{}_corner.png".format(comp_type)),
                     bbox_inches='tight', dpi=200)
-        result_dict[comp_type] = result
         evidences[comp_type] = (result['logz'], result['logzerr'])
 
     with open(os.path.join(outdir, 'logz_logzerr.json'), 'w') as fo:
@@ -11,18 +11,61 @@ except ImportError:
     pylab = None
 
 
-# TODO: Make parnames and size - class attributes
+def add_deltas_to_grid(grid, image, flux, x0, y0):
+    """
+    Add delta-functions to 2D-array with the grid of given image the same way
+    as ``DeltaComponent.add_to_image`` does.
+
+    :param grid:
+        2D numpy array with the same shape as ``image.image``.
+    :param image:
+        Instance of ``Image`` class.
+    :param flux:
+        Numpy array of fluxes [Jy].
+    :param x0:
+        Numpy array of X-coordinates [mas].
+    :param y0:
+        Numpy array of Y-coordinates [mas].
+    """
+    # 2 means that x_c & x_coords should be zero-indexed actually both.
+    x = image.x_c + np.round(x0 * mas_to_rad / image.dx).astype(int) - 2
+    y = image.y_c + np.round(y0 * mas_to_rad / image.dy).astype(int) - 2
+    # [y, x] - to get coincidence with fits clean maps
+    np.add.at(grid, (y, x), flux)
+
+
 class Component(object):
     """
     Basic class that implements single component of model.
+
+    :note:
+        When component is added to ``Model`` instance its ``_p`` and ``_fixed``
+        arrays become views of the model's contiguous arrays of parameters.
+        Component belongs to one model only, ``_model`` keeps weak reference
+        to it.
     """
     _parnames = ['flux', 'x', 'y']
-    size = len(_parnames)
+    __slots__ = ('_p', '_fixed', '_lnprior', 'size', '_model')
 
     def __init__(self):
         self._p = None
         self._fixed = np.array([False, False, False])
         self._lnprior = dict()
+        self.size = len(self._parnames)
+        self._model = None
+
+    def __getstate__(self):
+        # Subclasses without ``__slots__`` keep other attributes in __dict__
+        state = getattr(self, '__dict__', dict()).copy()
+        # Weak reference to model can't be pickled. Unpickled model binds its
+        # components again.
+        state.update({slot: getattr(self, slot) for slot in Component.__slots__
+                      if hasattr(self, slot) and slot != '_model'})
+        return state
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
 
     def __len__(self):
         return len(self._parnames)
@@ -125,6 +168,40 @@ class Component(object):
         """
         raise NotImplementedError("Method must me implemented in subclasses!")
 
+    def ft_batch(self, p, uv):
+        """
+        Method that returns Fourier Transform of component for many sets of
+        parameters in given points of uv-plane. Subclasses implement it
+        vectorized, here component's ``ft`` is called for each set.
+        :param p:
+            2D-numpy array of all (free & fixed) parameters with shape (#sets,
+            #parameters,).
+        :param uv:
+            2D-numpy array of uv-coordinates with shape (#data, 2,)
+        :return:
+            Complex numpy array with shape (#sets, #data,).
+        """
+        p_saved = self._p.copy()
+        result = np.empty((len(p), len(uv)), dtype=complex)
+        try:
+            for i, p_ in enumerate(p):
+                self._p[:] = p_
+                result[i] = self.ft(uv)
+        finally:
+            self._p[:] = p_saved
+        return result
+
+    def jacobian(self, uv):
+        """
+        Method that returns derivatives of component's Fourier Transform with
+        respect to free parameters in given points of uv-plane.
+        :param uv:
+            2D-numpy array of uv-coordinates with shape (#data, 2,)
+        :return:
+            Complex numpy array with shape (#data, #free parameters,).
+        """
+        raise NotImplementedError("Method must me implemented in subclasses!")
+
     def add_to_image(self, image, beam=None):
         """
         Add component to image.
@@ -180,7 +257,7 @@ class EGComponent(Component):
     Class that implements elliptical gaussian component.
     """
     _parnames = ['flux', 'x', 'y', 'bmaj', 'e', 'bpa']
-    size = len(_parnames)
+    __slots__ = ()
 
     def __init__(self, flux, x, y, bmaj, e, bpa, fixed=None):
         """
@@ -224,7 +301,7 @@ class EGComponent(Component):
             Instance of ``DeltaComponent``
         """
         if fixed is None:
-            fixed = self._fixed[:DeltaComponent.size]
+            fixed = self._fixed[:len(DeltaComponent._parnames)]
         return DeltaComponent(self.p[0], self.p[1], self.p[2],
                               fixed=np.array(DeltaComponent._parnames)[fixed])
 
@@ -239,7 +316,7 @@ class EGComponent(Component):
             Instance of ``CGcomponent``.
         """
         if fixed is None:
-            fixed = self._fixed[:CGComponent.size]
+            fixed = self._fixed[:len(CGComponent._parnames)]
         return CGComponent(self.p[0], self.p[1], self.p[2], self.p[3],
                            fixed=np.array(CGComponent._parnames)[fixed])
 
@@ -307,6 +384,88 @@ class EGComponent(Component):
             ft *= np.exp(-2. * math.pi * 1j * (u * x0 + v * y0))
         return ft
 
+    def ft_batch(self, p, uv):
+        """
+        Return the Fourier Transform of component for many sets of parameters
+        for given uv-points.
+        :param p:
+            2D numpy array of all parameters with shape (#sets, #parameters,).
+        :param uv:
+            2D numpy array of uv-points for which to calculate FT.
+        :return:
+            Complex numpy array with shape (#sets, length of ``uv``).
+        """
+        p = np.atleast_2d(p)
+        flux, x0, y0, bmaj = [p[:, i, np.newaxis] for i in range(4)]
+        # If we call method inside ``CGComponent``
+        if p.shape[1] == 6:
+            e = np.where(p[:, 4] == 0, 10**(-54), p[:, 4])[:, np.newaxis]
+            bpa = p[:, 5, np.newaxis] + 0.5 * np.pi
+        else:
+            e = 1.
+            bpa = 0.5 * np.pi
+
+        u = uv[:, 0]
+        v = uv[:, 1]
+        c = (np.pi * bmaj * mas_to_rad)**2 / (4. * np.log(2.))
+        b = e**2 * (u*np.cos(bpa)-v*np.sin(bpa))**2 + (u*np.sin(bpa)+v*np.cos(bpa))**2
+        return flux * np.exp(-c * b - 2. * math.pi * 1j * mas_to_rad *
+                             (u * x0 + v * y0))
+
+    def jacobian(self, uv):
+        """
+        Return derivatives of the Fourier Transform of component with respect
+        to free parameters for given uv-points.
+        :param uv:
+            2D numpy array of uv-points for which to calculate derivatives.
+        :return:
+            Complex numpy array with shape (length of ``uv``, #free parameters)
+            with derivatives of visibilities on ``flux`` [1/Jy], ``x``, ``y``,
+            ``bmaj`` [1/mas], ``e`` & ``bpa`` [1/rad].
+
+        :note:
+            With the same notation as in ``EGComponent.ft``
+
+            ft = flux * exp(-c * b) * exp(-2*pi*j*(u*x0+v*y0))
+
+            where c = (pi*bmaj)**2/(4*ln2), b = e**2*A**2+B**2,
+            A = u*cos(bpa')-v*sin(bpa'), B = u*sin(bpa')+v*cos(bpa') and
+            bpa' = bpa+pi/2. Thus dA/dbpa = -B, dB/dbpa = A and
+            db/dbpa = 2*A*B*(1-e**2).
+        """
+        try:
+            flux, x0, y0, bmaj, e, bpa = self._p
+            if e == 0:
+                e = 10**(-54)
+        # If we call method inside ``CGComponent``
+        except ValueError:
+            flux, x0, y0, bmaj = self._p
+            e = 1.
+            bpa = 0.
+
+        bpa += 0.5 * np.pi
+
+        u = uv[:, 0]
+        v = uv[:, 1]
+        a = u * np.cos(bpa) - v * np.sin(bpa)
+        b = u * np.sin(bpa) + v * np.cos(bpa)
+        # Derivative of ``c`` on ``bmaj`` in mas
+        dc = 2. * (np.pi * mas_to_rad) ** 2 * bmaj / (4. * np.log(2.))
+        c = 0.5 * dc * bmaj
+        shape = np.exp(-c * (e**2 * a**2 + b**2) -
+                       2. * math.pi * 1j * mas_to_rad * (u * x0 + v * y0))
+        ft = flux * shape
+
+        jac = np.empty((len(uv), len(self._parnames)), dtype=complex)
+        jac[:, 0] = shape
+        jac[:, 1] = -2. * math.pi * 1j * mas_to_rad * u * ft
+        jac[:, 2] = -2. * math.pi * 1j * mas_to_rad * v * ft
+        jac[:, 3] = -dc * (e**2 * a**2 + b**2) * ft
+        if len(self._parnames) == 6:
+            jac[:, 4] = -2. * c * e * a**2 * ft
+            jac[:, 5] = -2. * c * a * b * (1. - e**2) * ft
+        return jac[:, ~self._fixed]
+
     def _ft(self, uv):
         """
         Return the Fourier Transform of component for given uv-points.
@@ -514,7 +673,7 @@ class CGComponent(EGComponent):
     Class that implements circular gaussian component.
     """
     _parnames = ["flux", "x", "y", "bmaj"]
-    size = len(_parnames)
+    __slots__ = ()
 
     def __init__(self, flux, x, y, bmaj, fixed=None):
         """
@@ -557,6 +716,8 @@ class DeltaComponent(Component):
     """
     Class that implements delta-function component.
     """
+    __slots__ = ()
+
     def __init__(self, flux, x, y, fixed=None):
         """
         :param flux:
@@ -637,6 +798,48 @@ class DeltaComponent(Component):
                                        v[:, np.newaxis] * y0))).sum(axis=1)
         return visibilities
 
+    def ft_batch(self, p, uv):
+        """
+        Return the Fourier Transform of component for many sets of parameters
+        for given uv-points.
+        :param p:
+            2D numpy array of parameters with shape (#sets, 3,).
+        :param uv:
+            2D numpy array of uv-points for which to calculate FT.
+        :return:
+            Complex numpy array with shape (#sets, length of ``uv``).
+        """
+        p = np.atleast_2d(p)
+        flux, x0, y0 = [p[:, i, np.newaxis] for i in range(3)]
+        u = uv[:, 0]
+        v = uv[:, 1]
+        return flux * np.exp(-2. * math.pi * 1j * mas_to_rad *
+                             (u * x0 + v * y0))
+
+    def jacobian(self, uv):
+        """
+        Return derivatives of the Fourier Transform of component with respect
+        to free parameters for given uv-points.
+        :param uv:
+            2D numpy array of uv-points for which to calculate derivatives.
+        :return:
+            Complex numpy array with shape (length of ``uv``, #free parameters)
+            with derivatives of visibilities on ``flux`` [1/Jy], ``x`` & ``y``
+            [1/mas].
+        """
+        flux, x0, y0 = self._p
+
+        u = uv[:, 0]
+        v = uv[:, 1]
+        shift = np.exp(-2. * math.pi * 1j * mas_to_rad * (u * x0 + v * y0))
+        ft = flux * shift
+
+        jac = np.empty((len(uv), 3), dtype=complex)
+        jac[:, 0] = shift
+        jac[:, 1] = -2. * math.pi * 1j * mas_to_rad * u * ft
+        jac[:, 2] = -2. * math.pi * 1j * mas_to_rad * v * ft
+        return jac[:, ~self._fixed]
+
     def add_to_image(self, image, beam=None):
         """
         Add component to given instance of ``ImagePlane`` class.
@@ -690,6 +893,185 @@ class DeltaComponent(Component):
         image._image[y, x] -= flux
 
 
+class DeltaBlockComponent(Component):
+    """
+    Class that implements block of many delta-function components (e.g. CLEAN
+    components) kept in one array. Parameters are ordered as in sequence of
+    ``DeltaComponent`` instances: flux, x, y of the first component, then of
+    the second one etc.
+    """
+    # Number of components to FT at once
+    _chunk_size = 256
+
+    def __init__(self, flux, x, y, fixed=None):
+        """
+        :param flux:
+            Iterable of fluxes of components [Jy].
+        :param x:
+            Iterable of X-coordinates of components phase centers [mas].
+        :param y:
+            Iterable of Y-coordinates of components phase centers [mas].
+        :param fixed: (optional)
+            Iterable of parameter's names that are fixed for all components.
+            If ``None`` then all parameters are free. (default: ``None``)
+        """
+        super(DeltaBlockComponent, self).__init__()
+        flux = np.asarray(flux, dtype=float)
+        self._p = np.empty(3 * len(flux), dtype=float)
+        self._p[0::3] = flux
+        self._p[1::3] = x
+        self._p[2::3] = y
+        self._fixed = np.zeros(len(self._p), dtype=bool)
+        if fixed is not None:
+            for par in fixed:
+                if par not in self._parnames:
+                    raise Exception('Uknown parameter ' + str(par) + ' !')
+                self._fixed[self._parnames.index(par)::3] = True
+        self.size = np.count_nonzero(~self._fixed)
+
+    def __len__(self):
+        """
+        Number of delta-components in the block.
+        """
+        return self.n_components
+
+    @property
+    def parnames(self):
+        return np.tile(self._parnames, len(self._p) // 3)[~self._fixed]
+
+    @property
+    def n_components(self):
+        return len(self._p) // 3
+
+    def split(self):
+        """
+        Returns list of ``DeltaComponent`` instances that keep views of
+        parameters of the block. Priors of the block are priors of each of
+        them.
+        """
+        components = list()
+        for i in xrange(self.n_components):
+            component = DeltaComponent(0., 0., 0.)
+            component._p = self._p[3 * i: 3 * i + 3]
+            component._fixed = self._fixed[3 * i: 3 * i + 3]
+            component.size = np.count_nonzero(~component._fixed)
+            component._lnprior = self._lnprior
+            components.append(component)
+        return components
+
+    def select(self, mask):
+        """
+        Returns new block with selected components.
+
+        :param mask:
+            Boolean numpy array with shape (#components,).
+        """
+        block = DeltaBlockComponent(self._p[0::3][mask], self._p[1::3][mask],
+                                    self._p[2::3][mask])
+        block._fixed = self._fixed.reshape((-1, 3))[mask].ravel()
+        block.size = np.count_nonzero(~block._fixed)
+        block._lnprior = dict(self._lnprior)
+        return block
+
+    def ft(self, uv):
+        """
+        Return the Fourier Transform of all components of the block for given
+        uv-points.
+        :param uv:
+            2D numpy array of uv-points for which to calculate FT.
+        :return:
+            Numpy array of complex visibilities for specified points of
+            uv-plane. Length of the resulting array = length of ``uv`` array.
+        """
+        u = uv[:, 0]
+        v = uv[:, 1]
+        visibilities = np.zeros(len(uv), dtype=complex)
+        for start in xrange(0, len(self._p), 3 * self._chunk_size):
+            p = self._p[start: start + 3 * self._chunk_size]
+            visibilities += np.dot(np.exp(-2.0 * math.pi * 1j * mas_to_rad *
+                                          (u[:, np.newaxis] * p[1::3] +
+                                           v[:, np.newaxis] * p[2::3])),
+                                   p[0::3])
+        return visibilities
+
+    def ft_batch(self, p, uv):
+        """
+        Return the Fourier Transform of all components of the block for many
+        sets of parameters for given uv-points.
+        :param p:
+            2D numpy array of parameters with shape (#sets, #parameters,).
+        :param uv:
+            2D numpy array of uv-points for which to calculate FT.
+        :return:
+            Complex numpy array with shape (#sets, length of ``uv``).
+        """
+        p = np.atleast_2d(p)
+        u = uv[:, 0][:, np.newaxis]
+        v = uv[:, 1][:, np.newaxis]
+        visibilities = np.zeros((len(p), len(uv)), dtype=complex)
+        for start in xrange(0, p.shape[1], 3 * self._chunk_size):
+            p_ = p[:, start: start + 3 * self._chunk_size]
+            for i in xrange(len(p)):
+                visibilities[i] += np.dot(np.exp(-2.0 * math.pi * 1j *
+                                                 mas_to_rad *
+                                                 (u * p_[i, 1::3] +
+                                                  v * p_[i, 2::3])),
+                                          p_[i, 0::3])
+        return visibilities
+
+    def jacobian(self, uv):
+        """
+        Return derivatives of the Fourier Transform of the block with respect
+        to free parameters for given uv-points.
+        :param uv:
+            2D numpy array of uv-points for which to calculate derivatives.
+        :return:
+            Complex numpy array with shape (length of ``uv``, #free parameters)
+            with derivatives of visibilities on ``flux`` [1/Jy], ``x`` & ``y``
+            [1/mas] of each component.
+        """
+        u = uv[:, 0][:, np.newaxis]
+        v = uv[:, 1][:, np.newaxis]
+        flux, x0, y0 = self._p[0::3], self._p[1::3], self._p[2::3]
+        shift = np.exp(-2. * math.pi * 1j * mas_to_rad * (u * x0 + v * y0))
+        ft = flux * shift
+
+        jac = np.empty((len(uv), len(self._p)), dtype=complex)
+        jac[:, 0::3] = shift
+        jac[:, 1::3] = -2. * math.pi * 1j * mas_to_rad * u * ft
+        jac[:, 2::3] = -2. * math.pi * 1j * mas_to_rad * v * ft
+        return jac[:, ~self._fixed]
+
+    def _rasterize(self, image):
+        """
+        Returns 2D numpy array with fluxes of components placed on the grid of
+        given image the same way as in ``DeltaComponent.add_to_image``.
+        """
+        grid = np.zeros(np.shape(image._image), dtype=float)
+        add_deltas_to_grid(grid, image, self._p[0::3], self._p[1::3],
+                           self._p[2::3])
+        return grid
+
+    def add_to_image(self, image, beam=None):
+        """
+        Add components of the block to given instance of ``Image`` class.
+        """
+        grid = self._rasterize(image)
+        if beam is not None:
+            grid = beam.convolve(grid)
+        image._image += grid
+
+    def substract_from_image(self, image, beam=None):
+        """
+        Subtract components of the block from given instance of ``Image``
+        class.
+        """
+        grid = self._rasterize(image)
+        if beam is not None:
+            grid = beam.convolve(grid)
+        image._image -= grid
+
+
 # TODO: Add method of RM/alpha transformations? With arguments ``from_freq`` &
 # ``to_freq``
 class ImageComponent(Component):
@@ -714,6 +1096,7 @@ class ImageComponent(Component):
                                                  self.imsize[1])]
         self._fixed = np.zeros(len(self._parnames), dtype=bool)
         self._p = image.flatten()
+        self.size = len(self._parnames)
 
     def add_to_image(self, image, beam=None):
         add = self.image
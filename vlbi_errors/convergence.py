@@ -0,0 +1,262 @@
+import time
+import numpy as np
+from chains import run_mcmc
+
+
+def _auto_window(taus, c):
+    """
+    Automatic windowing procedure of Sokal (1989). Returns index of the first
+    window ``M`` such that ``M >= c * tau(M)``.
+    """
+    m = np.arange(len(taus)) < c * taus
+    if np.any(m):
+        return np.argmin(m)
+    return len(taus) - 1
+
+
+class ConvergenceMonitor(object):
+    """
+    Streaming convergence diagnostics of ensemble samplers. Samples are not
+    kept: integrated autocorrelation time, effective sample size and R-hat
+    are updated incrementally from running sums as positions of walkers
+    arrive.
+
+    Autocovariances of each walker are accumulated for lags up to ``max_lag``
+    using ring buffer of the last positions. Autocorrelation function is
+    averaged over walkers and integrated with automatic window of Sokal.
+    R-hat is the Gelman-Rubin statistic with walkers as chains.
+
+    :param n_walkers:
+        Number of walkers.
+    :param n_dim:
+        Number of parameters.
+    :param tau_factor: (optional)
+        Chain is converged only if it is longer than ``tau_factor``
+        autocorrelation times. (default: ``50``)
+    :param tau_rtol: (optional)
+        Chain is converged only if estimates of autocorrelation time changed
+        less than ``tau_rtol`` since the previous check. (default: ``0.01``)
+    :param min_ess: (optional)
+        Minimal effective sample size (for each parameter). If ``None`` then
+        don't check. (default: ``None``)
+    :param max_rhat: (optional)
+        Maximal R-hat. If ``None`` then don't check. (default: ``1.01``)
+    :param check_every: (optional)
+        Number of steps between checks of convergence. (default: ``100``)
+    :param max_lag: (optional)
+        Maximal lag of accumulated autocovariances. Autocorrelation times
+        longer than ``max_lag / c`` are not reliable. (default: ``500``)
+    :param c: (optional)
+        Parameter of automatic window. (default: ``5``)
+    """
+    def __init__(self, n_walkers, n_dim, tau_factor=50., tau_rtol=0.01,
+                 min_ess=None, max_rhat=1.01, check_every=100, max_lag=500,
+                 c=5.):
+        self.n_walkers = n_walkers
+        self.n_dim = n_dim
+        self.tau_factor = tau_factor
+        self.tau_rtol = tau_rtol
+        self.min_ess = min_ess
+        self.max_rhat = max_rhat
+        self.check_every = check_every
+        self.max_lag = max_lag
+        self.c = c
+        self.reset()
+
+    def reset(self):
+        self.n_steps = 0
+        # Ring buffer of the last ``max_lag`` positions (#lag, #walkers, #dim)
+        self._buffer = np.zeros((self.max_lag, self.n_walkers, self.n_dim))
+        # Sums of x(t) * x(t - k) for k = 0, ..., max_lag - 1
+        self._lagged_sums = np.zeros((self.max_lag, self.n_walkers,
+                                      self.n_dim))
+        # Running means & sums of squared deviations of walkers (Welford)
+        self._mean = np.zeros((self.n_walkers, self.n_dim))
+        self._m2 = np.zeros((self.n_walkers, self.n_dim))
+        self._tau_previous = None
+        self.tau = None
+        self.converged = False
+        self._start_time = None
+        self._start_step = 0
+        self._step_time = None
+        self.history = list()
+
+    def update(self, pos):
+        """
+        Add positions of walkers after one step.
+
+        :param pos:
+            Numpy array with shape (#walkers, #dim).
+        """
+        if self._start_time is None:
+            self._start_time = time.time()
+            self._start_step = self.n_steps
+        pos = np.asarray(pos, dtype=float)
+        self.n_steps += 1
+        delta = pos - self._mean
+        self._mean += delta / self.n_steps
+        self._m2 += delta * (pos - self._mean)
+
+        i = (self.n_steps - 1) % self.max_lag
+        self._buffer[i] = pos
+        n_lags = min(self.n_steps, self.max_lag)
+        # Indexes of x(t - k) in the ring buffer for k = 0, ..., n_lags - 1
+        indxs = (i - np.arange(n_lags)) % self.max_lag
+        self._lagged_sums[:n_lags] += pos * self._buffer[indxs]
+        self._step_time = ((time.time() - self._start_time) /
+                           (self.n_steps - self._start_step))
+
+    def update_from_chain(self, chain):
+        """
+        Add positions of walkers saved by previous run (e.g.
+        ``chains.ChainBackend.chain``) checking convergence every
+        ``check_every`` steps as callback does. Time per step is estimated
+        only from steps added later.
+
+        :param chain:
+            Numpy array with shape (#walkers, #steps, #dim).
+        """
+        for pos in np.swapaxes(chain, 0, 1):
+            self(pos)
+        self._start_time = None
+        self._step_time = None
+
+    def autocorrelation(self):
+        """
+        Returns estimate of normalized autocorrelation function averaged over
+        walkers with shape (#lags, #dim).
+        """
+        n_lags = min(self.n_steps, self.max_lag)
+        counts = (self.n_steps - np.arange(n_lags))[:, np.newaxis, np.newaxis]
+        acov = self._lagged_sums[:n_lags] / counts - self._mean ** 2
+        acf = acov / acov[0]
+        return np.nanmean(acf, axis=1)
+
+    def integrated_time(self):
+        """
+        Returns estimates of integrated autocorrelation time for each
+        parameter.
+        """
+        acf = self.autocorrelation()
+        taus = 2. * np.cumsum(acf, axis=0) - 1.
+        tau = np.empty(self.n_dim)
+        for j in range(self.n_dim):
+            tau[j] = taus[_auto_window(taus[:, j], self.c), j]
+        return tau
+
+    @property
+    def ess(self):
+        """
+        Effective sample size for each parameter.
+        """
+        return self.n_steps * self.n_walkers / self.integrated_time()
+
+    @property
+    def rhat(self):
+        """
+        Gelman-Rubin statistic for each parameter with walkers as chains.
+        """
+        n = self.n_steps
+        w = np.mean(self._m2 / (n - 1), axis=0)
+        b_n = np.var(self._mean, axis=0, ddof=1)
+        return np.sqrt(((n - 1.) / n * w + b_n) / w)
+
+    def check(self):
+        """
+        Check convergence with current samples. Updates ``tau``, ``converged``
+        and ``history``.
+
+        :return:
+            Boolean - is the chain converged?
+        """
+        tau = self.integrated_time()
+        rhat = self.rhat
+        ess = self.n_steps * self.n_walkers / tau
+        converged = bool(np.all(self.n_steps > self.tau_factor * tau))
+        if self._tau_previous is not None:
+            converged &= bool(np.all(np.abs(self._tau_previous - tau) / tau <
+                                     self.tau_rtol))
+        else:
+            converged = False
+        if self.min_ess is not None:
+            converged &= bool(np.all(ess >= self.min_ess))
+        if self.max_rhat is not None:
+            converged &= bool(np.all(rhat <= self.max_rhat))
+        self._tau_previous = tau
+        self.tau = tau
+        self.converged = converged
+        self.history.append({'n_steps': self.n_steps, 'tau': tau, 'ess': ess,
+                             'rhat': rhat})
+        return converged
+
+    def __call__(self, pos, lnprob=None, iteration=None):
+        """
+        Callback for ``chains.run_mcmc``. Returns ``True`` when sampling
+        should be stopped.
+        """
+        self.update(pos)
+        if self.n_steps % self.check_every:
+            return False
+        return self.check()
+
+    def time_saved(self, iterations):
+        """
+        Returns estimate of wall-clock time [s] saved by stopping after
+        ``n_steps`` instead of running for ``iterations`` steps.
+        """
+        if self._step_time is None:
+            return 0.
+        return max(iterations - self.n_steps, 0) * self._step_time
+
+    def report(self, iterations=None):
+        """
+        Print summary of diagnostics.
+
+        :param iterations: (optional)
+            Number of steps of the run without early stopping. If not ``None``
+            then report time saved. (default: ``None``)
+        """
+        if self.tau is None:
+            self.check()
+        print "Steps : {}, converged : {}".format(self.n_steps, self.converged)
+        print "Autocorrelation times : {}".format(self.tau)
+        print "Effective sample sizes : {}".format(self.n_steps *
+                                                   self.n_walkers / self.tau)
+        print "R-hat : {}".format(self.rhat)
+        if iterations is not None:
+            print "Stopped after {} of {} steps, saved {:.1f} s".format(
+                self.n_steps, iterations, self.time_saved(iterations))
+
+
+def run_until_converged(sampler, p0, iterations, monitor, backend=None):
+    """
+    Run ``emcee.EnsembleSampler`` until ``monitor`` reports convergence or for
+    ``iterations`` steps at most. Reports diagnostics and wall-clock time
+    saved. If ``backend`` has samples of interrupted run then ``monitor`` is
+    reset and fed with them before sampling is resumed, so the run stops at
+    the same step as uninterrupted one.
+
+    :param sampler:
+        Instance of ``emcee.EnsembleSampler``.
+    :param p0:
+        Initial positions of walkers.
+    :param iterations:
+        Maximal number of steps.
+    :param monitor:
+        Instance of ``ConvergenceMonitor``.
+    :param backend: (optional)
+        Instance of ``chains.ChainBackend`` to keep samples. If ``None`` then
+        samples are kept by ``sampler``. (default: ``None``)
+    :return:
+        Positions, ln of probabilities & RNG state after the last step.
+    """
+    if backend is not None and backend.iteration:
+        monitor.reset()
+        monitor.update_from_chain(backend.chain)
+        if monitor.converged:
+            state = backend.load_state()
+            monitor.report(iterations)
+            return state['pos'], state['lnprob'], state['rstate']
+    result = run_mcmc(sampler, p0, iterations, backend, callback=monitor)
+    monitor.report(iterations)
+    return result
@@ -52,7 +52,7 @@ sx1 = (0.02, -0.02)
 
 ccmodel = create_ccmodel_from_fits_file(im_path_c1)
 ccmodel_x1 = Model(stokes='I')
-for comp in ccmodel._components:
+for comp in ccmodel.components:
     r = np.sqrt(comp.p[1] ** 2. + comp.p[2] ** 2.)
     if r < 2. * (abs(pixsize_c1[0]) / mas_to_rad):
         print "removing component position ", comp.p
@@ -70,7 +70,7 @@ ccmodel_x1.add_component(CGComponent(0.35, 0. + sx1[0], 0. + sx1[1], 0.10))
 
 # Really we did X-band model first
 ccmodel_c1 = Model(stokes='I')
-for comp in ccmodel_x1._components:
+for comp in ccmodel_x1.components:
     r = np.sqrt(comp.p[1] ** 2. + comp.p[2] ** 2.)
     if r < 3. * (abs(pixsize_c1[0]) / mas_to_rad):
         print "removing component position ", comp.p
@@ -1,6 +1,83 @@
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from numpy.fft import ifft2
+from scipy import ndimage
+from utils import mas_to_rad
+from image import CleanImage
+from model import Model
+from components import DeltaBlockComponent
+
 __author__ = 'ilya'
 
 
+# Number of model visibility & component pairs to FT at once
+_degrid_chunk = 1 << 22
+
+
+def stokes_visibilities(uvdata, stokes='I'):
+    """
+    Returns visibilities of given Stokes parameter with their uv-coordinates
+    and weights. IFs are treated as separate points of uv-plane, points with
+    non-positive or absent weights are skipped.
+
+    :param uvdata:
+        Instance of ``UVData`` class.
+    :param stokes: (optional)
+        Stokes parameter (``I``, ``Q``, ``U``, ``V``) or correlation present
+        in data (e.g. ``RR``). (default: ``I``)
+    :return:
+        Numpy arrays of uv-coordinates with shape (#N, 2) [lambda], complex
+        visibilities and weights with shape (#N,).
+    """
+    data = uvdata.uvdata
+    weights = uvdata.weights
+    indxs = uvdata.stokes_dict_inv
+    stokes = stokes.upper()
+    pairs = {'I': ('RR', 'LL', 0.5, 0.5), 'V': ('RR', 'LL', 0.5, -0.5),
+             'Q': ('LR', 'RL', 0.5, 0.5), 'U': ('LR', 'RL', 0.5j, -0.5j)}
+    if stokes in indxs:
+        vis = data[..., indxs[stokes]]
+        w = weights[..., indxs[stokes]]
+    elif stokes in pairs:
+        corr1, corr2, c1, c2 = pairs[stokes]
+        if corr1 not in indxs or corr2 not in indxs:
+            raise Exception("No {} & {} correlations to get Stokes"
+                            " {}!".format(corr1, corr2, stokes))
+        vis = c1 * data[..., indxs[corr1]] + c2 * data[..., indxs[corr2]]
+        w1 = weights[..., indxs[corr1]]
+        w2 = weights[..., indxs[corr2]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            w = np.where((w1 > 0) & (w2 > 0), 4. / (1. / w1 + 1. / w2), 0.)
+    else:
+        raise Exception("Stokes must be one of I, Q, U, V or correlation"
+                        " present in data!")
+    uv = np.repeat(uvdata.uv, vis.shape[1], axis=0)
+    vis = vis.ravel()
+    w = w.ravel()
+    good = (w > 0) & np.isfinite(vis) & np.isfinite(uv).all(axis=1)
+    return uv[good], vis[good], w[good]
+
+
+def read_windows(fname):
+    """
+    Read ``difmap`` file with CLEAN windows (written by ``wwin``).
+
+    :param fname:
+        Path to file.
+    :return:
+        List of windows (xmin, xmax, ymin, ymax) [mas] in ``difmap``
+        coordinates (relative RA & DEC).
+    """
+    windows = list()
+    with open(fname) as fo:
+        for line in fo:
+            line = line.strip()
+            if not line or line.startswith('!'):
+                continue
+            windows.append(tuple(float(value) for value in line.split()[:4]))
+    return windows
+
+
 class Deconvolution(object):
     """
     Base class for deconvolution.
@@ -14,3 +91,463 @@ class MEMDeconvolution(Deconvolution):
         super(MEMDeconvolution, self).__init__(uvdata, *args, **kwargs)
         self.dirty_image = dirty_image
         self.dirty_beam = dirty_beam
+
+
+class CleanDeconvolution(Deconvolution):
+    """
+    CLEAN of uv-data without ``difmap``. Dirty images are made by FFT of
+    visibilities gridded to the nearest cell of uv-grid twice the image size,
+    so dirty beam covers shifts of components over the whole image. Minor
+    cycles (Hogbom or Clark) are done in image plane and major cycles subtract
+    exact FT of CLEAN components (degridding of model) from visibilities.
+    Pixel grid & CC positions are the same as of ``CleanImage`` instances made
+    from ``difmap`` FITS-files, so instances are thread-safe replacement of
+    ``spydiff.clean_difmap`` for bootstrap replications.
+
+    :param uvdata:
+        Instance of ``UVData`` class.
+    :param mapsize:
+        Iterable of image size [pix] and pixel size [mas] (as ``mapsize`` in
+        ``difmap``).
+    :param stokes: (optional)
+        Stokes parameter to CLEAN. (default: ``I``)
+    :param weighting: (optional)
+        ``natural`` or ``uniform`` weighting of visibilities. (default:
+        ``natural``)
+    """
+    def __init__(self, uvdata, mapsize, stokes='I', weighting='natural'):
+        super(CleanDeconvolution, self).__init__(uvdata)
+        if weighting not in ('natural', 'uniform'):
+            raise Exception("Weighting must be ``natural`` or ``uniform``!")
+        self.stokes = stokes.upper()
+        self.imsize = (int(mapsize[0]), int(mapsize[0]))
+        self.pixsize_mas = float(mapsize[1])
+        self.weighting = weighting
+        self.uv, self.vis, self.weights = stokes_visibilities(uvdata,
+                                                              self.stokes)
+        # Template image with pixel grid of result
+        self._template = self._new_image()
+        rows, cols = self.imsize
+        # Coordinates [rad] of rows & columns as in ``add_deltas_to_grid``
+        self._x = (np.arange(cols) + 2 - self._template.x_c) * self._template.dx
+        self._y = (np.arange(rows) + 2 - self._template.y_c) * self._template.dy
+        self._grid_shape = (2 * rows, 2 * cols)
+        self._grid_indxs, self._grid_weights = self._grid_points()
+        self._dirty_beam = None
+        self._beam_pars = None
+        self._main_lobe = None
+        self._max_sidelobe = None
+
+    def _new_image(self, beam=(1., 1., 0.)):
+        pixsize = self.pixsize_mas * mas_to_rad
+        image = CleanImage()
+        image._construct(imsize=self.imsize, pixsize=(-pixsize, pixsize),
+                         pixref=(self.imsize[0] // 2 + 1,
+                                 self.imsize[1] // 2 + 1),
+                         stokes=self.stokes, freq=self.uvdata.frequency,
+                         pixrefval=(0., 0.), bmaj=beam[0] * mas_to_rad,
+                         bmin=beam[1] * mas_to_rad, bpa=beam[2])
+        return image
+
+    def _grid_points(self):
+        """
+        Returns flat indexes of uv-grid cells for visibilities & their
+        conjugates and weights of gridding.
+        """
+        n_rows, n_cols = self._grid_shape
+        dx, dy = self._template.dx, self._template.dy
+        ku = np.round(self.uv[:, 0] * n_cols * dx).astype(int)
+        kv = np.round(self.uv[:, 1] * n_rows * dy).astype(int)
+        # Visibilities of the image are hermitian
+        indxs = np.hstack(((kv % n_rows) * n_cols + ku % n_cols,
+                           (-kv % n_rows) * n_cols + -ku % n_cols))
+        weights = np.hstack((self.weights, self.weights))
+        if self.weighting == 'uniform':
+            cell_weights = np.bincount(indxs, weights=weights,
+                                       minlength=n_rows * n_cols)
+            weights = weights / cell_weights[indxs]
+        return indxs, weights / weights.sum()
+
+    def _grid_to_image(self, values):
+        # Image with zero shift at [0, 0]
+        n_rows, n_cols = self._grid_shape
+        grid = np.bincount(self._grid_indxs, weights=values.real,
+                           minlength=n_rows * n_cols) +\
+            1j * np.bincount(self._grid_indxs, weights=values.imag,
+                             minlength=n_rows * n_cols)
+        return ifft2(grid.reshape(self._grid_shape)).real * (n_rows * n_cols)
+
+    def dirty_image(self, vis=None):
+        """
+        Returns dirty image.
+
+        :param vis: (optional)
+            Visibilities at points of uv-plane of data (e.g. residuals). If
+            ``None`` then use data. (default: ``None``)
+        :return:
+            2D numpy array with image [Jy/beam].
+        """
+        if vis is None:
+            vis = self.vis
+        values = np.hstack((vis, np.conj(vis))) * self._grid_weights
+        image = self._grid_to_image(values)
+        rows, cols = self.imsize
+        x0 = self._template.x_c - 2
+        y0 = self._template.y_c - 2
+        return image[np.ix_((np.arange(rows) - y0) % self._grid_shape[0],
+                            (np.arange(cols) - x0) % self._grid_shape[1])]
+
+    @property
+    def dirty_beam(self):
+        """
+        Dirty beam twice the image size with peak at the center of array.
+        """
+        if self._dirty_beam is None:
+            beam = self._grid_to_image(self._grid_weights.astype(complex))
+            n_rows, n_cols = self._grid_shape
+            self._dirty_beam = np.roll(np.roll(beam, n_rows // 2, axis=0),
+                                       n_cols // 2, axis=1)
+        return self._dirty_beam
+
+    def _beam_at(self, row, col):
+        # View of dirty beam for component at pixel (row, col) of image
+        n_rows, n_cols = self._grid_shape
+        rows, cols = self.imsize
+        r0 = n_rows // 2 - row
+        c0 = n_cols // 2 - col
+        return self.dirty_beam[r0: r0 + rows, c0: c0 + cols]
+
+    @property
+    def main_lobe(self):
+        """
+        Boolean mask of the main lobe (above half of the peak) of dirty beam.
+        """
+        if self._main_lobe is None:
+            labels, _ = ndimage.label(self.dirty_beam > 0.5)
+            n_rows, n_cols = self._grid_shape
+            self._main_lobe = labels == labels[n_rows // 2, n_cols // 2]
+        return self._main_lobe
+
+    @property
+    def max_sidelobe(self):
+        """
+        Maximal absolute value of dirty beam outside of the main lobe.
+        """
+        if self._max_sidelobe is None:
+            # Main lobe down to the first zero
+            labels, _ = ndimage.label(self.dirty_beam > 0.)
+            n_rows, n_cols = self._grid_shape
+            lobe = labels == labels[n_rows // 2, n_cols // 2]
+            self._max_sidelobe = np.abs(self.dirty_beam[~lobe]).max()
+        return self._max_sidelobe
+
+    @property
+    def beam(self):
+        """
+        Parameters of elliptical gaussian fitted to the main lobe of dirty
+        beam: bmaj [mas], bmin [mas], bpa [deg]. Found from second moments of
+        the area above half of the peak.
+        """
+        if self._beam_pars is None:
+            n_rows, n_cols = self._grid_shape
+            rows, cols = np.nonzero(self.main_lobe)
+            x = (cols - n_cols // 2) * self._template.dx / mas_to_rad
+            y = (rows - n_rows // 2) * self._template.dy / mas_to_rad
+            cov = np.cov(np.vstack((x, y)), bias=True)
+            if not np.all(np.isfinite(cov)) or len(x) < 2:
+                cov = np.eye(2) * self.pixsize_mas ** 2 / 16.
+            eigvals, eigvecs = np.linalg.eigh(cov)
+            # Semi-axes of uniform ellipse are 2 * std, FWHM are its axes
+            bmin, bmaj = 4. * np.sqrt(np.maximum(eigvals,
+                                                 self.pixsize_mas ** 2 / 16.))
+            ex, ey = eigvecs[:, 1]
+            # From North to East. Axis is the same in ``difmap`` coordinates
+            bpa = np.rad2deg(np.arctan2(ex, ey))
+            if bpa > 90.:
+                bpa -= 180.
+            elif bpa <= -90.:
+                bpa += 180.
+            self._beam_pars = (bmaj, bmin, bpa)
+        return self._beam_pars
+
+    def window_mask(self, clean_box=None, txt_windows=None):
+        """
+        Returns boolean mask of pixels where CLEAN components could be placed.
+
+        :param clean_box: (optional)
+            Window (xmin, xmax, ymin, ymax) [mas] in ``difmap`` coordinates
+            (as for ``addwin``). (default: ``None``)
+        :param txt_windows: (optional)
+            Path to ``difmap`` file with windows. (default: ``None``)
+        :return:
+            2D boolean numpy array. If no windows then all pixels are
+            allowed.
+        """
+        windows = list()
+        if clean_box is not None:
+            windows.append(clean_box)
+        if txt_windows is not None:
+            windows.extend(read_windows(txt_windows))
+        if not windows:
+            return np.ones(self.imsize, dtype=bool)
+        # ``difmap`` coordinates are of opposite sign to model's ones
+        x = -self._x / mas_to_rad
+        y = -self._y / mas_to_rad
+        mask = np.zeros(self.imsize, dtype=bool)
+        for window in windows:
+            x1, x2, y1, y2 = window
+            in_x = (x >= min(x1, x2)) & (x <= max(x1, x2))
+            in_y = (y >= min(y1, y2)) & (y <= max(y1, y2))
+            mask |= in_y[:, np.newaxis] & in_x[np.newaxis, :]
+        return mask
+
+    def degrid(self, cc):
+        """
+        Returns FT of CLEAN components at points of uv-plane of data.
+
+        :param cc:
+            2D numpy array of CLEAN components [Jy] on image pixels.
+        :return:
+            Numpy array of complex visibilities.
+        """
+        rows, cols = np.nonzero(cc)
+        flux = cc[rows, cols]
+        vis = np.zeros(len(self.uv), dtype=complex)
+        if not len(flux):
+            return vis
+        # FT of pixel is the product of its row & column factors
+        used_rows, rows = np.unique(rows, return_inverse=True)
+        used_cols, cols = np.unique(cols, return_inverse=True)
+        chunk = max(1, _degrid_chunk // len(flux))
+        for start in xrange(0, len(self.uv), chunk):
+            u = self.uv[start: start + chunk, 0]
+            v = self.uv[start: start + chunk, 1]
+            ft_x = np.exp(-2j * np.pi * u[:, np.newaxis] *
+                          self._x[used_cols][np.newaxis, :])
+            ft_y = np.exp(-2j * np.pi * v[:, np.newaxis] *
+                          self._y[used_rows][np.newaxis, :])
+            vis[start: start + chunk] = np.dot(ft_x[:, cols] * ft_y[:, rows],
+                                               flux)
+        return vis
+
+    def hogbom(self, residuals, cc, mask, gain, niter, stop_level):
+        """
+        Hogbom minor cycle. Components are subtracted from residuals using the
+        whole dirty beam.
+
+        :param residuals:
+            2D numpy array of residual image. Changed inplace.
+        :param cc:
+            2D numpy array of CLEAN components. Changed inplace.
+        :param mask:
+            2D boolean numpy array of allowed pixels.
+        :param gain:
+            Loop gain.
+        :param niter:
+            Maximum number of iterations.
+        :param stop_level:
+            Stop when absolute value of peak residual is below this level.
+        :return:
+            Number of iterations done.
+        """
+        i = 0
+        while i < niter:
+            abs_residuals = np.abs(residuals)
+            abs_residuals[~mask] = 0.
+            peak = np.argmax(abs_residuals)
+            if abs_residuals.flat[peak] <= stop_level:
+                break
+            row, col = np.unravel_index(peak, self.imsize)
+            flux = gain * residuals[row, col]
+            cc[row, col] += flux
+            residuals -= flux * self._beam_at(row, col)
+            i += 1
+        return i
+
+    def clark(self, residuals, cc, mask, gain, niter, stop_level,
+              max_points=1000):
+        """
+        Clark minor cycle. Components are searched among the brightest pixels
+        of residual image that could contain peaks above sidelobes of the
+        current peak. Only values of these pixels are updated, so the whole
+        residual image is correct only after the next major cycle.
+
+        :param max_points: (optional)
+            Maximal number of pixels to search components in. (default:
+            ``1000``)
+        :return:
+            Number of iterations done.
+
+        :note:
+            Other parameters & results as of ``hogbom``.
+        """
+        abs_residuals = np.abs(residuals)
+        abs_residuals[~mask] = 0.
+        peak = abs_residuals.max()
+        level = max(stop_level, self.max_sidelobe * peak)
+        points = np.flatnonzero(abs_residuals > level)
+        if len(points) > max_points:
+            order = np.argsort(abs_residuals.flat[points])[::-1]
+            points = points[order[:max_points]]
+            level = max(level, abs_residuals.flat[points[-1]])
+        if not len(points):
+            return 0
+        rows, cols = np.unravel_index(points, self.imsize)
+        n_rows, n_cols = self._grid_shape
+        beam = self.dirty_beam[n_rows // 2 + rows[:, np.newaxis] -
+                               rows[np.newaxis, :],
+                               n_cols // 2 + cols[:, np.newaxis] -
+                               cols[np.newaxis, :]]
+        values = residuals.flat[points].copy()
+        i = 0
+        while i < niter:
+            j = np.argmax(np.abs(values))
+            if abs(values[j]) <= level:
+                break
+            flux = gain * values[j]
+            cc.flat[points[j]] += flux
+            values -= flux * beam[:, j]
+            i += 1
+        return i
+
+    def clean(self, niter=1000, gain=0.1, threshold=0., algorithm='hogbom',
+              clean_box=None, txt_windows=None, cycle_factor=1.,
+              max_major=50, beam_restore=None):
+        """
+        CLEAN uv-data.
+
+        :param niter: (optional)
+            Maximal number of CLEAN iterations. (default: ``1000``)
+        :param gain: (optional)
+            Loop gain. (default: ``0.1``)
+        :param threshold: (optional)
+            Stop when absolute value of peak residual [Jy/beam] in windows is
+            below this level. (default: ``0``)
+        :param algorithm: (optional)
+            Minor cycle ``hogbom`` or ``clark``. (default: ``hogbom``)
+        :param clean_box: (optional)
+            Window (xmin, xmax, ymin, ymax) [mas] in ``difmap`` coordinates.
+            (default: ``None``)
+        :param txt_windows: (optional)
+            Path to ``difmap`` file with windows. (default: ``None``)
+        :param cycle_factor: (optional)
+            Minor cycle of Hogbom algorithm is stopped when peak residual
+            decreases to this factor times maximal sidelobe of dirty beam
+            times the peak at the start of cycle. (default: ``1``)
+        :param max_major: (optional)
+            Maximal number of major cycles. (default: ``50``)
+        :param beam_restore: (optional)
+            Beam parameters (bmaj [mas], bmin [mas], bpa [deg]) to restore
+            image. If ``None`` then use ``beam``. (default: ``None``)
+        :return:
+            Instance of ``CleanImage``.
+        """
+        if algorithm not in ('hogbom', 'clark'):
+            raise Exception("Algorithm must be ``hogbom`` or ``clark``!")
+        mask = self.window_mask(clean_box=clean_box, txt_windows=txt_windows)
+        if not mask.any():
+            raise Exception("CLEAN windows lie outside of image!")
+        cc = np.zeros(self.imsize, dtype=float)
+        model_vis = np.zeros(len(self.vis), dtype=complex)
+        n_done = 0
+        for _ in xrange(max_major):
+            residuals = self.dirty_image(self.vis - model_vis)
+            peak = np.abs(residuals[mask]).max()
+            if n_done >= niter or peak <= threshold:
+                break
+            new_cc = np.zeros(self.imsize, dtype=float)
+            if algorithm == 'hogbom':
+                stop_level = max(threshold,
+                                 cycle_factor * self.max_sidelobe * peak)
+                n = self.hogbom(residuals, new_cc, mask, gain,
+                                niter - n_done, stop_level)
+            else:
+                n = self.clark(residuals, new_cc, mask, gain,
+                               niter - n_done, threshold)
+            if not n:
+                break
+            n_done += n
+            cc += new_cc
+            # Major cycle
+            model_vis += self.degrid(new_cc)
+        else:
+            residuals = self.dirty_image(self.vis - model_vis)
+
+        if beam_restore is None:
+            beam_restore = self.beam
+        image = self._new_image(beam=beam_restore)
+        image._image = cc
+        image._residuals = residuals
+        image._image_original = image.cc_image + residuals
+        return image
+
+    def model(self, image):
+        """
+        Returns instance of ``Model`` with CLEAN components of ``image``.
+
+        :param image:
+            Instance of ``CleanImage`` returned by ``clean``.
+        """
+        rows, cols = np.nonzero(image.cc)
+        model = Model(stokes=self.stokes)
+        model.add_component(DeltaBlockComponent(image.cc[rows, cols],
+                                                self._x[cols] / mas_to_rad,
+                                                self._y[rows] / mas_to_rad))
+        return model
+
+
+def clean_uvdata(uvdata, stokes, mapsize_clean, niter=1000, gain=0.1,
+                 threshold=0., algorithm='hogbom', clean_box=None,
+                 txt_windows=None, beam_restore=None, weighting='natural'):
+    """
+    CLEAN uv-data without ``difmap`` (see ``CleanDeconvolution``).
+
+    :param uvdata:
+        Instance of ``UVData`` class.
+    :param stokes:
+        Stokes parameter 'i', 'q', 'u' or 'v'.
+    :param mapsize_clean:
+        Parameters of map for cleaning (map size, pixel size [mas]).
+    :return:
+        Instance of ``CleanImage``.
+
+    :note:
+        Other parameters are those of ``CleanDeconvolution`` &
+        ``CleanDeconvolution.clean``.
+    """
+    deconvolution = CleanDeconvolution(uvdata, mapsize_clean, stokes=stokes,
+                                       weighting=weighting)
+    return deconvolution.clean(niter=niter, gain=gain, threshold=threshold,
+                               algorithm=algorithm, clean_box=clean_box,
+                               txt_windows=txt_windows,
+                               beam_restore=beam_restore)
+
+
+def clean_uvdatas(uvdatas, stokes, mapsize_clean, n_jobs=1, **kwargs):
+    """
+    CLEAN several instances of ``UVData`` (e.g. bootstrap replications)
+    without ``difmap`` using ``n_jobs`` threads. Most of the work is done by
+    ``numpy`` routines that release GIL.
+
+    :param uvdatas:
+        Iterable of instances of ``UVData`` class.
+    :param n_jobs: (optional)
+        Number of threads. (default: ``1``)
+    :return:
+        List of instances of ``CleanImage``.
+
+    :note:
+        Other parameters are those of ``clean_uvdata``.
+    """
+    def clean(uvdata):
+        return clean_uvdata(uvdata, stokes, mapsize_clean, **kwargs)
+
+    uvdatas = list(uvdatas)
+    if n_jobs > 1 and len(uvdatas) > 1:
+        pool = ThreadPool(min(n_jobs, len(uvdatas)))
+        try:
+            return pool.map(clean, uvdatas)
+        finally:
+            pool.close()
+            pool.join()
+    return map(clean, uvdatas)
@@ -0,0 +1,365 @@
+import os
+import time
+import Queue
+import shutil
+import tempfile
+import threading
+import subprocess
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+
+
+# Default ``difmap`` executable. Could be set by ``DIFMAP`` environment
+# variable.
+DIFMAP = os.environ.get('DIFMAP', 'difmap')
+
+
+class DifmapError(Exception):
+    pass
+
+
+class DifmapTimeoutError(DifmapError):
+    pass
+
+
+class DifmapRunner(object):
+    """
+    Runs ``difmap`` scripts. Each job is run in its own temporary directory
+    (where ``difmap`` keeps its command & log files), so several jobs could
+    run at the same time. Paths in commands should be absolute.
+
+    :param executable: (optional)
+        Path to ``difmap`` executable. If ``None`` then use ``DIFMAP``
+        environment variable or ``difmap``. (default: ``None``)
+    :param timeout: (optional)
+        Time [s] after which job is killed and ``DifmapTimeoutError`` is
+        raised. If ``None`` then wait forever. (default: ``None``)
+    :param n_jobs: (optional)
+        Number of jobs that ``map`` runs concurrently. (default: ``1``)
+    :param work_dir: (optional)
+        Directory for temporary directories of jobs. If ``None`` then use
+        system default. (default: ``None``)
+    :param log_dir: (optional)
+        Directory to save output of jobs to ``{name}.log`` files. If ``None``
+        then output is only returned. (default: ``None``)
+    :param keep_work_dirs: (optional)
+        Keep temporary directories of jobs (e.g. for debugging)? (default:
+        ``False``)
+    :param sessions: (optional)
+        Default value of ``sessions`` argument of ``map``. (default:
+        ``False``)
+    """
+    def __init__(self, executable=None, timeout=None, n_jobs=1, work_dir=None,
+                 log_dir=None, keep_work_dirs=False, sessions=False):
+        if executable is None:
+            executable = DIFMAP
+        self.executable = executable
+        self.timeout = timeout
+        self.n_jobs = n_jobs
+        self.work_dir = work_dir
+        self.log_dir = log_dir
+        self.keep_work_dirs = keep_work_dirs
+        self.sessions = sessions
+        if log_dir is not None and not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+
+    def run(self, commands, name='difmap', show_output=False):
+        """
+        Run one ``difmap`` script.
+
+        :param commands:
+            Iterable of ``difmap`` commands. ``exit`` is added if the last
+            command is not ``exit``.
+        :param name: (optional)
+            Name of the job used in prefix of temporary directory and in the
+            name of log file. (default: ``difmap``)
+        :param show_output: (optional)
+            Print output of ``difmap``? (default: ``False``)
+        :return:
+            String with output (stdout & stderr) of ``difmap``.
+        """
+        commands = list(commands)
+        if not commands or commands[-1].strip() != 'exit':
+            commands.append('exit')
+        job_dir = tempfile.mkdtemp(prefix='{}_'.format(name),
+                                   dir=self.work_dir)
+        try:
+            command_file = os.path.join(job_dir, 'difmap_commands')
+            with open(command_file, 'w') as fo:
+                fo.write("\n".join(commands) + "\n")
+            with open(command_file, 'r') as fi:
+                try:
+                    process = subprocess.Popen([self.executable], stdin=fi,
+                                               stdout=subprocess.PIPE,
+                                               stderr=subprocess.STDOUT,
+                                               cwd=job_dir)
+                except OSError as e:
+                    raise DifmapError("Can't run difmap executable {}:"
+                                      " {}".format(self.executable, e))
+                timed_out = threading.Event()
+
+                def kill():
+                    timed_out.set()
+                    process.kill()
+
+                timer = None
+                if self.timeout is not None:
+                    timer = threading.Timer(self.timeout, kill)
+                    timer.start()
+                try:
+                    output = process.communicate()[0]
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+        finally:
+            if not self.keep_work_dirs:
+                shutil.rmtree(job_dir, ignore_errors=True)
+
+        if self.log_dir is not None:
+            with open(os.path.join(self.log_dir, '{}.log'.format(name)),
+                      'w') as fo:
+                fo.write(output)
+        if show_output:
+            print output
+        if timed_out.is_set():
+            raise DifmapTimeoutError("Job {} was killed after {} s".format(
+                name, self.timeout))
+        if process.returncode:
+            raise DifmapError("Job {} failed with code {}:\n{}".format(
+                name, process.returncode, output[-2000:]))
+        return output
+
+    def _run_job(self, job):
+        if isinstance(job, dict):
+            return self.run(**job)
+        return self.run(job)
+
+    def session(self):
+        """
+        Returns new ``DifmapSession`` with parameters of the runner.
+        """
+        return DifmapSession(executable=self.executable, timeout=self.timeout,
+                             work_dir=self.work_dir,
+                             keep_work_dir=self.keep_work_dirs)
+
+    def _map_sessions(self, jobs, n_sessions):
+        # Jobs are taken from common queue by sessions of workers
+        queue = Queue.Queue()
+        for i, job in enumerate(jobs):
+            queue.put((i, job))
+        outputs = [None] * len(jobs)
+
+        def work(_):
+            with self.session() as session:
+                while True:
+                    try:
+                        i, job = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    if isinstance(job, dict):
+                        job = job['commands']
+                    outputs[i] = session.run(job)
+
+        pool = ThreadPool(n_sessions)
+        try:
+            pool.map(work, range(n_sessions))
+        finally:
+            pool.close()
+            pool.join()
+        return outputs
+
+    def map(self, jobs, sessions=None):
+        """
+        Run several ``difmap`` scripts using ``n_jobs`` concurrent processes.
+
+        :param jobs:
+            Iterable of iterables of ``difmap`` commands or of dictionaries
+            with keyword arguments of ``run``.
+        :param sessions: (optional)
+            Stream jobs through ``n_jobs`` persistent ``DifmapSession``
+            instances instead of starting new ``difmap`` process for each job.
+            Then each job should start with ``observe``. Log files are not
+            written in this case. If ``None`` then use ``sessions`` attribute.
+            (default: ``None``)
+        :return:
+            List with output of each job.
+        """
+        jobs = list(jobs)
+        if sessions is None:
+            sessions = self.sessions
+        if sessions and jobs:
+            return self._map_sessions(jobs, max(1, min(self.n_jobs,
+                                                       len(jobs))))
+        if self.n_jobs > 1 and len(jobs) > 1:
+            # Threads only wait for ``difmap`` processes
+            pool = ThreadPool(min(self.n_jobs, len(jobs)))
+            try:
+                return pool.map(self._run_job, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        return map(self._run_job, jobs)
+
+
+class DifmapSession(object):
+    """
+    Persistent ``difmap`` process that is fed with commands over pipe. Many
+    sets of commands (e.g. ``observe``, ``clean``, ``wmap`` for each
+    bootstrap replica) are run by the same process, so its start is made
+    once. End of each set is found by sentinel printed by ``difmap`` after
+    the last command. Use it as context manager or call ``close``.
+
+    :param executable: (optional)
+        Path to ``difmap`` executable. If ``None`` then use ``DIFMAP``
+        environment variable or ``difmap``. (default: ``None``)
+    :param timeout: (optional)
+        Time [s] to wait for each set of commands. After it process is killed
+        and ``DifmapTimeoutError`` is raised. If ``None`` then wait forever.
+        (default: ``None``)
+    :param work_dir: (optional)
+        Directory for temporary directory of the session. If ``None`` then use
+        system default. (default: ``None``)
+    :param keep_work_dir: (optional)
+        Keep temporary directory of the session? (default: ``False``)
+
+    :note:
+        Output of ``difmap`` is line buffered with ``stdbuf`` if it is
+        available, so sentinel is not stuck in buffer of the pipe.
+    """
+    sentinel = '__DIFMAP_SESSION_DONE__'
+    # Run after each ``observe`` to remove windows & models left by previous
+    # sets of commands
+    reset_commands = ['delwin', 'clrmod true, true, true']
+
+    def __init__(self, executable=None, timeout=None, work_dir=None,
+                 keep_work_dir=False):
+        if executable is None:
+            executable = DIFMAP
+        self.executable = executable
+        self.timeout = timeout
+        self.work_dir = work_dir
+        self.keep_work_dir = keep_work_dir
+        self._process = None
+        self._lines = None
+        self._session_dir = None
+
+    def start(self):
+        """
+        Start ``difmap`` process.
+        """
+        self._session_dir = tempfile.mkdtemp(prefix='difmap_session_',
+                                             dir=self.work_dir)
+        args = [self.executable]
+        stdbuf = find_executable('stdbuf')
+        if stdbuf is not None:
+            args = [stdbuf, '-oL'] + args
+        try:
+            self._process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE,
+                                             stderr=subprocess.STDOUT,
+                                             cwd=self._session_dir)
+        except OSError as e:
+            raise DifmapError("Can't run difmap executable {}:"
+                              " {}".format(self.executable, e))
+        # Output is read by thread, so waiting for it could be timed out
+        self._lines = Queue.Queue()
+        reader = threading.Thread(target=self._read_output,
+                                  args=(self._process.stdout, self._lines))
+        reader.daemon = True
+        reader.start()
+
+    @staticmethod
+    def _read_output(stdout, lines):
+        for line in iter(stdout.readline, ''):
+            lines.put(line)
+        # End of output
+        lines.put(None)
+
+    @property
+    def is_alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def run(self, commands):
+        """
+        Run set of ``difmap`` commands and wait for their completion.
+
+        :param commands:
+            Iterable of ``difmap`` commands. Trailing ``exit`` is ignored.
+        :return:
+            String with output of ``difmap`` for these commands.
+        """
+        if not self.is_alive:
+            self.close()
+            self.start()
+        commands = [command for command in commands if command.strip()]
+        while commands and commands[-1].strip() == 'exit':
+            commands.pop()
+        commands_ = list()
+        for command in commands:
+            commands_.append(command)
+            if command.split()[0] == 'observe':
+                commands_.extend(self.reset_commands)
+        commands = commands_
+        commands.append('print "{}"'.format(self.sentinel))
+        try:
+            self._process.stdin.write("\n".join(commands) + "\n")
+            self._process.stdin.flush()
+        except IOError:
+            pass
+
+        output = list()
+        # Timeout is for the whole set of commands, not for each line of output
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0.)
+            try:
+                line = self._lines.get(timeout=timeout)
+            except Queue.Empty:
+                self._kill()
+                raise DifmapTimeoutError("Session was killed after {} s"
+                                         " waiting for output".format(self.timeout))
+            if line is None:
+                self._process.wait()
+                raise DifmapError("difmap exited with code {}:\n{}".format(
+                    self._process.returncode, "".join(output)[-2000:]))
+            if line.strip() == self.sentinel:
+                return "".join(output)
+            output.append(line)
+
+    def _kill(self):
+        if self.is_alive:
+            self._process.kill()
+            self._process.wait()
+
+    def close(self):
+        """
+        Exit ``difmap`` and remove temporary directory of the session.
+        """
+        if self.is_alive:
+            try:
+                self._process.stdin.write("exit\n")
+                self._process.stdin.close()
+            except IOError:
+                pass
+            timer = None
+            if self.timeout is not None:
+                timer = threading.Timer(self.timeout, self._kill)
+                timer.start()
+            self._process.wait()
+            if timer is not None:
+                timer.cancel()
+        self._process = None
+        if self._session_dir is not None and not self.keep_work_dir:
+            shutil.rmtree(self._session_dir, ignore_errors=True)
+        self._session_dir = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
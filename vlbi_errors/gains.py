@@ -3,6 +3,7 @@
 
 import copy
 import numpy as np
+from scipy.ndimage import uniform_filter1d
 try:
     import pylab as plt
 except ImportError:
@@ -10,6 +11,33 @@ except ImportError:
 from utils import baselines_2_ants, get_hdu
 
 
+# Indexes of polarizations (R - 0, L - 1) of the 1st & 2nd antennas of
+# correlations
+correlation_pols = {'RR': (0, 0), 'LL': (1, 1), 'RL': (0, 1), 'LR': (1, 0)}
+
+
+def baseline_gains(gains1, gains2, stokes):
+    """
+    Returns complex gains ``gain1 * gain2^*`` of correlations for antenna gains
+    of the 1st & 2nd antennas of visibilities.
+
+    :param gains1:
+        Complex numpy array (#vis, #IF, #pol) of gains of the 1st antennas.
+    :param gains2:
+        Complex numpy array (#vis, #IF, #pol) of gains of the 2nd antennas.
+    :param stokes:
+        Iterable of correlations (e.g. ``UVData.stokes``).
+    :return:
+        Complex numpy array (#vis, #IF, #stokes).
+    """
+    try:
+        pols = np.array([correlation_pols[stokes_] for stokes_ in stokes])
+    except KeyError:
+        raise Exception("Gains could be applied only to RR, LL, RL & LR"
+                        " correlations!")
+    return gains1[:, :, pols[:, 0]] * np.conjugate(gains2[:, :, pols[:, 1]])
+
+
 def open_gains(fname, snver=1):
     """
     Helper function for instantiating and loading complex antenna gains from
@@ -239,7 +267,46 @@ class Gains(object):
     """
     Class that represents complex antenna gains from single VLBI experiment.
     """
-    def __init__(self, fname, snver=1):
+    def __init__(self, fname=None, snver=1):
+        self._data = None
+        self.nif = None
+        self.npol = None
+        # Dictionary with keys - window sizes & values - smoothed ln of gains
+        # & their deviations used in ``resample_gains``
+        self._fluctuations = dict()
+        if fname is not None:
+            self.load(fname, snver=snver)
+
+    @property
+    def data(self):
+        """
+        Shortcut for ``self.data``.
+        """
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    @property
+    def gains(self):
+        """
+        Shortcut for ``self.data['gains']``.
+        """
+        return self.data['gains']
+
+    @gains.setter
+    def gains(self, gains):
+        self.data['gains'] = gains
+
+    def load(self, fname, snver=1):
+        """
+        Method that loads complex antenna gains from ``AIPS SN`` binary table
+        extension of FITS-file.
+
+        ..  warning:: Current implementation assumes that reference antena is
+        the same
+        """
         hdu = get_hdu(fname, extname='AIPS SN', ver=snver)
 
         nif = hdu.header['NO_IF']
@@ -286,38 +353,8 @@ class Gains(object):
         _data['antenna'] = antenna
         _data['gains'] = gains
         _data['weights'] = weights
-
-    @property
-    def data(self):
-        """
-        Shortcut for ``self.data``.
-        """
-        return self._data
-
-    @data.setter
-    def data(self, data):
-        self._data = data
-
-    @property
-    def gains(self):
-        """
-        Shortcut for ``self.data['gains']``.
-        """
-        return self.data['gains']
-
-    @gains.setter
-    def gains(self, gains):
-        self.data['gains'] = gains
-
-    def load(self, fname, snver=1):
-        """
-        Method that loads complex antenna gains from ``AIPS SN`` binary table
-        extension of FITS-file.
-
-        ..  warning:: Current implementation assumes that reference antena is
-        the same
-        """
-        self._data = self._io.load(fname, snver=snver)
+        self._data = _data
+        self._fluctuations = dict()
 
     def save(self, fname, snver=None):
         """
@@ -348,23 +385,10 @@ class Gains(object):
         self_copy = copy.deepcopy(self)
 
         if isinstance(other, Gains):
-            for t in set(0.5 * (self._data['start'] + self._data['stop'])):
-                # Indexes of all entries of self._data array wich have ``t``
-                indxs_self = np.where(0.5 * (self._data['start'] +
-                                      self._data['stop']) == t)[0]
-                for ant in self._data[indxs_self]['antenna']:
-                    # Indexes of self._data array which have ``t`` and ``ant``
-                    indx = np.where((0.5 * (self._data['start'] +
-                                    self._data['stop']) == t) &
-                                    (self._data['antenna'] == ant))[0]
-                    print (indx)
-                    print (np.shape(self._data[indx]['gains'] ))
-                    print (np.shape(other.find_gains_for_antenna(t, ant)))
-                    self_copy._data['gains'][indx] =\
-                            self._data[indx]['gains'] *\
-                            other.find_gains_for_antenna(t, ant)
-                    if other.find_gains_for_antenna(t, ant) is None:
-                        print self_copy._data['gains'][indx]
+            t = 0.5 * (self._data['start'] + self._data['stop'])
+            self_copy.gains = self.gains *\
+                other.find_gains(t, self._data['antenna'])
+            self_copy._fluctuations = dict()
         else:
             raise Exception('Gains instances can be multiplied only on'
                             'instances of Gains class!')
@@ -386,18 +410,10 @@ class Gains(object):
         self_copy = copy.deepcopy(self)
 
         if isinstance(other, Gains):
-            for t in set(0.5 * (self._data['start'] + self._data['stop'])):
-                # Indexes of all entries of self._data array wich have ``t``
-                indxs_self = np.where(0.5 * (self._data['start'] +
-                                      self._data['stop']) == t)[0]
-                for ant in self._data[indxs_self]['antenna']:
-                    # Indexes of self._data array which have ``t`` and ``ant``
-                    indx = np.where((0.5 * (self._data['start'] +
-                                    self._data['stop']) == t) &
-                                    (self._data['antenna'] == ant))[0]
-                    self_copy._data['gains'][indx] =\
-                            self._data[indx]['gains'] /\
-                            other.find_gains_for_antenna(t, ant)
+            t = 0.5 * (self._data['start'] + self._data['stop'])
+            self_copy.gains = self.gains /\
+                other.find_gains(t, self._data['antenna'])
+            self_copy._fluctuations = dict()
         else:
             raise Exception('Gains instances can be divided only by '
                             'instances of Gains class!')
@@ -479,6 +495,140 @@ class Gains(object):
 
         return gains12
 
+    def get_indexes(self, t, antennas):
+        """
+        Returns indexes of entries of ``data`` with gains of given antennas at
+        given times.
+
+        :param t:
+            Numpy array of times.
+        :param antennas:
+            Numpy array of antenna numbers with the same shape as ``t``.
+        :return:
+            Numpy integer array with indexes. ``-1`` for times not covered by
+            gains solutions.
+        """
+        t = np.asarray(t, dtype=float)
+        antennas = np.asarray(antennas)
+        indxs = -np.ones(len(t), dtype=int)
+        for ant in np.unique(antennas):
+            ant_indxs = np.where(self._data['antenna'] == ant)[0]
+            ant_indxs = ant_indxs[np.argsort(self._data['start'][ant_indxs])]
+            mask = antennas == ant
+            # The last solution interval that starts before ``t``
+            i = np.searchsorted(self._data['start'][ant_indxs], t[mask],
+                                side='right') - 1
+            found = i >= 0
+            i = ant_indxs[np.maximum(i, 0)]
+            found &= t[mask] <= self._data['stop'][i]
+            indxs[mask] = np.where(found, i, -1)
+        return indxs
+
+    def find_gains(self, t, antennas, gains=None):
+        """
+        Vectorized version of ``find_gains_for_antenna``.
+
+        :param t:
+            Numpy array of times.
+        :param antennas:
+            Numpy array of antenna numbers with the same shape as ``t``.
+        :param gains: (optional)
+            Complex numpy array with the same shape as ``gains`` (e.g. result
+            of ``resample_gains``) to use instead of ``gains``. (default:
+            ``None``)
+        :return:
+            Complex numpy array (#t, #IF, #pol). ``nan`` for times not covered
+            by gains solutions.
+        """
+        if gains is None:
+            gains = self.gains
+        indxs = self.get_indexes(t, antennas)
+        result = gains[np.maximum(indxs, 0)]
+        result[indxs < 0] = np.nan
+        return result
+
+    def baseline_gains(self, t, baselines, stokes):
+        """
+        Vectorized version of ``find_gains_for_baseline``.
+
+        :param t:
+            Numpy array of times.
+        :param baselines:
+            Numpy array of baseline numbers with the same shape as ``t``.
+        :param stokes:
+            Iterable of correlations (e.g. ``UVData.stokes``).
+        :return:
+            Complex numpy array (#t, #IF, #stokes).
+        """
+        baselines = np.abs(np.asarray(baselines)).astype(int)
+        ant1 = baselines // 256
+        ant2 = baselines - 256 * ant1
+        return baseline_gains(self.find_gains(t, ant1),
+                              self.find_gains(t, ant2), stokes)
+
+    def _get_fluctuations(self, window):
+        """
+        Returns ln of gains smoothed by moving average of ``window``
+        successive solutions of each antenna, deviations of ln of gains from
+        smoothed ones, and boolean array of valid gains. Phases are unwrapped
+        in time.
+        """
+        if window in self._fluctuations:
+            return self._fluctuations[window]
+        gains = self.gains
+        valid = (self._data['weights'] > 0) & (np.abs(gains) > 0) &\
+            np.isfinite(gains)
+        smoothed = np.zeros(gains.shape, dtype=complex)
+        deviations = np.zeros(gains.shape, dtype=complex)
+        for ant in np.unique(self._data['antenna']):
+            indxs = np.where(self._data['antenna'] == ant)[0]
+            indxs = indxs[np.argsort(self._data['start'][indxs])]
+            valid_ = valid[indxs]
+            g = np.where(valid_, gains[indxs], 1.)
+            ln_g = np.log(np.abs(g)) + 1j * np.unwrap(np.angle(g), axis=0)
+            # Moving average of valid solutions only
+            n = uniform_filter1d(valid_.astype(float), window, axis=0,
+                                 mode='nearest')
+            with np.errstate(divide='ignore', invalid='ignore'):
+                smoothed_ = (uniform_filter1d(ln_g.real * valid_, window,
+                                              axis=0, mode='nearest') +
+                             1j * uniform_filter1d(ln_g.imag * valid_, window,
+                                                   axis=0, mode='nearest')) / n
+            smoothed_ = np.where(valid_, smoothed_, 0.)
+            smoothed[indxs] = smoothed_
+            deviations[indxs] = np.where(valid_, ln_g - smoothed_, 0.)
+        result = smoothed, deviations, valid
+        self._fluctuations[window] = result
+        return result
+
+    def resample_gains(self, window=5, random_state=np.random):
+        """
+        Returns gains with resampled fluctuations. ln of gains of each
+        antenna are smoothed by moving average and deviations of solutions
+        (of all IFs & polarizations together) are resampled with replacement
+        among solutions of the same antenna. All antennas are resampled at
+        once.
+
+        :param window: (optional)
+            Number of successive solutions in moving average. (default:
+            ``5``)
+        :param random_state: (optional)
+            Instance of ``np.random.RandomState``. (default: ``np.random``)
+        :return:
+            Complex numpy array with the same shape as ``gains``. Invalid
+            (flagged) gains are not changed.
+        """
+        smoothed, deviations, valid = self._get_fluctuations(window)
+        antennas = self._data['antenna']
+        order = np.argsort(antennas, kind='mergesort')
+        _, starts, sizes = np.unique(antennas[order], return_index=True,
+                                     return_counts=True)
+        groups = np.searchsorted(antennas[order][starts], antennas)
+        draws = order[starts[groups] + (random_state.random_sample(len(groups)) *
+                                        sizes[groups]).astype(int)]
+        resampled = np.exp(smoothed + deviations[draws])
+        return np.where(valid & valid[draws], resampled, self.gains)
+
     # TODO: convert time to datetime format and use date2num for plotting
     def tplot(self, antenna=None, IF=None, pol=None):
         """
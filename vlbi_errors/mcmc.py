@@ -12,7 +12,9 @@ try:
 except ImportError:
     sys.exit("install scipy for ml estimation")
 import scipy as sp
-from stats import LnLikelihood, LnPost
+from stats import LnLikelihood, LnPost, SharedMemoryPool
+from chains import ChainBackend, run_mcmc
+from convergence import ConvergenceMonitor, run_until_converged
 from image import find_bbox
 from image import plot as iplot
 from image_ops import rms_image
@@ -97,21 +99,33 @@ mdl.add_components(eg1, cg2, cg3, cg4)
 lnpost = LnPost(uvdata, mdl, use_V=False, average_freq=True)
 ndim = mdl.size
 nwalkers = 200
-sampler = emcee.EnsembleSampler(nwalkers, ndim, lnpost)
+pool = SharedMemoryPool(lnpost.lnlik, lnpost.lnpr)
+sampler = emcee.EnsembleSampler(nwalkers, ndim, lnpost, pool=pool)
 # p_std1 = [0.05, 0.001, 0.001, 0.01, 0.01, 0.01, 0.01, 0.005, 0.005, 0.01]
 p_std1 = [0.05, 0.001, 0.001, 0.01, 0.01, 0.01, 0.01, 0.005, 0.005, 0.01] +\
          [0.003, 0.005, 0.005] + [0.003, 0.005, 0.005, 0.001]
 p0 = emcee.utils.sample_ball(mdl.p, p_std1, size=nwalkers)
-pos, prob, state = sampler.run_mcmc(p0, 100)
-sampler.reset()
-pos, lnp, _ = sampler.run_mcmc(pos, 500)
-sampler.reset()
-pos, lnp, _ = sampler.run_mcmc(pos, 500)
+# Chains are checkpointed so killed run continues from the last checkpoint
+chains_dir = os.path.join(data_dir, 'chains')
+pos, prob, state = run_mcmc(sampler, p0, 100,
+                            ChainBackend(chains_dir, name='burnin_1'))
+pos, lnp, _ = run_mcmc(sampler, pos, 500,
+                       ChainBackend(chains_dir, name='burnin_2'))
+production = ChainBackend(chains_dir, name='production')
+# Stop production run when chain has converged. It was fixed 500 steps, now
+# it is at least 200 (two checks of convergence) and at most 2000 steps - if
+# chain hasn't converged by then it is used as is.
+monitor = ConvergenceMonitor(nwalkers, ndim)
+pos, lnp, _ = run_until_converged(sampler, pos, 2000, monitor,
+                                  backend=production)
+if not monitor.converged:
+    print "Production chain hasn't converged in 2000 steps"
+pool.close()
 
 # Plot corner
 fig, axes = plt.subplots(nrows=ndim, ncols=ndim)
 fig.set_size_inches(19.5, 19.5)
-corner.corner(sampler.flatchain[::10, :], fig=fig,
+corner.corner(production.flatchain[::10, :], fig=fig,
               labels=[r'$flux$', r'$x$', r'$y$', r'$bmaj$', r'$e$', r'$bpa$',
                       r'$flux$', r'$x$', r'$y$', r'$bmaj$',
                       r'$flux$', r'$x$', r'$y$',
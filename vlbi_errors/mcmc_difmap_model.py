@@ -5,7 +5,7 @@ from model import Model
 from components import CGComponent, EGComponent, DeltaComponent
 from spydiff import import_difmap_model
 import scipy as sp
-from stats import LnPost
+from stats import LnPost, BatchPool
 import emcee
 import corner
 import matplotlib.pyplot as plt
@@ -101,7 +101,7 @@ def fit_model_with_mcmc(uv_fits, mdl_file, outdir=None, nburnin_1=100,
     ndim = mdl.size
 
     # Initialize sampler
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnpost)
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnpost, pool=BatchPool())
 
     # Initialize pool of walkers
     p_std = list()
@@ -1,11 +1,14 @@
+import copy
 import math
+import weakref
 import numpy as np
 import scipy as sp
 import astropy.io.fits as pf
 from stats import LnPost
-from components import CGComponent, EGComponent, DeltaComponent
+from components import (CGComponent, EGComponent, DeltaComponent,
+                        DeltaBlockComponent, add_deltas_to_grid)
 from utils import get_hdu_from_hdulist, get_fits_image_info_from_hdulist,\
-    degree_to_mas, _function_wrapper
+    degree_to_mas, _function_wrapper, gaussian, mas_to_rad
 import matplotlib
 
 try:
@@ -15,22 +18,122 @@ except ImportError:
 
 
 class Jitter(object):
-    def __init__(self, uvdata):
-        self.baselines = uvdata.baselines
+    """
+    Multiplicative scaling of noise on each baseline or of each antenna.
+    Parameters are natural logs of scale factors. For antenna-based jitter
+    noise on baseline ``i-j`` is scaled by product of factors of antennas
+    ``i`` & ``j``.
+
+    :param uvdata:
+        Instance of ``UVData``.
+    :param per: (optional)
+        ``baseline`` or ``antenna``. (default: ``baseline``)
+    """
+    def __init__(self, uvdata, per='baseline'):
+        self.baselines = np.asarray(uvdata.baselines)
+        self.per = per
+        if per == 'baseline':
+            self.names = list(self.baselines)
+        elif per == 'antenna':
+            self.names = list(uvdata.antennas)
+            ants1 = np.abs(self.baselines) // 256
+            ants2 = np.abs(self.baselines) - ants1 * 256
+            # Indexes of antennas of each baseline (#baselines, 2)
+            self._ant_indxs = np.searchsorted(self.names,
+                                              np.vstack((ants1, ants2)).T)
+        else:
+            raise Exception("Jitter could be only per baseline or antenna!")
         self._lnpriors = dict()
 
-    def set_priors(self):
-        for baseline in self.baselines:
-            self._lnpriors[baseline] = _function_wrapper(sp.stats.uniform.logpdf, [-5, 5], dict(),)
+    @property
+    def size(self):
+        return len(self.names)
+
+    @property
+    def n_groups(self):
+        """
+        Number of groups of data with the same noise scaling (baselines).
+        """
+        return len(self.baselines)
+
+    def group_indxs(self, uvdata):
+        """
+        Returns numpy array with index of group (baseline) for each
+        visibility of ``uvdata``.
+        """
+        return np.searchsorted(self.baselines, uvdata.hdu.data['BASELINE'])
+
+    def log_scales(self, p):
+        """
+        Returns ln of noise scale factors of baselines.
+
+        :param p:
+            Numpy array of parameters with shape (#parameters,) or (#sets,
+            #parameters,).
+        :return:
+            Numpy array with shape (#baselines,) or (#sets, #baselines,).
+        """
+        p = np.asarray(p, dtype=float)
+        if self.per == 'baseline':
+            return p
+        return p[..., self._ant_indxs[:, 0]] + p[..., self._ant_indxs[:, 1]]
+
+    def log_scales_gradient(self, dlog_scales):
+        """
+        Returns gradient with respect to parameters given gradient with
+        respect to ln of noise scale factors of baselines.
+        """
+        if self.per == 'baseline':
+            return dlog_scales
+        return (np.bincount(self._ant_indxs[:, 0], dlog_scales,
+                            minlength=self.size) +
+                np.bincount(self._ant_indxs[:, 1], dlog_scales,
+                            minlength=self.size))
+
+    def set_priors(self, lnprior=None):
+        """
+        :param lnprior: (optional)
+            Tuple of callable, args & kwargs of prior for ln of scale factors.
+            If ``None`` then uniform on ``[-5, 0]``. (default: ``None``)
+        """
+        if lnprior is None:
+            lnprior = (sp.stats.uniform.logpdf, [-5, 5], dict(),)
+        for name in self.names:
+            self._lnpriors[name] = _function_wrapper(*lnprior)
 
     def lnpr(self, p):
-        n = len(self.baselines)
         lnprior = list()
         for i, par in enumerate(p):
-            lnprior.append(self._lnpriors[self.baselines[i]](par))
+            lnprior.append(self._lnpriors[self.names[i]](par))
         return sum(lnprior)
 
 
+def _copy_component(component):
+    """
+    Returns copy of component with its own parameters that doesn't belong to
+    any model.
+    """
+    component = copy.copy(component)
+    component._p = np.array(component._p)
+    component._fixed = np.array(component._fixed)
+    component._lnprior = dict(component._lnprior)
+    component._model = None
+    return component
+
+
+def _footprint(coords, center, radius):
+    """
+    Returns slice of (monotonic) coordinate array ``coords`` that covers
+    interval ``[center - radius, center + radius]``.
+    """
+    step = coords[1] - coords[0] if len(coords) > 1 else 1.
+    i1 = (center - radius - coords[0]) / step
+    i2 = (center + radius - coords[0]) / step
+    start = max(int(np.floor(min(i1, i2))), 0)
+    stop = min(int(np.ceil(max(i1, i2))) + 1, len(coords))
+    return slice(start, max(start, stop))
+
+
 # TODO: ``Model`` subclasses can't be convolved with anything! It is
 # `BasicImage`` that can be convolved.
 # TODO: Keep components ordered by what?
@@ -41,11 +144,93 @@ class Model(object):
     def __init__(self, stokes=None):
         self._components = list()
         self._stokes = stokes
+        self._clear_parameters()
+
+    def __setstate__(self, state):
+        # Views are not preserved by pickling
+        for attr in ('_p_all', '_fixed_all', '_free_indxs'):
+            state.pop(attr, None)
+        self.__dict__.update(state)
+        components = self._components
+        self._components = list()
+        self._clear_parameters()
+        self._reserve(sum(len(component._p) for component in components))
+        for component in components:
+            self._components.append(component)
+            self._bind(component)
+
+    def _clear_parameters(self):
+        # Contiguous arrays with parameters & fixed masks of all components
+        # with spare room at the end. Components keep views of them.
+        self._p_buffer = np.empty(0)
+        self._fixed_buffer = np.empty(0, dtype=bool)
+        # Number of used entries of arrays
+        self._n_p = 0
+        # Indexes of free parameters in ``_p_all``. Found when needed.
+        self._free_indxs_ = None
+
+    @property
+    def _p_all(self):
+        return self._p_buffer[:self._n_p]
+
+    @property
+    def _fixed_all(self):
+        return self._fixed_buffer[:self._n_p]
+
+    @property
+    def _free_indxs(self):
+        if self._free_indxs_ is None:
+            self._free_indxs_ = np.flatnonzero(~self._fixed_all)
+        return self._free_indxs_
+
+    def _reserve(self, size):
+        """
+        Make room for ``size`` parameters in contiguous arrays. Arrays are
+        grown geometrically, so adding components one by one takes linear
+        time.
+        """
+        if size > len(self._p_buffer):
+            self._realloc(max(size, 2 * len(self._p_buffer)))
+
+    def _realloc(self, capacity):
+        """
+        Move parameters of all components to new contiguous arrays with
+        ``capacity`` entries.
+        """
+        self._p_buffer = np.empty(capacity)
+        self._fixed_buffer = np.ones(capacity, dtype=bool)
+        self._n_p = 0
+        for component in self._components:
+            self._bind(component)
+
+    def _bind(self, component):
+        """
+        Put parameters of component at the end of contiguous arrays and make
+        component keep views of them. There should be room for them.
+        """
+        start = self._n_p
+        stop = start + len(component._p)
+        self._p_buffer[start: stop] = component._p
+        self._fixed_buffer[start: stop] = component._fixed
+        component._p = self._p_buffer[start: stop]
+        component._fixed = self._fixed_buffer[start: stop]
+        component._model = weakref.ref(self)
+        self._n_p = stop
+        self._free_indxs_ = None
+
+    @staticmethod
+    def _unbind(component):
+        """
+        Make component keep its own parameters.
+        """
+        component._p = np.array(component._p)
+        component._fixed = np.array(component._fixed)
+        component._model = None
 
     # FIXME:
     def __str__(self):
         result = ""
-        for comp in self._components:
+        for comp in self.components:
             result += result.join([str(comp)])
             result += result.join(["\n"])
         return result
@@ -65,16 +250,12 @@ class Model(object):
         hdu = get_hdu_from_hdulist(hdulist, extname='AIPS CC', ver=ver)
         # TODO: Need this when dealing with IDI UV_DATA extension binary table
         # dtype = build_dtype_for_bintable_data(hdu.header)
-        dtype = hdu.data.dtype
-        data = np.zeros(hdu.header['NAXIS2'], dtype=dtype)
-        for name in data.dtype.names:
-            data[name] = hdu.data[name]
-
-        for flux, x, y in zip(data['FLUX'], data['DELTAX'] * degree_to_mas,
-                              data['DELTAY'] * degree_to_mas):
-            # We keep positions in mas
-            component = DeltaComponent(flux, -x, -y)
-            self.add_component(component)
+        # We keep positions in mas
+        self.add_component(DeltaBlockComponent(hdu.data['FLUX'],
+                                               -hdu.data['DELTAX'] *
+                                               degree_to_mas,
+                                               -hdu.data['DELTAY'] *
+                                               degree_to_mas))
 
     def from_2darray(self, image, pixsize, pixref=None, stokes='I'):
         """
@@ -92,14 +273,10 @@ class Model(object):
         imshape = np.shape(image)
         if pixref is None:
             pixref = (imshape[0]/2, imshape[1]/2)
-        for (x, y), flux in np.ndenumerate(image):
-            if flux:
-                x -= pixref[0]
-                y -= pixref[1]
-                x *= pixsize[0]
-                y *= pixsize[1]
-                component = DeltaComponent(flux, x, y)
-                self.add_component(component)
+        x, y = np.nonzero(image)
+        self.add_component(DeltaBlockComponent(image[x, y],
+                                               (x - pixref[0]) * pixsize[0],
+                                               (y - pixref[1]) * pixsize[1]))
         self.stokes = stokes
 
     def from_fits(self, fname, ver=1):
@@ -153,38 +330,87 @@ class Model(object):
             else:
                 raise NotImplementedError("Only CC, CG & EG are implemented")
             comps.append(comp)
-        self.add_components(comps)
+        self.add_components(*comps)
 
     # FIXME: Add only models with same stokes? Or implement multistokes models?
     def __add__(self, other):
-        self._components.extend(other._components)
+        self.add_components(*other._components)
 
     def add_component(self, component):
-        self._components.append(component)
+        self.add_components(component)
 
     def add_components(self, *components):
+        """
+        Add components to model. Components keep views of the model's
+        contiguous arrays of parameters, so changing parameters of model
+        changes parameters of components and vice versa. Copies of components
+        that already belong to some model (e.g. this one) are added, so the
+        other model is not changed.
+        """
+        self._reserve(self._n_p + sum(len(component._p) for component in
+                                      components))
         for component in components:
+            model = getattr(component, '_model', None)
+            if model is not None and model() is not None:
+                component = _copy_component(component)
             self._components.append(component)
+            self._bind(component)
 
     def remove_component(self, component):
-        self._components.remove(component)
+        self.remove_components(component)
 
     def remove_components(self, *components):
         for component in components:
-            self._components.remove(component)
+            i = self._components.index(component)
+            self._unbind(self._components.pop(i))
+        self._realloc(len(self._p_buffer))
 
     def filter_components_by_r(self, r_max_mas=None):
         """
         Remove all components that are further away then ``r_max_mas``.
+        Delta-components are removed from their blocks.
         :param r_max_mas:
             Maximum distance of component to phase center to keep it in model.
         """
+        if r_max_mas is None:
+            return
+        components = list()
         for component in self._components:
-            if np.hypot(component.p[1], component.p[2]) < r_max_mas:
-                self.remove_component(component)
+            if isinstance(component, DeltaBlockComponent):
+                near = np.hypot(component._p[1::3],
+                                component._p[2::3]) <= r_max_mas
+                if near.all():
+                    components.append(component)
+                    continue
+                self._unbind(component)
+                if near.any():
+                    components.append(component.select(near))
+            elif np.hypot(component._p[1], component._p[2]) <= r_max_mas:
+                components.append(component)
+            else:
+                self._unbind(component)
+        self._components = components
+        self._realloc(len(self._p_buffer))
+
+    @property
+    def components(self):
+        """
+        List of model's components with blocks of delta-components split to
+        single ``DeltaComponent`` instances (that keep views of parameters).
+        """
+        components = list()
+        for component in self._components:
+            if isinstance(component, DeltaBlockComponent):
+                components.extend(component.split())
+            else:
+                components.append(component)
+        return components
 
     def clear_components(self):
+        for component in self._components:
+            self._unbind(component)
         self._components = list()
+        self._clear_parameters()
 
     def clear_uv(self):
         self._uv = None
@@ -200,6 +426,44 @@ class Model(object):
             ft += component.ft(uv)
         return ft
 
+    def ft_batch(self, p, uv=None):
+        """
+        Returns FT of model's components for many sets of free parameters at
+        specified points of uv-plane.
+
+        :param p:
+            2D numpy array of free parameters with shape (#sets, ``size``).
+            Order of parameters is the same as in ``Model.p``.
+        :return:
+            Complex numpy array with shape (#sets, length of ``uv``).
+        """
+        if uv is None:
+            uv = self._uv
+        p = np.atleast_2d(p)
+        p_all = np.tile(self._p_all, (len(p), 1))
+        p_all[:, self._free_indxs] = p
+        ft = np.zeros((len(p), len(uv)), dtype=complex)
+        start = 0
+        for component in self._components:
+            stop = start + len(component._p)
+            ft += component.ft_batch(p_all[:, start: stop], uv)
+            start = stop
+        return ft
+
+    def jacobian(self, uv=None):
+        """
+        Returns derivatives of model's FT with respect to free parameters at
+        specified points of uv-plane.
+
+        :return:
+            Complex numpy array with shape (length of ``uv``, ``size``). Order
+            of columns is the same as in ``Model.p``.
+        """
+        if uv is None:
+            uv = self._uv
+        return np.hstack([component.jacobian(uv) for component in
+                          self._components])
+
     def uvplot(self, uv, style='a&p', sym='.r', fig=None):
         """
         Plot FT of model (visibilities) vs uv-radius.
@@ -239,24 +503,19 @@ class Model(object):
     @property
     def p(self):
         """
-        Shortcut for parameters of model.
+        Shortcut for free parameters of model.
         """
-        p = list()
-        for component in self._components:
-            p.extend(component.p)
-        return p
+        return self._p_all[self._free_indxs]
 
     @p.setter
     def p(self, p):
-        for component in self._components:
-            component.p = p[:component.size]
-            p = p[component.size:]
+        self._p_all[self._free_indxs] = p
 
     @property
     def size(self):
-        return len(self.p)
+        return len(self._free_indxs)
 
-    def add_to_image(self, image, beam=None):
+    def add_to_image(self, image, beam=None, beam_threshold=1e-8):
         """
         Add model to instances of ``Image`` subclasses.
 
@@ -265,11 +524,19 @@ class Model(object):
         :param beam: (optional)
             Instance of ``Beam`` subclass to convolve model with beam before
             adding to image. If ``None`` then don't convolve.
+        :param beam_threshold: (optional)
+            Fraction of beam peak below which beam is cropped before
+            convolution (see ``Beam.convolve``). If ``None`` then convolve with
+            the whole beam image. (default: ``1e-8``)
         """
-        for component in self._components:
+        grid, others = self._rasterize(image)
+        if beam is not None:
+            grid = beam.convolve(grid, threshold=beam_threshold)
+        image._image += grid
+        for component in others:
             component.add_to_image(image, beam=beam)
 
-    def substract_from_image(self, image, beam=None):
+    def substract_from_image(self, image, beam=None, beam_threshold=1e-8):
         """
         Subtract model from instances of ``Image`` subclasses.
 
@@ -278,10 +545,81 @@ class Model(object):
         :param beam: (optional)
             Instance of ``Beam`` subclass to convolve model with beam before
             adding to image. If ``None`` then don't convolve.
+        :param beam_threshold: (optional)
+            Fraction of beam peak below which beam is cropped before
+            convolution (see ``Beam.convolve``). If ``None`` then convolve with
+            the whole beam image. (default: ``1e-8``)
         """
-        for component in self._components:
+        grid, others = self._rasterize(image)
+        if beam is not None:
+            grid = beam.convolve(grid, threshold=beam_threshold)
+        image._image -= grid
+        for component in others:
             component.substract_from_image(image, beam=beam)
 
+    def _rasterize(self, image, n_sigma=6.):
+        """
+        Place all delta & gaussian components of model on the grid of given
+        image (without convolution with beam). Delta components are
+        accumulated with one ``np.add.at`` call and gaussians are evaluated
+        only inside boxes of ``n_sigma`` standard deviations along major axis
+        around their centers.
+
+        :param image:
+            Instance of ``Image`` subclass.
+        :param n_sigma: (optional)
+            Half-size of box where gaussian components are evaluated in
+            standard deviations of major axis. (default: ``6.``)
+        :return:
+            2D numpy array with the same shape as ``image.image`` and list of
+            components that can't be rasterized in batch.
+        """
+        grid = np.zeros(np.shape(image._image), dtype=float)
+        dx, dy = image.dx, image.dy
+        x_c, y_c = image.x_c, image.y_c
+
+        deltas = list()
+        gaussians = list()
+        others = list()
+        for component in self._components:
+            if isinstance(component, DeltaComponent):
+                deltas.append(component._p[np.newaxis, :])
+            elif isinstance(component, DeltaBlockComponent):
+                deltas.append(component._p.reshape((-1, 3)))
+            elif isinstance(component, EGComponent):
+                gaussians.append(component._p)
+            else:
+                others.append(component)
+
+        if deltas:
+            flux, x0, y0 = np.vstack(deltas).T
+            add_deltas_to_grid(grid, image, flux, x0, y0)
+
+        # Coordinates [rad] of grid columns & rows the same way as in
+        # ``EGComponent.add_to_image``
+        xs = (np.arange(1, image.imsize[0] + 1) - x_c) * dx
+        ys = (np.arange(1, image.imsize[1] + 1) - y_c) * dy
+        for p in gaussians:
+            try:
+                flux, x0, y0, bmaj, e, bpa = p
+            except ValueError:
+                flux, x0, y0, bmaj = p
+                e = 1.
+                bpa = 0.
+            x0 *= mas_to_rad
+            y0 *= mas_to_rad
+            bmaj *= mas_to_rad
+            amp = 4. * np.log(2) * flux / (np.pi * (bmaj /
+                                                    abs(image.pixsize[0]))**2 * e)
+            gaussf = gaussian(amp, x0, y0, bmaj, e, bpa=bpa)
+            radius = n_sigma * bmaj / (2. * np.sqrt(2. * np.log(2)))
+            cols = _footprint(xs, x0, radius)
+            rows = _footprint(ys, y0, radius)
+            grid[rows, cols] += gaussf(xs[cols][np.newaxis, :],
+                                       ys[rows][:, np.newaxis])
+
+        return grid, others
+
     # FIXME: Nonlinear models can't use AIC/BIC?
     def bic(self, uvdata, average_freq=True):
         """
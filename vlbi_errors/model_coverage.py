@@ -11,7 +11,8 @@ import numpy as np
 from utils import hdi_of_mcmc
 from image_ops import rms_image
 from mojave import download_mojave_uv_fits, mojave_uv_fits_fname
-from spydiff import import_difmap_model, modelfit_difmap, clean_difmap
+from spydiff import (import_difmap_model, import_difmap_models,
+                     modelfit_difmap, clean_difmap)
 from uv_data import UVData
 from model import Model
 from bootstrap import CleanBootstrap
@@ -226,14 +227,14 @@ def coverage_of_model(original_uv_fits, original_mdl_file, outdir=None,
         for i, comp in enumerate(comps):
             comps_params0[i].extend(list(comp.p))
 
-        # Load bootstrap models
+        # Load bootstrap models as one (#boot, #comps, #params) table
         booted_mdl_paths = glob.glob(os.path.join(data_dir, dfm_model_fname + "_*"))
-        comps_params = {i: [] for i in range(len(comps))}
-        for booted_mdl_path in booted_mdl_paths:
-            path, booted_mdl_file = os.path.split(booted_mdl_path)
-            comps = import_difmap_model(booted_mdl_file, path)
-            for i, comp in enumerate(comps):
-                comps_params[i].extend(list(comp.p))
+        booted_params, _, _ = import_difmap_models(booted_mdl_paths)
+        comps_params = dict()
+        for i, comp in enumerate(comps):
+            # (#boot, #free parameters)
+            params = booted_params[:, i, :len(comp._parnames)][:, ~comp._fixed]
+            comps_params[i] = list(params.ravel())
 
         # Print 65-% intervals (1 sigma)
         for i, comp in enumerate(comps):
@@ -0,0 +1,454 @@
+import os
+import copy
+import math
+import pickle
+import hashlib
+import multiprocessing
+import numpy as np
+from scipy.cluster.vq import kmeans2
+from chains import _atomic_save
+
+
+class BatchPriorTransform(object):
+    """
+    Transform of points of unit hypercube to parameters using prior's ppf of
+    each parameter. Works with batches of points.
+
+    :param ppfs:
+        Iterable of callables (e.g. ``utils._function_wrapper`` of
+        ``scipy.stats.uniform.ppf``) that are vectorized over their argument.
+    """
+    def __init__(self, ppfs):
+        self.ppfs = list(ppfs)
+
+    def __call__(self, u):
+        u = np.atleast_2d(u)
+        assert u.shape[1] == len(self.ppfs)
+        v = np.empty(u.shape, dtype=float)
+        for j, ppf in enumerate(self.ppfs):
+            v[:, j] = ppf(u[:, j])
+        return v
+
+
+def share_likelihood(lnlik, model):
+    """
+    Returns copy of ``stats.LnLikelihood`` instance for other model that shares
+    arrays of visibilities, noise & uv-coordinates with ``lnlik``.
+    """
+    lnlik = copy.copy(lnlik)
+    lnlik.model = model
+    return lnlik
+
+
+def hypothesis_key(lnlik, prior_transform):
+    """
+    Returns hash that identifies data, model & prior of hypothesis. It is used
+    to check that checkpoint of ``nested_sample`` belongs to the same
+    hypothesis.
+
+    :param lnlik:
+        Instance of ``stats.LnLikelihood``.
+    :param prior_transform:
+        Instance of ``BatchPriorTransform`` or other callable.
+    """
+    sha = hashlib.sha1()
+    for array in (lnlik.uvdata, lnlik.error, lnlik.uv, lnlik.model._p_all,
+                  lnlik.model._fixed_all):
+        sha.update(np.ascontiguousarray(array).tostring())
+    sha.update(repr((lnlik.stokes, lnlik.average_freq, lnlik.amp_only,
+                     lnlik.size)))
+    sha.update(repr([component.__class__.__name__ for component in
+                     lnlik.model._components]))
+    if lnlik.jitter is not None:
+        sha.update(repr((lnlik.jitter.per, lnlik.jitter.names)))
+    for ppf in getattr(prior_transform, 'ppfs', [prior_transform]):
+        sha.update(repr((_callable_name(getattr(ppf, 'f', ppf)),
+                         getattr(ppf, 'args', None),
+                         getattr(ppf, 'kwargs', None))))
+    return sha.hexdigest()
+
+
+def _callable_name(f):
+    # Bound methods of ``scipy.stats`` distributions are named by distribution
+    owner = getattr(f, '__self__', None)
+    name = getattr(f, '__name__', f.__class__.__name__)
+    if owner is not None:
+        name = '{}.{}'.format(getattr(owner, 'name', owner.__class__.__name__),
+                              name)
+    return name
+
+
+class _Ellipsoid(object):
+    """
+    Ellipsoid that bounds points in unit hypercube enlarged by ``enlarge`` in
+    volume.
+
+    :param min_logvol: (optional)
+        Minimal ln of volume (in units of volume of unit ball). If ``None``
+        then don't limit. (default: ``None``)
+    """
+    def __init__(self, points, enlarge=1.2, min_logvol=None):
+        ndim = points.shape[1]
+        self.center = points.mean(axis=0)
+        cov = np.atleast_2d(np.cov(points, rowvar=False))
+        # Keep ellipsoid non-degenerate
+        cov += 10 ** (-12) * np.eye(ndim)
+        delta = points - self.center
+        d2 = np.einsum('ij,jk,ik->i', delta, np.linalg.inv(cov), delta).max()
+        self._axes = np.linalg.cholesky(cov * d2) * enlarge ** (1. / ndim)
+        self.logvol = np.sum(np.log(np.diag(self._axes)))
+        if min_logvol is not None and self.logvol < min_logvol:
+            self._axes *= math.exp((min_logvol - self.logvol) / ndim)
+            self.logvol = min_logvol
+
+    @property
+    def major_axis(self):
+        values, vectors = np.linalg.eigh(np.dot(self._axes, self._axes.T))
+        return vectors[:, -1] * math.sqrt(values[-1])
+
+    def contains(self, points):
+        x = np.linalg.solve(self._axes, (points - self.center).T)
+        return np.sum(x ** 2, axis=0) <= 1.
+
+    def sample(self, n, rstate):
+        ndim = len(self.center)
+        x = rstate.normal(size=(n, ndim))
+        x /= np.sqrt(np.sum(x ** 2, axis=1))[:, np.newaxis]
+        x *= rstate.uniform(size=(n, 1)) ** (1. / ndim)
+        return self.center + np.dot(x, self._axes.T)
+
+
+def _bounding_ellipsoids(points, ellipsoid, logpointvol, enlarge):
+    """
+    Recursively split ``points`` in two clusters (2-means started from the ends
+    of major axis of ``ellipsoid``) while total volume of their bounding
+    ellipsoids is less than half of volume of ``ellipsoid``. Volume of each
+    ellipsoid is not less than number of its points times ``exp(logpointvol)``.
+    """
+    npoints, ndim = points.shape
+    if npoints < 2 * ndim + 2:
+        return [ellipsoid]
+    start = np.vstack((ellipsoid.center - ellipsoid.major_axis,
+                       ellipsoid.center + ellipsoid.major_axis))
+    _, labels = kmeans2(points, start, iter=10, minit='matrix')
+    clusters = [points[labels == k] for k in (0, 1)]
+    if min(len(cluster) for cluster in clusters) < ndim + 1:
+        return [ellipsoid]
+    ellipsoids = [_Ellipsoid(cluster, enlarge,
+                             logpointvol + math.log(len(cluster)))
+                  for cluster in clusters]
+    if (np.logaddexp(ellipsoids[0].logvol, ellipsoids[1].logvol) >
+            ellipsoid.logvol + math.log(0.5)):
+        return [ellipsoid]
+    return (_bounding_ellipsoids(clusters[0], ellipsoids[0], logpointvol,
+                                 enlarge) +
+            _bounding_ellipsoids(clusters[1], ellipsoids[1], logpointvol,
+                                 enlarge))
+
+
+class _MultiEllipsoid(object):
+    """
+    Union of ellipsoids that bound clusters of points in unit hypercube (as
+    ``method='multi'`` of ``nestle``).
+
+    :param logvol: (optional)
+        Estimate of ln of volume of hypercube fraction occupied by points. It
+        sets minimal volume of ellipsoids of small clusters. (default: ``0``)
+    """
+    def __init__(self, points, enlarge=1.2, logvol=0.):
+        npoints, ndim = points.shape
+        ellipsoid = _Ellipsoid(points, enlarge)
+        # In units of volume of unit ball
+        logpointvol = (logvol - math.log(npoints) -
+                       0.5 * ndim * math.log(math.pi) +
+                       math.lgamma(0.5 * ndim + 1.))
+        self.ellipsoids = _bounding_ellipsoids(points, ellipsoid, logpointvol,
+                                               enlarge)
+        logvols = np.array([e.logvol for e in self.ellipsoids])
+        self._probs = np.exp(logvols - logvols.max())
+        self._probs /= self._probs.sum()
+
+    def sample(self, n, rstate):
+        """
+        Returns up to ``n`` points uniformly distributed in union of
+        ellipsoids.
+        """
+        indxs = rstate.choice(len(self.ellipsoids), size=n, p=self._probs)
+        u = np.empty((n, len(self.ellipsoids[0].center)))
+        for k, ellipsoid in enumerate(self.ellipsoids):
+            mask = indxs == k
+            u[mask] = ellipsoid.sample(np.count_nonzero(mask), rstate)
+        # Points in overlaps are kept with probability inverse to the number of
+        # ellipsoids that contain them
+        q = np.sum([ellipsoid.contains(u) for ellipsoid in self.ellipsoids],
+                   axis=0)
+        return u[rstate.uniform(size=n) * q < 1.]
+
+
+def resample_equal(samples, weights, rstate=None):
+    """
+    Returns equally weighted samples using systematic resampling.
+    """
+    if rstate is None:
+        rstate = np.random
+    n = len(weights)
+    positions = (rstate.uniform() + np.arange(n)) / n
+    cumsum = np.cumsum(weights)
+    cumsum /= cumsum[-1]
+    indxs = np.minimum(np.searchsorted(cumsum, positions), n - 1)
+    return samples[indxs]
+
+
+def nested_sample(loglikelihood, prior_transform, ndim, npoints=100,
+                  batch_size=None, dlogz=0.5, maxiter=None, method='single',
+                  enlarge=1.2, update_interval=None, rstate=None,
+                  checkpoint_file=None, checkpoint_every=100,
+                  checkpoint_key=None, callback=None):
+    """
+    Nested sampling with bounding ellipsoids where proposals of new live
+    points are evaluated in vectorized batches.
+
+    :param loglikelihood:
+        Callable that returns numpy array of ln of likelihood for 2D numpy
+        array of parameters with shape (#points, ``ndim``) (e.g.
+        ``stats.LnLikelihood.batch``).
+    :param prior_transform:
+        Callable that transforms 2D numpy array of points in unit hypercube to
+        parameters (e.g. ``BatchPriorTransform``).
+    :param ndim:
+        Number of parameters.
+    :param npoints: (optional)
+        Number of live points. (default: ``100``)
+    :param batch_size: (optional)
+        Number of proposals evaluated at once. If ``None`` then ``npoints``.
+        Proposals above current threshold are kept for the next iterations.
+        (default: ``None``)
+    :param dlogz: (optional)
+        Stop when estimate of remaining evidence is less than ``dlogz``.
+        (default: ``0.5``)
+    :param maxiter: (optional)
+        Maximal number of iterations. If ``None`` then no limit. (default:
+        ``None``)
+    :param method: (optional)
+        ``single`` - bound live points by one ellipsoid, ``multi`` - by union
+        of ellipsoids of clusters of live points as ``nestle`` does. Single
+        ellipsoid is inefficient for multimodal posteriors. (default:
+        ``single``)
+    :param enlarge: (optional)
+        Enlargement of bounding ellipsoid volume. (default: ``1.2``)
+    :param update_interval: (optional)
+        Number of iterations between updates of bounding ellipsoid. If
+        ``None`` then ``npoints / 10``. (default: ``None``)
+    :param rstate: (optional)
+        Instance of ``np.random.RandomState``. If ``None`` then use new one.
+        (default: ``None``)
+    :param checkpoint_file: (optional)
+        File to save state every ``checkpoint_every`` iterations. If it
+        exists and was saved for the same ``checkpoint_key`` and options of
+        sampler then sampling is resumed from the saved state, otherwise it is
+        started from scratch. File is removed when sampling is finished. If
+        ``None`` then don't checkpoint. (default: ``None``)
+    :param checkpoint_every: (optional)
+        Number of iterations between checkpoints. (default: ``100``)
+    :param checkpoint_key: (optional)
+        String that identifies likelihood & prior (e.g. result of
+        ``hypothesis_key``). If ``None`` then checkpoint is checked only
+        against options of sampler. (default: ``None``)
+    :param callback: (optional)
+        Callable that is called with dictionary of current state (keys ``it``,
+        ``logz``, ``ncall``) each iteration. (default: ``None``)
+    :return:
+        Dictionary with keys ``samples``, ``weights``, ``logl``, ``logz``,
+        ``logzerr``, ``h``, ``niter``, ``ncall`` similar to ``nestle.Result``.
+    """
+    if rstate is None:
+        rstate = np.random.RandomState()
+    if batch_size is None:
+        batch_size = npoints
+    if update_interval is None:
+        update_interval = max(1, npoints // 10)
+    if method not in ('single', 'multi'):
+        raise Exception("Method could be only single or multi!")
+    key = hashlib.sha1(repr((checkpoint_key, ndim, npoints, batch_size, method,
+                             enlarge, update_interval))).hexdigest()
+
+    state = None
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        with open(checkpoint_file, 'rb') as fo:
+            state = pickle.load(fo)
+        if state.get('key') == key:
+            rstate.set_state(state['rstate'])
+            print "Resuming nested sampling from iteration {}".format(
+                state['it'])
+        else:
+            print "Checkpoint {} was saved for other data, model or sampler" \
+                  " options. Starting from scratch".format(checkpoint_file)
+            state = None
+    if state is None:
+        live_u = rstate.uniform(size=(npoints, ndim))
+        live_v = prior_transform(live_u)
+        # Candidates are uniform in bounding ellipsoid and keep distribution
+        # uniform in constrained region if they are above the new threshold
+        state = {'key': key, 'live_u': live_u, 'live_v': live_v,
+                 'live_logl': np.asarray(loglikelihood(live_v), dtype=float),
+                 'cand_u': np.empty((0, ndim)), 'cand_v': np.empty((0, ndim)),
+                 'cand_logl': np.empty(0), 'bound': None,
+                 'saved_v': list(), 'saved_logl': list(),
+                 'saved_logwt': list(), 'logz': -1e300, 'h': 0., 'it': 0,
+                 'ncall': npoints,
+                 'logvol': math.log(1. - math.exp(-1. / npoints))}
+    live_u, live_v, live_logl = (state['live_u'], state['live_v'],
+                                 state['live_logl'])
+    cand_u, cand_v, cand_logl = (state['cand_u'], state['cand_v'],
+                                 state['cand_logl'])
+    ellipsoid = state['bound']
+    logz, h, it, ncall = state['logz'], state['h'], state['it'], state['ncall']
+    logvol = state['logvol']
+
+    while maxiter is None or it < maxiter:
+        worst = np.argmin(live_logl)
+        logl_star = live_logl[worst]
+        logwt = logvol + logl_star
+        logz_new = np.logaddexp(logz, logwt)
+        h = (math.exp(logwt - logz_new) * logl_star +
+             math.exp(logz - logz_new) * (h + logz) - logz_new)
+        logz = logz_new
+        state['saved_v'].append(live_v[worst].copy())
+        state['saved_logl'].append(logl_star)
+        state['saved_logwt'].append(logwt)
+
+        if ellipsoid is None or not it % update_interval:
+            if method == 'multi':
+                ellipsoid = _MultiEllipsoid(live_u, enlarge=enlarge,
+                                            logvol=-float(it) / npoints)
+            else:
+                ellipsoid = _Ellipsoid(live_u, enlarge=enlarge)
+        while True:
+            above = cand_logl > logl_star
+            if np.any(above):
+                i = np.flatnonzero(above)[0]
+                live_u[worst] = cand_u[i]
+                live_v[worst] = cand_v[i]
+                live_logl[worst] = cand_logl[i]
+                keep = above.copy()
+                keep[i] = False
+                cand_u, cand_v, cand_logl = (cand_u[keep], cand_v[keep],
+                                             cand_logl[keep])
+                break
+            u = ellipsoid.sample(batch_size, rstate)
+            u = u[np.all((u > 0.) & (u < 1.), axis=1)]
+            if not len(u):
+                continue
+            v = prior_transform(u)
+            logl = np.asarray(loglikelihood(v), dtype=float)
+            ncall += len(u)
+            cand_u, cand_v, cand_logl = (np.vstack((cand_u, u)),
+                                         np.vstack((cand_v, v)),
+                                         np.hstack((cand_logl, logl)))
+
+        logvol -= 1. / npoints
+        it += 1
+        if callback is not None:
+            callback({'it': it, 'logz': logz, 'ncall': ncall})
+        if checkpoint_file is not None and not it % checkpoint_every:
+            state.update({'live_u': live_u, 'live_v': live_v,
+                          'live_logl': live_logl, 'cand_u': cand_u,
+                          'cand_v': cand_v, 'cand_logl': cand_logl,
+                          'bound': ellipsoid, 'logz': logz, 'h': h,
+                          'it': it, 'ncall': ncall, 'logvol': logvol,
+                          'rstate': rstate.get_state()})
+            _atomic_save(checkpoint_file,
+                         lambda fo: pickle.dump(state, fo,
+                                                pickle.HIGHEST_PROTOCOL))
+
+        logz_remain = np.max(live_logl) - float(it) / npoints
+        if np.logaddexp(logz, logz_remain) - logz < dlogz:
+            break
+
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        os.unlink(checkpoint_file)
+
+    # Add remaining live points
+    logvol = -len(state['saved_v']) / float(npoints) - math.log(npoints)
+    saved_v = list(state['saved_v'])
+    saved_logl = list(state['saved_logl'])
+    saved_logwt = list(state['saved_logwt'])
+    for i in np.argsort(live_logl):
+        logwt = logvol + live_logl[i]
+        logz_new = np.logaddexp(logz, logwt)
+        h = (math.exp(logwt - logz_new) * live_logl[i] +
+             math.exp(logz - logz_new) * (h + logz) - logz_new)
+        logz = logz_new
+        saved_v.append(live_v[i])
+        saved_logl.append(live_logl[i])
+        saved_logwt.append(logwt)
+
+    return {'samples': np.array(saved_v), 'logl': np.array(saved_logl),
+            'weights': np.exp(np.array(saved_logwt) - logz), 'logz': logz,
+            'logzerr': math.sqrt(max(h, 0.) / npoints), 'h': h, 'niter': it,
+            'ncall': ncall}
+
+
+# Hypotheses of ``compare_hypotheses`` inherited by worker processes
+_hypotheses = dict()
+
+
+def _run_hypothesis(args):
+    key, kwargs = args
+    lnlik, prior_transform = _hypotheses[key]
+    print "Working on hypothesis: {}".format(key)
+    return key, nested_sample(lnlik.batch, prior_transform, lnlik.size,
+                              checkpoint_key=hypothesis_key(lnlik,
+                                                            prior_transform),
+                              **kwargs)
+
+
+def compare_hypotheses(lnliks, prior_transforms, processes=None,
+                       outdir=None, **kwargs):
+    """
+    Run nested sampling for several hypotheses (e.g. point, circular &
+    elliptical core) in parallel processes.
+
+    :param lnliks:
+        Dictionary with keys - names of hypotheses and values - instances of
+        ``stats.LnLikelihood``. Use ``share_likelihood`` to create them from
+        one compacted dataset.
+    :param prior_transforms:
+        Dictionary with the same keys and values - callables that transform
+        points of unit hypercube to parameters (e.g. ``BatchPriorTransform``).
+    :param processes: (optional)
+        Number of processes. If ``None`` then one process for each hypothesis
+        but not more than number of cores. (default: ``None``)
+    :param outdir: (optional)
+        Directory to keep checkpoints ``{name}_nested.pkl``. Checkpoint is
+        resumed only for the same data, model, prior & options of sampler (see
+        ``hypothesis_key``) and is removed when sampling of hypothesis is
+        finished. If ``None`` then don't checkpoint. (default: ``None``)
+    :param kwargs: (optional)
+        Any arguments passed to ``nested_sample``.
+    :return:
+        Dictionary with keys - names of hypotheses and values - results of
+        ``nested_sample``.
+    """
+    _hypotheses.clear()
+    tasks = list()
+    for key, lnlik in lnliks.items():
+        _hypotheses[key] = (lnlik, prior_transforms[key])
+        kwargs_ = dict(kwargs)
+        if outdir is not None:
+            kwargs_['checkpoint_file'] = os.path.join(outdir,
+                                                      '{}_nested.pkl'.format(key))
+        tasks.append((key, kwargs_))
+    if processes is None:
+        processes = min(len(tasks), multiprocessing.cpu_count())
+    if processes > 1:
+        # Workers are forked after ``_hypotheses`` is filled and inherit data
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_run_hypothesis, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_run_hypothesis, tasks)
+    return dict(results)
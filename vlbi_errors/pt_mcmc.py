@@ -1,6 +1,6 @@
 from uv_data import UVData
 from spydiff import import_difmap_model
-from stats import LnLikelihood, LnPrior
+from stats import LnLikelihood, LnPrior, SharedMemoryPool
 from model import Model
 from emcee import PTSampler, utils
 import scipy as sp
@@ -34,7 +34,9 @@ p0 = utils.sample_ball(model.p, [0.3, 0.1, 0.1, 0.003, 0.03, 0.1],
                        size=ntemps*nwalkers).reshape((ntemps, nwalkers, ndim))
 
 betas = np.exp(np.linspace(0, -(ntemps - 1) * 0.5 * np.log(2), ntemps))
-ptsampler = PTSampler(ntemps, nwalkers, ndim, lnlik, lnpr, betas=betas)
+pool = SharedMemoryPool(lnlik, lnpr)
+ptsampler = PTSampler(ntemps, nwalkers, ndim, lnlik, lnpr, betas=betas,
+                      pool=pool)
 
 
 # Burning in
@@ -48,6 +50,7 @@ for p, lnprob, lnlike in ptsampler.sample(p, lnprob0=lnprob,
                                           lnlike0=lnlike,
                                           iterations=10000, thin=10):
     pass
+pool.close()
 
 # # 0-temperature chain
 # mu0 = np.mean(np.mean(ptsampler.chain[0,...], axis=0), axis=0)
@@ -5,7 +5,7 @@ from model import Model
 from components import CGComponent, EGComponent, DeltaComponent
 from spydiff import import_difmap_model
 import scipy as sp
-from stats import LnLikelihood, LnPrior
+from stats import LnLikelihood, LnPrior, BatchPool
 import emcee
 import corner
 import matplotlib.pyplot as plt
@@ -107,7 +107,7 @@ def fit_model_with_ptmcmc(uv_fits, mdl_file, outdir=None, nburnin=1000,
     betas = np.exp(np.linspace(0, -(ntemps - 1) * 0.5 * np.log(2), ntemps))
     # Initialize sampler
     ptsampler = emcee.PTSampler(ntemps, nwalkers, ndim, lnlik, lnpr,
-                                betas=betas)
+                                betas=betas, pool=BatchPool())
 
     # Burning in
     print "Burnin"
@@ -0,0 +1,151 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from chains import _atomic_save
+
+
+def _to_json(obj):
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError("Can't hash parameter {!r}".format(obj))
+
+
+class ResultCache(object):
+    """
+    Content-addressed cache of files produced by ``difmap`` (FITS-files with
+    CLEAN images, difmap model files). Key is hash of contents of input files
+    and of parameters, so results are found for changed names of files and
+    could be shared by several pipelines using the same ``cache_dir``. The
+    least recently used entries are removed when cache grows beyond limits.
+
+    :param cache_dir:
+        Directory with cached files. Created if it doesn't exist.
+    :param max_size: (optional)
+        Maximum total size of cached files [bytes]. If ``None`` then don't
+        limit size. (default: ``None``)
+    :param max_entries: (optional)
+        Maximum number of cached files. If ``None`` then don't limit number.
+        (default: ``None``)
+    """
+    def __init__(self, cache_dir, max_size=None, max_entries=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_entries = max_entries
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Created by other process
+                if not os.path.isdir(cache_dir):
+                    raise
+        # Hashes of files keyed by (path, size, mtime)
+        self._file_hashes = dict()
+        self._lock = threading.Lock()
+
+    def file_hash(self, fname):
+        """
+        Returns SHA1 of file content.
+        """
+        stat = os.stat(fname)
+        file_key = (os.path.abspath(fname), stat.st_size, stat.st_mtime)
+        with self._lock:
+            if file_key in self._file_hashes:
+                return self._file_hashes[file_key]
+        sha = hashlib.sha1()
+        with open(fname, 'rb') as fo:
+            for chunk in iter(lambda: fo.read(1 << 20), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with self._lock:
+            self._file_hashes[file_key] = digest
+        return digest
+
+    def key(self, fnames, params):
+        """
+        Returns key of result.
+
+        :param fnames:
+            Iterable of input files. ``None`` values are skipped.
+        :param params:
+            Dictionary with parameters of run (numbers, strings and iterables
+            of them).
+        """
+        sha = hashlib.sha1()
+        for fname in fnames:
+            if fname is not None:
+                sha.update(self.file_hash(fname))
+        sha.update(json.dumps(params, sort_keys=True, default=_to_json))
+        return sha.hexdigest()
+
+    def _entry_path(self, key, ext):
+        return os.path.join(self.cache_dir, key + ext)
+
+    def get(self, key, out_fname):
+        """
+        Copy cached result to ``out_fname`` if it is in cache.
+
+        :param key:
+            Key of result.
+        :param out_fname:
+            Path to file where result should be.
+        :return:
+            ``out_fname`` if result was found in cache or ``None``.
+        """
+        entry = self._entry_path(key, os.path.splitext(out_fname)[1])
+        try:
+            # Modification time of entry is the time of the last use
+            os.utime(entry, None)
+            shutil.copyfile(entry, out_fname)
+        except (IOError, OSError):
+            return None
+        return out_fname
+
+    def put(self, key, fname):
+        """
+        Put result to cache.
+
+        :param key:
+            Key of result.
+        :param fname:
+            Path to file with result.
+        """
+        entry = self._entry_path(key, os.path.splitext(fname)[1])
+
+        def save(fo):
+            with open(fname, 'rb') as fi:
+                shutil.copyfileobj(fi, fo)
+
+        _atomic_save(entry, save)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries while cache exceeds limits.
+        """
+        if self.max_size is None and self.max_entries is None:
+            return
+        entries = list()
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith('.tmp'):
+                continue
+            path = os.path.join(self.cache_dir, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        n = len(entries)
+        for mtime, entry_size, path in entries:
+            if ((self.max_size is None or size <= self.max_size) and
+                    (self.max_entries is None or n <= self.max_entries)):
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            size -= entry_size
+            n -= 1
@@ -1,52 +1,116 @@
 import os
-import datetime
+import glob
+import hashlib
 import numpy as np
 import copy
 from utils import degree_to_rad
+from chains import _atomic_save
+from difmap_runner import DifmapRunner
 from components import DeltaComponent, CGComponent, EGComponent
 
 
+def get_difmap_runner(runner=None):
+    """
+    Returns ``runner`` or new ``DifmapRunner`` with default executable if
+    ``runner`` is ``None``.
+    """
+    if runner is None:
+        runner = DifmapRunner()
+    return runner
+
+
 def clean_n(fname, outfname, stokes, mapsize_clean, niter=100,
             path_to_script=None, mapsize_restore=None, beam_restore=None,
             outpath=None, shift=None, show_difmap_output=False,
-            txt_windows=None, clean_box=None):
+            txt_windows=None, clean_box=None, runner=None):
     if outpath is None:
         outpath = os.getcwd()
 
     if not mapsize_restore:
         mapsize_restore = mapsize_clean
 
-    difmapout = open("difmap_commands", "w")
-    difmapout.write("observe " + fname + "\n")
+    # ``difmap`` is run in temporary directory
+    commands = ["observe " + os.path.abspath(fname)]
     if txt_windows is not None:
-        difmapout.write("rwin " + str(txt_windows) + "\n")
+        commands.append("rwin " + os.path.abspath(str(txt_windows)))
 
     if clean_box is not None:
-        difmapout.write("addwin " + str(clean_box[0]) + ', ' +
+        commands.append("addwin " + str(clean_box[0]) + ', ' +
                         str(clean_box[1]) + ', ' + str(clean_box[2]) + ', ' +
-                        str(clean_box[3]) + "\n")
+                        str(clean_box[3]))
 
-    difmapout.write("mapsize " + str(mapsize_clean[0] * 2) + ', ' +
-                    str(mapsize_clean[1]) + "\n")
-    difmapout.write("@" + path_to_script + " " + stokes + ", " + str(niter) + "\n")
+    commands.append("mapsize " + str(mapsize_clean[0] * 2) + ', ' +
+                    str(mapsize_clean[1]))
+    commands.append("@" + os.path.abspath(path_to_script) + " " + stokes +
+                    ", " + str(niter))
     if beam_restore:
-        difmapout.write("restore " + str(beam_restore[0]) + ', ' +
-                        str(beam_restore[1]) + ', ' + str(beam_restore[2]) +
-                        "\n")
-    difmapout.write("mapsize " + str(mapsize_restore[0] * 2) + ', ' +
-                    str(mapsize_restore[1]) + "\n")
+        commands.append("restore " + str(beam_restore[0]) + ', ' +
+                        str(beam_restore[1]) + ', ' + str(beam_restore[2]))
+    commands.append("mapsize " + str(mapsize_restore[0] * 2) + ', ' +
+                    str(mapsize_restore[1]))
+    if shift is not None:
+        commands.append("shift " + str(shift[0]) + ', ' + str(shift[1]))
+    commands.append("wmap " + os.path.abspath(os.path.join(outpath, outfname)))
+    get_difmap_runner(runner).run(commands, name='clean_n',
+                                  show_output=show_difmap_output)
+
+
+def clean_difmap_commands(fname, outfname, stokes, mapsize_clean, path=None,
+                          path_to_script=None, mapsize_restore=None,
+                          beam_restore=None, outpath=None, shift=None,
+                          clean_box=None):
+    """
+    Returns list of ``difmap`` commands of ``clean_difmap``. Paths are
+    absolute.
+    """
+    if path is None:
+        path = os.getcwd()
     if outpath is None:
         outpath = os.getcwd()
+
+    if not mapsize_restore:
+        mapsize_restore = mapsize_clean
+
+    commands = ["observe " + os.path.abspath(os.path.join(path, fname))]
+    # if shift is not None:
+    #     commands.append("shift " + str(shift[0]) + ', ' + str(shift[1]))
+    commands.append("mapsize " + str(mapsize_clean[0] * 2) + ', ' +
+                    str(mapsize_clean[1]))
+    if clean_box is not None:
+        commands.append("addwin " + str(clean_box[0]) + ', ' +
+                        str(clean_box[1]) + ', ' + str(clean_box[2]) + ', ' +
+                        str(clean_box[3]))
+    commands.append("@" + os.path.abspath(path_to_script) + " " + stokes)
+    if beam_restore:
+        commands.append("restore " + str(beam_restore[0]) + ', ' +
+                        str(beam_restore[1]) + ', ' + str(beam_restore[2]))
+    commands.append("mapsize " + str(mapsize_restore[0] * 2) + ', ' +
+                    str(mapsize_restore[1]))
     if shift is not None:
-        difmapout.write("shift " + str(shift[0]) + ', ' + str(shift[1]) + "\n")
-    difmapout.write("wmap " + os.path.join(outpath, outfname) + "\n")
-    difmapout.write("exit\n")
-    difmapout.close()
-    # TODO: Use subprocess for silent cleaning?
-    shell_command = "difmap < difmap_commands 2>&1"
-    if not show_difmap_output:
-        shell_command += " >/dev/null"
-    os.system(shell_command)
+        commands.append("shift " + str(shift[0]) + ', ' + str(shift[1]))
+    commands.append("wmap " + os.path.abspath(os.path.join(outpath, outfname)))
+    commands.append("exit")
+    return commands
+
+
+def clean_difmap_key(cache, fname, stokes, mapsize_clean, path=None,
+                     path_to_script=None, mapsize_restore=None,
+                     beam_restore=None, shift=None, clean_box=None):
+    """
+    Returns key of ``clean_difmap`` result in ``result_cache.ResultCache``
+    instance ``cache``. It depends on contents of uv-data & script files and
+    on parameters of CLEAN.
+    """
+    if path is None:
+        path = os.getcwd()
+    if not mapsize_restore:
+        mapsize_restore = mapsize_clean
+    params = {'task': 'clean', 'stokes': stokes,
+              'mapsize_clean': mapsize_clean,
+              'mapsize_restore': mapsize_restore,
+              'beam_restore': beam_restore, 'shift': shift,
+              'clean_box': clean_box}
+    return cache.key([os.path.join(path, fname), path_to_script], params)
 
 
 # TODO: add ``shift`` argument, that shifts image before cleaning. It must be
@@ -55,7 +119,7 @@ def clean_n(fname, outfname, stokes, mapsize_clean, niter=100,
 def clean_difmap(fname, outfname, stokes, mapsize_clean, path=None,
                  path_to_script=None, mapsize_restore=None, beam_restore=None,
                  outpath=None, shift=None, show_difmap_output=False,
-                 command_file=None, clean_box=None):
+                 command_file=None, clean_box=None, runner=None, cache=None):
     """
     Map self-calibrated uv-data in difmap.
     :param fname:
@@ -89,52 +153,40 @@ def clean_difmap(fname, outfname, stokes, mapsize_clean, path=None,
     :param show_difmap_output: (optional)
         Show difmap output? (default: ``False``)
     :param command_file: (optional)
-        Script file name to store `difmap` commands. If ``None`` then use
-        ``difmap_commands``. (default: ``None``)
-
+        Ignored. Commands are written to temporary directory of the job.
+    :param runner: (optional)
+        Instance of ``difmap_runner.DifmapRunner``. If ``None`` then use
+        default executable. (default: ``None``)
+    :param cache: (optional)
+        Instance of ``result_cache.ResultCache``. If the same uv-data were
+        CLEANed with the same script & parameters then cached image is
+        copied to ``outfname`` without running ``difmap``. If ``None`` then
+        don't use cache. (default: ``None``)
+    :return:
+        Path to FITS-file with CCs.
     """
-    if path is None:
-        path = os.getcwd()
     if outpath is None:
         outpath = os.getcwd()
-
-    if not mapsize_restore:
-        mapsize_restore = mapsize_clean
-
-    if command_file is None:
-        command_file = "difmap_commands"
-
-    difmapout = open(command_file, "w")
-    difmapout.write("observe " + os.path.join(path, fname) + "\n")
-    # if shift is not None:
-    #     difmapout.write("shift " + str(shift[0]) + ', ' + str(shift[1]) + "\n")
-    difmapout.write("mapsize " + str(mapsize_clean[0] * 2) + ', ' +
-                    str(mapsize_clean[1]) + "\n")
-    if clean_box is not None:
-        difmapout.write("addwin " + str(clean_box[0]) + ', ' +
-                        str(clean_box[1]) + ', ' + str(clean_box[2]) + ', ' +
-                        str(clean_box[3]) + "\n")
-    difmapout.write("@" + path_to_script + " " + stokes + "\n")
-    if beam_restore:
-        difmapout.write("restore " + str(beam_restore[0]) + ', ' +
-                        str(beam_restore[1]) + ', ' + str(beam_restore[2]) +
-                        "\n")
-    difmapout.write("mapsize " + str(mapsize_restore[0] * 2) + ', ' +
-                    str(mapsize_restore[1]) + "\n")
-    if outpath is None:
-        outpath = path
-    elif not outpath.endswith("/"):
-        outpath = outpath + "/"
-    if shift is not None:
-        difmapout.write("shift " + str(shift[0]) + ', ' + str(shift[1]) + "\n")
-    difmapout.write("wmap " + os.path.join(outpath, outfname) + "\n")
-    difmapout.write("exit\n")
-    difmapout.close()
-    # TODO: Use subprocess for silent cleaning?
-    shell_command = "/home/osh/Soft/difmap_2.4l_p1/./difmap < " + command_file + " 2>&1"
-    if not show_difmap_output:
-        shell_command += " >/dev/null"
-    os.system(shell_command)
+    out_fname = os.path.abspath(os.path.join(outpath, outfname))
+    if cache is not None:
+        key = clean_difmap_key(cache, fname, stokes, mapsize_clean, path=path,
+                               path_to_script=path_to_script,
+                               mapsize_restore=mapsize_restore,
+                               beam_restore=beam_restore, shift=shift,
+                               clean_box=clean_box)
+        if cache.get(key, out_fname) is not None:
+            return out_fname
+    commands = clean_difmap_commands(fname, outfname, stokes, mapsize_clean,
+                                     path=path, path_to_script=path_to_script,
+                                     mapsize_restore=mapsize_restore,
+                                     beam_restore=beam_restore,
+                                     outpath=outpath, shift=shift,
+                                     clean_box=clean_box)
+    get_difmap_runner(runner).run(commands, name='clean',
+                                  show_output=show_difmap_output)
+    if cache is not None:
+        cache.put(key, out_fname)
+    return out_fname
 
 
 def import_difmap_model(mdl_fname, mdl_dir=None):
@@ -211,6 +263,191 @@ def import_difmap_model(mdl_fname, mdl_dir=None):
     return comps
 
 
+# Columns of parameters table returned by ``import_difmap_models``
+difmap_table_parnames = ['flux', 'x', 'y', 'bmaj', 'e', 'bpa']
+# Codes of component types in table returned by ``import_difmap_models``
+difmap_table_types = {0: DeltaComponent, 1: CGComponent, 2: EGComponent}
+
+
+def _parse_difmap_model(mdl):
+    """
+    Parse difmap-format model file to arrays without creating ``Component``
+    instances. Follows conventions of ``import_difmap_model``.
+
+    :param mdl:
+        Path to file with difmap model.
+    :return:
+        Tuple of 2D numpy array of parameters with shape (#comps, 6,), 1D
+        numpy array of type codes (see ``difmap_table_types``) and 2D boolean
+        numpy array of fixed parameters with shape (#comps, 6,).
+    """
+    with open(mdl) as mdlo:
+        lines = [line.split() for line in mdlo if not line.startswith('!')]
+    lines = [tokens for tokens in lines if tokens]
+    n = len(lines)
+    params = np.nan * np.ones((n, 6), dtype=float)
+    types = np.zeros(n, dtype=int)
+    fixed = np.zeros((n, 6), dtype=bool)
+    for i, tokens in enumerate(lines):
+        if len(tokens) == 3:
+            tokens = tokens + ['0.0', '1.0v', '0.0', '0']
+        elif len(tokens) not in (7, 9):
+            raise ValueError("Problem parsing line :\n{}".format(' '.join(tokens)))
+        flux, radius, theta, major, axial, phi, type_ = tokens[:7]
+        fixed[i, 0] = not flux.endswith('v')
+        params[i, 0] = float(flux.rstrip('v'))
+        radius = float(radius.rstrip('v'))
+        theta = np.deg2rad(float(theta.rstrip('v')))
+        params[i, 1] = -radius * np.sin(theta)
+        params[i, 2] = -radius * np.cos(theta)
+        if int(type_) == 0:
+            continue
+        elif int(type_) != 1:
+            raise NotImplementedError("Only CC, CG & EG are implemented")
+        fixed[i, 3] = not major.endswith('v')
+        params[i, 3] = float(major.rstrip('v'))
+        if float(axial.rstrip('v')) == 1:
+            types[i] = 1
+        else:
+            types[i] = 2
+            params[i, 4] = float(axial.rstrip('v'))
+            params[i, 5] = np.deg2rad(float(phi.rstrip('v'))) + np.pi / 2.
+    return params, types, fixed
+
+
+def _file_digest(path):
+    """
+    Returns SHA1 hash of file content.
+    """
+    with open(path, 'rb') as fo:
+        return hashlib.sha1(fo.read()).hexdigest()
+
+
+def _load_difmap_models_cache(cache_fname):
+    """
+    Load cache of parsed difmap models.
+
+    :return:
+        Dictionary with paths as keys and tuples (digest, params, types,
+        fixed) as values, where digest is SHA1 hash of model file content.
+    """
+    cache = dict()
+    try:
+        npz = np.load(cache_fname)
+    except (IOError, ValueError):
+        return cache
+    try:
+        bounds = np.cumsum(np.hstack(([0], npz['n_comps'])))
+        for i, path in enumerate(npz['paths']):
+            rows = slice(bounds[i], bounds[i + 1])
+            cache[str(path)] = (str(npz['digests'][i]), npz['params'][rows],
+                                npz['types'][rows], npz['fixed'][rows])
+    # Cache of older format
+    except KeyError:
+        cache = dict()
+    finally:
+        npz.close()
+    return cache
+
+
+def _save_difmap_models_cache(cache, cache_fname):
+    """
+    Atomically save cache of parsed difmap models. Silently skip if
+    directory is not writable.
+    """
+    paths = sorted(cache.keys())
+    entries = [cache[path] for path in paths]
+
+    def save(fo):
+        np.savez(fo, paths=np.array(paths),
+                 digests=np.array([e[0] for e in entries]),
+                 n_comps=np.array([len(e[2]) for e in entries], dtype=int),
+                 params=np.vstack([e[1] for e in entries] or
+                                  [np.empty((0, 6))]),
+                 types=np.hstack([e[2] for e in entries] or
+                                 [np.empty(0, dtype=int)]),
+                 fixed=np.vstack([e[3] for e in entries] or
+                                 [np.empty((0, 6), dtype=bool)]))
+
+    try:
+        _atomic_save(cache_fname, save)
+    except (IOError, OSError):
+        pass
+
+
+def import_difmap_models(mdl_fnames, mdl_dir=None, cache_fname=None):
+    """
+    Function that reads many difmap-format models (e.g. bootstrap replicas)
+    into one table of parameters without creating ``Component`` instances.
+
+    :param mdl_fnames:
+        Iterable of file names (or paths) of difmap models or glob-pattern
+        string (e.g. ``'mdl_booted_*.txt'``).
+    :param mdl_dir: (optional)
+        Directory with difmap models. If ``None`` then use CWD. (default:
+        ``None``)
+    :param cache_fname: (optional)
+        Path to binary cache of already parsed models. Files are re-parsed
+        only if SHA1 hash of their content has changed. Cache keeps only
+        models of the last call. If ``'auto'`` then use
+        ``.difmap_models_cache.npz`` in directory of the first model. If
+        ``None`` then don't use cache. (default: ``None``)
+    :return:
+        Tuple of 3D numpy array of parameters with shape (#models, #max comps,
+        6,) (columns are ``difmap_table_parnames``, coordinates [mas] & bpa
+        [rad] the same as in ``import_difmap_model``, absent values are
+        ``NaN``), 2D numpy array of component type codes with shape (#models,
+        #max comps,) (see ``difmap_table_types``, ``-1`` for absent
+        components) and 3D boolean numpy array of fixed parameters with the
+        same shape as parameters.
+    """
+    if mdl_dir is None:
+        mdl_dir = os.getcwd()
+    if isinstance(mdl_fnames, basestring):
+        mdl_paths = sorted(glob.glob(os.path.join(mdl_dir, mdl_fnames)))
+    else:
+        mdl_paths = [os.path.join(mdl_dir, fname) for fname in mdl_fnames]
+    mdl_paths = [os.path.abspath(path) for path in mdl_paths]
+
+    if cache_fname == 'auto':
+        cache_fname = None
+        if mdl_paths:
+            cache_fname = os.path.join(os.path.dirname(mdl_paths[0]),
+                                       '.difmap_models_cache.npz')
+    old_cache = dict()
+    if cache_fname is not None:
+        old_cache = _load_difmap_models_cache(cache_fname)
+
+    cache = dict()
+    tables = list()
+    for path in mdl_paths:
+        digest = _file_digest(path) if cache_fname is not None else None
+        try:
+            cached_digest, params, types, fixed = old_cache[path]
+            if cached_digest != digest:
+                raise KeyError
+        except KeyError:
+            params, types, fixed = _parse_difmap_model(path)
+        cache[path] = (digest, params, types, fixed)
+        tables.append((params, types, fixed))
+
+    # Save if any model was re-parsed or models of previous call are absent
+    if cache_fname is not None and (
+            set(cache) != set(old_cache) or
+            any(cache[path][0] != old_cache[path][0] for path in cache)):
+        _save_difmap_models_cache(cache, cache_fname)
+
+    n_comps = max([len(types) for _, types, _ in tables] or [0])
+    params_all = np.nan * np.ones((len(tables), n_comps, 6), dtype=float)
+    types_all = -np.ones((len(tables), n_comps), dtype=int)
+    fixed_all = np.zeros((len(tables), n_comps, 6), dtype=bool)
+    for i, (params, types, fixed) in enumerate(tables):
+        params_all[i, :len(types)] = params
+        types_all[i, :len(types)] = types
+        fixed_all[i, :len(types)] = fixed
+    return params_all, types_all, fixed_all
+
+
 def core_alpha_delta(mfile):
     fid = open(mfile)
     lines = fid.readlines()
@@ -540,9 +777,47 @@ def transform_component(difmap_model_file, new_type, freq_hz, comp_id=0,
     export_difmap_model(new_comps, outname, freq_hz)
 
 
+def modelfit_difmap_commands(fname, mdl_fname, out_fname, niter=50,
+                             stokes='i', path=None, mdl_path=None,
+                             out_path=None):
+    """
+    Returns list of ``difmap`` commands of ``modelfit_difmap``. Paths are
+    absolute.
+    """
+    if path is None:
+        path = os.getcwd()
+    if mdl_path is None:
+        mdl_path = os.getcwd()
+    if out_path is None:
+        out_path = os.getcwd()
+
+    return ["observe " + os.path.abspath(os.path.join(path, fname)),
+            "select " + stokes,
+            "rmodel " + os.path.abspath(os.path.join(mdl_path, mdl_fname)),
+            "modelfit " + str(niter),
+            "wmodel " + os.path.abspath(os.path.join(out_path, out_fname)),
+            "exit"]
+
+
+def modelfit_difmap_key(cache, fname, mdl_fname, niter=50, stokes='i',
+                       path=None, mdl_path=None):
+    """
+    Returns key of ``modelfit_difmap`` result in ``result_cache.ResultCache``
+    instance ``cache``. It depends on contents of uv-data & model files and
+    on parameters of fit.
+    """
+    if path is None:
+        path = os.getcwd()
+    if mdl_path is None:
+        mdl_path = os.getcwd()
+    params = {'task': 'modelfit', 'stokes': stokes, 'niter': niter}
+    return cache.key([os.path.join(path, fname),
+                      os.path.join(mdl_path, mdl_fname)], params)
+
+
 def modelfit_difmap(fname, mdl_fname, out_fname, niter=50, stokes='i',
                     path=None, mdl_path=None, out_path=None,
-                    show_difmap_output=False):
+                    show_difmap_output=False, runner=None, cache=None):
     """
     Modelfit self-calibrated uv-data in difmap.
 
@@ -563,31 +838,33 @@ def modelfit_difmap(fname, mdl_fname, out_fname, niter=50, stokes='i',
     :param out_path: (optional)
         Path to file with CCs. If ``None`` then use ``path``.
         (default: ``None``)
+    :param runner: (optional)
+        Instance of ``difmap_runner.DifmapRunner``. If ``None`` then use
+        default executable. (default: ``None``)
+    :param cache: (optional)
+        Instance of ``result_cache.ResultCache``. If the same uv-data were
+        fitted with the same model & parameters then cached model is copied
+        to ``out_fname`` without running ``difmap``. If ``None`` then don't
+        use cache. (default: ``None``)
+    :return:
+        Path to file with fitted model.
     """
-    if path is None:
-        path = os.getcwd()
-    if mdl_path is None:
-        mdl_path = os.getcwd()
     if out_path is None:
         out_path = os.getcwd()
-
-    stamp = datetime.datetime.now()
-    command_file = os.path.join(out_path, "difmap_commands_{}".format(stamp.isoformat()))
-    # difmapout = open("difmap_commands", "w")
-    difmapout = open(command_file, "w")
-    difmapout.write("observe " + os.path.join(path, fname) + "\n")
-    difmapout.write("select " + stokes + "\n")
-    difmapout.write("rmodel " + os.path.join(mdl_path, mdl_fname) + "\n")
-    difmapout.write("modelfit " + str(niter) + "\n")
-    difmapout.write("wmodel " + os.path.join(out_path, out_fname) + "\n")
-    difmapout.write("exit\n")
-    difmapout.close()
-
-    # TODO: Use subprocess?
-    shell_command = "/home/osh/Soft/difmap_2.4l_p1/./difmap < " + command_file + " 2>&1"
-    if not show_difmap_output:
-        shell_command += " >/dev/null"
-    os.system(shell_command)
+    out_file = os.path.abspath(os.path.join(out_path, out_fname))
+    if cache is not None:
+        key = modelfit_difmap_key(cache, fname, mdl_fname, niter=niter,
+                                  stokes=stokes, path=path, mdl_path=mdl_path)
+        if cache.get(key, out_file) is not None:
+            return out_file
+    commands = modelfit_difmap_commands(fname, mdl_fname, out_fname,
+                                        niter=niter, stokes=stokes, path=path,
+                                        mdl_path=mdl_path, out_path=out_path)
+    get_difmap_runner(runner).run(commands, name='modelfit',
+                                  show_output=show_difmap_output)
+    if cache is not None:
+        cache.put(key, out_file)
+    return out_file
 
 
 def make_map_with_core_at_zero(mdl_file, uv_fits_fname, mapsize_clean,
@@ -1,11 +1,37 @@
 import math
 #from model import Model
 import glob
+import copy
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 import numpy as np
 import scipy as sp
 from utils import is_sorted
 
 
+def rice_lnlik(model_amp, data_amp, inv_var):
+    """
+    Returns part of ln of Rice likelihood of amplitudes ``data_amp`` that
+    depends on model amplitudes ``model_amp``. Modified Bessel function is
+    evaluated in exponentially scaled form, so ``ln(I0(x)) = ln(ive(0, x)) +
+    x`` doesn't overflow for bright sources and ``x`` cancels with the
+    exponent of the Rice density.
+
+    :param model_amp:
+        Numpy array of model amplitudes.
+    :param data_amp:
+        Numpy array of data amplitudes broadcastable to ``model_amp``.
+    :param inv_var:
+        Numpy array of inverse variances of data (zero for masked data).
+    :return:
+        Numpy array of ``-(|M| - |D|)^2 / (2 sigma^2) + ln(ive(0, |M||D| /
+        sigma^2))``. Add ``sum(ln(|D|) - 2 ln(sigma))`` to get full ln of
+        likelihood.
+    """
+    return -0.5 * (model_amp - data_amp) ** 2. * inv_var +\
+        np.log(sp.special.ive(0., model_amp * data_amp * inv_var))
+
+
 class CrossValidation(object):
     """
     Class that implements cross-validation analysis of image-plane models.
@@ -69,12 +95,23 @@ class CrossValidation(object):
 
 # FIXME: For ``average_freq=True`` got shitty results
 class LnLikelihood(object):
+    """
+    ln of likelihood of visibilities for given model.
+
+    :param jitter: (optional)
+        Instance of ``model.Jitter``. If not ``None`` then noise of each
+        baseline is scaled by free factors which ln are the last parameters
+        after parameters of model. (default: ``None``)
+    """
     def __init__(self, uvdata, model, average_freq=True, amp_only=False,
-                 use_V=False, use_weights=False):
+                 use_V=False, use_weights=False, jitter=None):
         error = uvdata.error(average_freq=average_freq, use_V=use_V)
         self.amp_only = amp_only
         self.model = model
+        self.jitter = jitter
         self.data = uvdata
+        # (u, v) -coordinates are recalculated by ``UVData`` on each access
+        self.uv = uvdata.uv
         stokes = model.stokes
         self.stokes = stokes
         self.average_freq = average_freq
@@ -113,31 +150,138 @@ class LnLikelihood(object):
                 self.error = error[..., 1]
             else:
                 raise Exception("Working with only I, RR or LL!")
+        self._amp_terms = None
+        self._jitter_terms = None
+        if jitter is not None:
+            if amp_only:
+                raise Exception("Jitter works only with complex data!")
+            self._jitter_terms = self._get_jitter_terms()
+
+    @property
+    def size(self):
+        """
+        Number of parameters (of model & jitter).
+        """
+        if self.jitter is None:
+            return self.model.size
+        return self.model.size + self.jitter.size
+
+    @property
+    def _k(self):
+        # Stokes I is the average of two hands
+        if self.stokes == 'I':
+            return 2.
+        return 1.
+
+    def _get_jitter_terms(self):
+        """
+        Returns data-dependent terms of likelihood with jitter: filled data,
+        inverse variances (zero for masked data), index of baseline for each
+        data point, numbers of (not masked) data points on baselines and
+        constant part of ln of likelihood.
+        """
+        mask = np.ma.getmaskarray(self.uvdata) | np.ma.getmaskarray(self.error)
+        data = np.ma.filled(self.uvdata, 0.)
+        error = np.ma.filled(self.error, 1.)
+        inv_var = np.where(mask, 0., 1. / error ** 2.)
+        groups = self.jitter.group_indxs(self.data)
+        groups = np.broadcast_to(groups.reshape((-1,) + (1,) * (data.ndim - 1)),
+                                 data.shape).ravel()
+        counts = np.bincount(groups[~mask.ravel()],
+                             minlength=self.jitter.n_groups)
+        const = -self._k * np.sum(np.log(2. * math.pi * error ** 2.)[~mask])
+        return data, inv_var, groups, counts, const
+
+    def _group_sums(self, model_data):
+        """
+        Returns sums of squared normalized residuals on each baseline.
+
+        :param model_data:
+            Numpy array of model visibilities with shape (#sets, #data, ...).
+        :return:
+            Numpy array with shape (#sets, #baselines).
+        """
+        data, inv_var, groups, counts, const = self._jitter_terms
+        n_sets, n_groups = len(model_data), len(counts)
+        r = (np.absolute(data - model_data) ** 2. * inv_var).reshape((n_sets,
+                                                                      -1))
+        indxs = groups + n_groups * np.arange(n_sets)[:, np.newaxis]
+        return np.bincount(indxs.ravel(), r.ravel(),
+                           minlength=n_sets * n_groups).reshape((n_sets,
+                                                                 n_groups))
+
+    def _jitter_lnlik(self, model_data, p_jitter):
+        """
+        Returns ln of likelihood with jitter for sets of model visibilities
+        with shape (#sets, #data, ...) and jitter parameters with shape (#sets,
+        #jitter parameters). Data enter only through precomputed terms and
+        sums of residuals on baselines.
+        """
+        counts, const = self._jitter_terms[3:]
+        log_s = self.jitter.log_scales(p_jitter)
+        return const - self._k * np.sum(2. * counts * log_s +
+                                        0.5 * np.exp(-2. * log_s) *
+                                        self._group_sums(model_data), axis=1)
+
+    def amp_terms(self):
+        """
+        Returns data-dependent terms of Rice likelihood used with
+        ``amp_only=True``. They are calculated once on the first call.
+
+        :return:
+            Tuple of numpy arrays of data amplitudes and inverse variances
+            (zero for masked data) and constant part of ln of likelihood.
+        """
+        if self._amp_terms is None:
+            mask = np.ma.getmaskarray(self.uvdata) |\
+                np.ma.getmaskarray(self.error)
+            data_amp = np.absolute(np.ma.filled(self.uvdata, 1.))
+            error = np.ma.filled(self.error, 1.)
+            inv_var = np.where(mask, 0., 1. / error ** 2.)
+            const = np.sum((np.log(data_amp) - 2. * np.log(error))[~mask])
+            self._amp_terms = (data_amp, inv_var, const)
+        return self._amp_terms
+
+    def __getstate__(self):
+        # ``UVData`` instance keeps opened ``hdulist``. Only arrays prepared in
+        # constructor are needed to calculate likelihood.
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
 
     def __call__(self, p):
         """
         Returns ln of likelihood for data and model with parameters ``p``.
         :param p:
+            Iterable of free parameters of model or 2D numpy array with shape
+            (#sets, #free parameters,) (e.g. positions of all walkers).
         :return:
+            Value of ln of likelihood or numpy array of values for each set of
+            parameters.
         """
+        if np.ndim(p) == 2:
+            return self.batch(p)
         # print "calculating lnlik for ", p
         # Data visibilities and noise
         data = self.uvdata
         error = self.error
         # Model visibilities at uv-points of data
-        assert(self.model.size == len(p))
-        self.model.p = p[:]
-        model_data = self.model.ft(self.data.uv)
+        assert(self.size == len(p))
+        self.model.p = p[:self.model.size]
+        model_data = self.model.ft(self.uv)
+        # Without frequency averaging data has shape (#, #IF)
+        if np.ndim(data) > 1:
+            model_data = model_data[:, np.newaxis]
+        if self.jitter is not None:
+            return self._jitter_lnlik(model_data[np.newaxis],
+                                      np.atleast_2d(p[self.model.size:]))[0]
         # ln of data likelihood
         if self.amp_only:
-            model_amp = np.absolute(model_data)
-            data_amp = np.absolute(data)
             # FIXME: double data for stokes I conjugate
             # Use Rice distribution
-            lnlik = np.log(model_amp) - 2. * np.log(error) -\
-                    (model_amp ** 2. + data_amp ** 2.) / (2. * error ** 2.) +\
-                    np.log(sp.special.iv(0.,
-                                         (model_amp * data_amp / error ** 2.)))
+            data_amp, inv_var, const = self.amp_terms()
+            model_amp = np.absolute(model_data)
+            return const + rice_lnlik(model_amp, data_amp, inv_var).sum()
         else:
             # Use complex normal distribution
             k = 1.
@@ -152,45 +296,376 @@ class LnLikelihood(object):
             lnlik = lnlik.real
         return lnlik.sum()
 
+    def batch(self, p, chunk_size=32):
+        """
+        Returns ln of likelihood for data and model for many sets of
+        parameters. Model visibilities are calculated in one vectorized pass
+        for ``chunk_size`` sets at once. Model itself is not changed.
+        :param p:
+            2D numpy array with shape (#sets, #free parameters,).
+        :param chunk_size: (optional)
+            Number of sets of parameters to evaluate at once. Bounds memory
+            used for (#sets, #data,) arrays of model visibilities. (default:
+            ``32``)
+        :return:
+            Numpy array of ln of likelihood values for each set of parameters.
+        """
+        p = np.atleast_2d(p)
+        assert(self.size == p.shape[1])
+        n = self.model.size
+        # Masked data points are excluded from the sum
+        mask = np.ma.getmaskarray(self.uvdata) | np.ma.getmaskarray(self.error)
+        data = np.ma.filled(self.uvdata, 0.)
+        error = np.ma.filled(self.error, 1.)
+        if self.amp_only:
+            data_amp, inv_var, const = self.amp_terms()
+        k = 1.
+        if self.stokes == 'I':
+            k = 2.
+        lnliks = np.empty(len(p), dtype=float)
+        for start in xrange(0, len(p), chunk_size):
+            # (#chunk, #data)
+            model_data = self.model.ft_batch(p[start: start + chunk_size, :n],
+                                             self.uv)
+            # Without frequency averaging data has shape (#, #IF)
+            if data.ndim > 1:
+                model_data = model_data[..., np.newaxis]
+            if self.jitter is not None:
+                lnliks[start: start + chunk_size] =\
+                    self._jitter_lnlik(model_data,
+                                       p[start: start + chunk_size, n:])
+                continue
+            if self.amp_only:
+                # Masked data have zero inverse variance and contribute zero
+                lnlik = rice_lnlik(np.absolute(model_data), data_amp, inv_var)
+                lnliks[start: start + chunk_size] = const +\
+                    lnlik.reshape((len(lnlik), -1)).sum(axis=1)
+                continue
+            lnlik = k * (-np.log(2. * math.pi * error ** 2.) -
+                         np.absolute(data - model_data) ** 2. /
+                         (2. * error ** 2.))
+            lnlik[:, mask] = 0.
+            lnliks[start: start + chunk_size] =\
+                lnlik.reshape((len(lnlik), -1)).sum(axis=1)
+        return lnliks
+
+    def gradient(self, p):
+        """
+        Returns gradient of ln of likelihood for data and model with parameters
+        ``p``.
+        :param p:
+            Iterable of free parameters of model (and of jitter).
+        :return:
+            Numpy array with derivatives of ln of likelihood with respect to
+            ``p``.
+        """
+        data = self.uvdata
+        error = self.error
+        assert(self.size == len(p))
+        self.model.p = p[:self.model.size]
+        # (#, #free parameters)
+        jac = self.model.jacobian(self.uv)
+        model_data = self.model.ft(self.uv)
+        # Without frequency averaging data has shape (#, #IF)
+        if np.ndim(data) > 1:
+            model_data = model_data[:, np.newaxis]
+            jac = jac[:, np.newaxis, :]
+        if self.amp_only:
+            data_amp, inv_var, _ = self.amp_terms()
+            model_amp = np.absolute(model_data)
+            x = model_amp * data_amp * inv_var
+            # d(lnlik)/d|model| for the Rice distribution used in ``__call__``
+            dlnlik = (data_amp * sp.special.ive(1., x) / sp.special.ive(0., x) -
+                      model_amp) * inv_var
+            # d|model|/dp = Re(model* * dmodel/dp) / |model|
+            weights = dlnlik * model_data.conj() / model_amp
+        elif self.jitter is not None:
+            data, inv_var, groups, counts, _ = self._jitter_terms
+            log_s = self.jitter.log_scales(p[self.model.size:])
+            # Inverse variances scaled by jitter of baselines
+            inv_var = inv_var * np.exp(-2. * log_s)[groups].reshape(data.shape)
+            weights = self._k * (data - model_data).conj() * inv_var
+            dlog_s = self._k * (np.exp(-2. * log_s) *
+                                self._group_sums(model_data[np.newaxis])[0] -
+                                2. * counts)
+        else:
+            # d|data - model|^2/dp = -2 * Re((data - model)* * dmodel/dp)
+            weights = self._k * (data - model_data).conj() / error ** 2.
+        weights = np.ma.filled(weights, 0.)
+        gradient = np.real(weights[..., np.newaxis] * jac).reshape((-1,
+                                                                     jac.shape[-1])).sum(axis=0)
+        if self.jitter is not None:
+            gradient = np.hstack((gradient,
+                                  self.jitter.log_scales_gradient(dlog_s)))
+        return gradient
+
 
 class LnPrior(object):
-    def __init__(self, model):
+    def __init__(self, model, jitter=None):
         self.model = model
+        self.jitter = jitter
 
     def __call__(self, p):
-        self.model.p = p[:]
+        self.model.p = p[:self.model.size]
+        components = self.model.components
         distances = list()
-        for component in self.model._components:
+        for component in components:
             distances.append(np.sqrt(component.p[1] ** 2. +
                                      component.p[2] ** 2.))
         if not is_sorted(distances):
             print "Components are not sorted:("
             return -np.inf
         lnpr = list()
-        for component in self.model._components:
+        for component in components:
             # This is implemented in ``Model.p``
             # component.p = p[:component.size]
             # p = p[component.size:]
             #print "Got lnprior for component : ", component.lnpr
             lnpr.append(component.lnpr)
+        if self.jitter is not None:
+            lnpr.append(self.jitter.lnpr(p[self.model.size:]))
 
         return sum(lnpr)
 
+    def batch(self, p):
+        """
+        Returns ln of prior for many sets of parameters.
+        :param p:
+            2D numpy array with shape (#sets, #free parameters,).
+        """
+        return np.array([self(p_) for p_ in np.atleast_2d(p)], dtype=float)
+
 
 class LnPost(object):
     def __init__(self, uvdata, model, average_freq=True, use_V=False,
-                 use_weights=False):
+                 use_weights=False, jitter=None):
         self.lnlik = LnLikelihood(uvdata, model, average_freq=average_freq,
-                                  use_V=use_V, use_weights=use_weights)
-        self.lnpr = LnPrior(model)
+                                  use_V=use_V, use_weights=use_weights,
+                                  jitter=jitter)
+        self.lnpr = LnPrior(model, jitter=jitter)
 
     def __call__(self, p):
+        if np.ndim(p) == 2:
+            return self.batch(p)
         lnpr = self.lnpr(p[:])
         if not np.isfinite(lnpr):
             print "inf prior"
             return -np.inf
         return self.lnlik(p[:]) + lnpr
 
+    def batch(self, p):
+        """
+        Returns ln of posterior for many sets of parameters (e.g. positions of
+        all walkers of ensemble sampler). Likelihood is evaluated in one
+        vectorized pass only for sets with finite prior.
+        :param p:
+            2D numpy array with shape (#sets, #free parameters,).
+        """
+        p = np.atleast_2d(p)
+        lnpr = self.lnpr.batch(p)
+        lnpost = -np.inf * np.ones(len(p), dtype=float)
+        finite = np.isfinite(lnpr)
+        if np.any(finite):
+            lnpost[finite] = self.lnlik.batch(p[finite]) + lnpr[finite]
+        return lnpost
+
+
+def _batch_call(func, p):
+    """
+    Call ``batch`` method of ``func`` if it has one or ``func`` for each set
+    of parameters.
+    """
+    try:
+        batch = func.batch
+    except AttributeError:
+        return np.array([func(p_) for p_ in p])
+    return batch(p)
+
+
+class BatchPool(object):
+    """
+    Pool-like object for ``emcee`` samplers that evaluates ln of posterior
+    (likelihood & prior for ``PTSampler``) of all walkers in one vectorized
+    call of their ``batch`` methods.
+
+    :example:
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnpost,
+                                        pool=BatchPool())
+
+    :note:
+        ``emcee`` version 3 can use ``vectorize=True`` instead as ``LnPost``
+        and ``LnLikelihood`` accept 2D arrays of parameters.
+    """
+    def map(self, func, p):
+        p = np.array(list(p))
+        # ``PTSampler`` wraps ln of likelihood & prior in ``PTLikePrior``
+        if hasattr(func, 'logl') and hasattr(func, 'logp'):
+            if (func.loglargs or func.logpargs or func.loglkwargs or
+                    func.logpkwargs):
+                return map(func, p)
+            lnpr = _batch_call(func.logp, p)
+            lnlik = lnpr.copy()
+            finite = np.isfinite(lnpr)
+            if np.any(finite):
+                lnlik[finite] = _batch_call(func.logl, p[finite])
+            return zip(lnlik, lnpr)
+        # ``EnsembleSampler`` wraps ln of posterior in ``_function_wrapper``
+        if getattr(func, 'args', None) or getattr(func, 'kwargs', None):
+            return map(func, p)
+        return list(_batch_call(getattr(func, 'f', func), p))
+
+
+# Posterior of the worker process of ``SharedMemoryPool``
+_shared_lnpost = None
+
+
+def _shared_array(array, typecode='d'):
+    """
+    Copy numpy array to shared memory.
+    """
+    array = np.ascontiguousarray(array)
+    shared = RawArray(typecode, array.nbytes // np.dtype(typecode).itemsize)
+    np.frombuffer(shared, dtype=typecode)[:] =\
+        array.view(typecode).ravel()
+    return shared
+
+
+def _stripped_lnpost(lnlik, lnpr=None):
+    """
+    Returns posterior for workers of ``SharedMemoryPool`` with copy of
+    likelihood that doesn't hold data arrays (they are attached from shared
+    memory by ``_shared_worker_init``).
+    """
+    lnlik = copy.copy(lnlik)
+    lnlik.data = None
+    lnlik.uv = None
+    lnlik.uvdata = None
+    lnlik.error = None
+    lnlik._amp_terms = None
+    if lnlik.jitter is not None:
+        lnlik._jitter_terms = (None, None) + lnlik._jitter_terms[2:]
+    if lnpr is None:
+        lnpr = _FlatLnPrior()
+    lnpost = LnPost.__new__(LnPost)
+    lnpost.lnlik = lnlik
+    lnpost.lnpr = lnpr
+    return lnpost
+
+
+def _shared_worker_init(lnpost, shared, shapes):
+    """
+    Attach posterior of worker process to arrays in shared memory.
+    """
+    global _shared_lnpost
+    uv = np.frombuffer(shared['uv']).reshape(shapes['uv'])
+    data = np.frombuffer(shared['data']).view(complex).reshape(shapes['data'])
+    mask = np.frombuffer(shared['mask'], dtype='b').reshape(shapes['data'])
+    error = np.frombuffer(shared['error']).reshape(shapes['data'])
+    lnpost.lnlik.uv = uv
+    lnpost.lnlik.uvdata = np.ma.array(data, mask=mask.view(bool), copy=False)
+    lnpost.lnlik.error = error
+    if lnpost.lnlik.jitter is not None:
+        # Only baseline indexes, counts & constant were passed to worker
+        groups, counts, const = lnpost.lnlik._jitter_terms[2:]
+        inv_var = np.where(mask.view(bool), 0., 1. / error ** 2.)
+        lnpost.lnlik._jitter_terms = (data, inv_var, groups, counts, const)
+    _shared_lnpost = lnpost
+
+
+def _shared_worker_batch(args):
+    """
+    Returns ln of likelihood & prior for chunk of parameters in worker process.
+    """
+    p, chunk_size = args
+    lnpr = _shared_lnpost.lnpr.batch(p)
+    lnlik = lnpr.copy()
+    finite = np.isfinite(lnpr)
+    if np.any(finite):
+        lnlik[finite] = _shared_lnpost.lnlik.batch(p[finite],
+                                                   chunk_size=chunk_size)
+    return lnlik, lnpr
+
+
+class SharedMemoryPool(object):
+    """
+    Pool of worker processes for ``emcee`` samplers that evaluates ln of
+    posterior (likelihood & prior for ``PTSampler``) of walkers in parallel.
+    Compact uv-coordinates, visibilities & noise of likelihood are placed in
+    shared memory once and workers attach to them, so ``UVData`` is never
+    pickled.
+
+    :param lnlik:
+        Instance of ``LnLikelihood``.
+    :param lnpr: (optional)
+        Instance of ``LnPrior``. If ``None`` then use flat prior. (default:
+        ``None``)
+    :param processes: (optional)
+        Number of worker processes. If ``None`` then use all cores. (default:
+        ``None``)
+    :param chunk_size: (optional)
+        Number of sets of parameters each worker evaluates at once. (default:
+        ``32``)
+
+    :example:
+        pool = SharedMemoryPool(lnpost.lnlik, lnpost.lnpr)
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnpost, pool=pool)
+        ...
+        pool.close()
+
+    :note:
+        Function passed to ``map`` by sampler is used only to distinguish
+        ``PTSampler`` from ``EnsembleSampler``. Workers evaluate copies of
+        ``lnlik`` & ``lnpr`` made when pool was created.
+    """
+    def __init__(self, lnlik, lnpr=None, processes=None, chunk_size=32):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        mask = np.ma.getmaskarray(lnlik.uvdata) |\
+            np.ma.getmaskarray(lnlik.error)
+        shapes = {'uv': np.shape(lnlik.uv), 'data': mask.shape}
+        shared = {'uv': _shared_array(np.asarray(lnlik.uv, dtype=float)),
+                  'data': _shared_array(np.ma.filled(lnlik.uvdata,
+                                                     0.).astype(complex)),
+                  'mask': _shared_array(mask.view('b'), typecode='b'),
+                  'error': _shared_array(np.ma.filled(lnlik.error,
+                                                      1.).astype(float))}
+        self._pool = multiprocessing.Pool(self.processes,
+                                          initializer=_shared_worker_init,
+                                          initargs=(_stripped_lnpost(lnlik,
+                                                                     lnpr),
+                                                    shared, shapes))
+
+    def _evaluate(self, p):
+        p = np.array(list(p))
+        chunks = [chunk for chunk in np.array_split(p, self.processes) if
+                  len(chunk)]
+        results = self._pool.map(_shared_worker_batch,
+                                 [(chunk, self.chunk_size) for chunk in
+                                  chunks])
+        lnlik = np.hstack([result[0] for result in results])
+        lnpr = np.hstack([result[1] for result in results])
+        return lnlik, lnpr
+
+    def map(self, func, p):
+        lnlik, lnpr = self._evaluate(p)
+        # ``PTSampler`` wraps ln of likelihood & prior in ``PTLikePrior``
+        if hasattr(func, 'logl') and hasattr(func, 'logp'):
+            return zip(lnlik, lnpr)
+        return list(lnlik + lnpr)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+class _FlatLnPrior(object):
+    def batch(self, p):
+        return np.zeros(len(p), dtype=float)
+
 
 if __name__ == '__main__':
     # Test LS_estimates
@@ -215,10 +690,10 @@ if __name__ == '__main__':
     # Nelder-Mead simplex algorithm
     p_ml = fmin(lambda p: -lnlik(p), mdl.p)
     # Various methods of minimization (some require jacobians)
-    # TODO: Implement analitical grad of likelihood (it's gaussian)
     fit = minimize(lambda p: -lnlik(p), mdl.p, method='L-BFGS-B',
+                   jac=lambda p: -lnlik.gradient(p),
                    options={'maxiter': 30000, 'maxfev': 1000000, 'xtol': 0.001,
-                            'ftol': 0.001, 'approx_grad': True},
+                            'ftol': 0.001},
                    bounds=[(0., 2), (None, None), (None, None), (0., +np.inf),
                            (0., 1.), (None, None),
                            (0., 2), (None, None), (None, None), (0., 5),
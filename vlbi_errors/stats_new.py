@@ -81,15 +81,16 @@ class LnPrior(object):
 
     def __call__(self, p):
         self.model.p = p[:-1]
+        components = self.model.components
         distances = list()
-        for component in self.model._components:
+        for component in components:
             distances.append(np.sqrt(component.p[1] ** 2. +
                                      component.p[2] ** 2.))
         if not is_sorted(distances):
             print "Components are not sorted:("
             return -np.inf
         lnpr = list()
-        for component in self.model._components:
+        for component in components:
             lnpr.append(component.lnpr)
         lnpr.append(sp.stats.uniform.logpdf(p[-1], 0, 2))
 
@@ -132,7 +133,7 @@ if __name__ == '__main__':
     lnlik = LnLikelihood(uvdata, mdl)
     lnpr = LnPrior(mdl)
     lnpost = LnPost(uvdata, mdl)
-    p = mdl.p + [0.04]
+    p = list(mdl.p) + [0.04]
     print lnpr(p)
     print lnlik(p)
     print lnpost(p)
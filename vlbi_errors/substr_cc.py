@@ -20,7 +20,7 @@ clean_difmap(uv_fits, 'cc.fits', 'I', (1024, 0.03), path=data_dir,
              outpath=data_dir)
 
 model = create_model_from_fits_file(os.path.join(data_dir, 'cc.fits'))
-comps = model._components
+comps = model.components
 comps = sorted(comps, key=lambda x: np.sqrt(x._p[1]**2 + x._p[2]**2),
                reverse=True)
 
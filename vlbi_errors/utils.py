@@ -10,6 +10,7 @@ import string
 from math import floor
 from scipy import optimize
 from scipy.stats import scoreatpercentile
+from scipy.special import logsumexp
 from sklearn.mixture import GMM
 from sklearn.grid_search import GridSearchCV
 from sklearn.neighbors import KernelDensity
@@ -17,6 +18,7 @@ from sklearn import svm
 from sklearn.covariance import EllipticEnvelope, MinCovDet
 from sklearn.cluster import DBSCAN
 from sklearn.preprocessing import StandardScaler
+from sklearn.utils import check_random_state
 from skimage import transform
 from scipy.ndimage import interpolation
 try:
@@ -170,6 +172,143 @@ def fit_kde(data):
     return grid.best_estimator_
 
 
+class GaussianKDE(object):
+    """
+    1D gaussian KDE with fixed bandwidth. Has ``sample`` & ``score_samples``
+    methods as ``sklearn.neighbors.KernelDensity``.
+
+    :param data:
+        Numpy array.
+    :param bandwidth:
+        Bandwidth of gaussian kernel.
+    """
+    def __init__(self, data, bandwidth):
+        self.data = np.asarray(data, dtype=float).ravel()
+        self.bandwidth = bandwidth
+
+    def sample(self, n_samples=1, random_state=None):
+        """
+        Returns numpy array with shape (``n_samples``, 1) of random samples.
+        """
+        random_state = check_random_state(random_state)
+        indxs = random_state.randint(0, len(self.data), n_samples)
+        return (self.data[indxs] + self.bandwidth *
+                random_state.normal(size=n_samples))[:, np.newaxis]
+
+    def score_samples(self, X):
+        """
+        Returns ln of density for numpy array with shape (#points, 1).
+        """
+        x = np.asarray(X, dtype=float)[:, 0]
+        d = (x[:, np.newaxis] - self.data[np.newaxis, :]) / self.bandwidth
+        return logsumexp(-0.5 * d ** 2, axis=1) -\
+            math.log(len(self.data) * self.bandwidth * math.sqrt(2. * math.pi))
+
+
+def _grouped_scales(data, groups, n_groups):
+    """
+    Returns numbers of data points and robust scales ``min(std, IQR / 1.349)``
+    of data in each group.
+    """
+    n = np.bincount(groups, minlength=n_groups).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.bincount(groups, data, minlength=n_groups) / n
+        var = (np.bincount(groups, data ** 2, minlength=n_groups) / n -
+               mean ** 2) * n / (n - 1.)
+    std = np.sqrt(np.maximum(var, 0.))
+    iqr = grouped_quantile(data, groups, 0.75, n_groups) -\
+        grouped_quantile(data, groups, 0.25, n_groups)
+    scale = np.where(iqr > 0, np.minimum(std, iqr / 1.349), std)
+    scale[n < 2] = np.nan
+    return n, scale
+
+
+def silverman_bandwidths(data, groups):
+    """
+    Returns Silverman's rule-of-thumb bandwidths of gaussian KDE for data of
+    each group.
+
+    :param data:
+        Numpy array of real values.
+    :param groups:
+        Numpy array of integer group indexes of data points.
+    :return:
+        Numpy array of bandwidths (``nan`` for groups with less than 2 points).
+    """
+    n, scale = _grouped_scales(data, groups, groups.max() + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 0.9 * scale * n ** (-0.2)
+
+
+def _binned_psi(counts, delta, g, r):
+    """
+    Returns binned estimates of density functionals ``psi_r`` (r = 4 or 6)
+    with gaussian kernel of bandwidth ``g`` for each row of ``counts``
+    (#groups, #bins) with bin widths ``delta``. Sums over pairs of bins are
+    convolutions calculated with FFT.
+    """
+    n_groups, n_bins = counts.shape
+    x = np.arange(-(n_bins - 1), n_bins)[np.newaxis, :] *\
+        (delta / g)[:, np.newaxis]
+    if r == 4:
+        hermite = x ** 4 - 6. * x ** 2 + 3.
+    else:
+        hermite = x ** 6 - 15. * x ** 4 + 45. * x ** 2 - 15.
+    kernel = hermite * np.exp(-0.5 * x ** 2) / math.sqrt(2. * math.pi) /\
+        g[:, np.newaxis] ** (r + 1)
+    size = 2 ** int(np.ceil(np.log2(3 * n_bins - 2)))
+    conv = np.fft.irfft(np.fft.rfft(counts, size) * np.fft.rfft(kernel, size),
+                        size)[:, n_bins - 1: 2 * n_bins - 1]
+    n = counts.sum(axis=1)
+    return np.sum(counts * conv, axis=1) / n ** 2
+
+
+def plugin_bandwidths(data, groups, n_bins=401):
+    """
+    Returns two-stage direct plug-in (Sheather & Jones, Wand & Jones)
+    bandwidths of gaussian KDE for data of each group. Density functionals
+    are estimated for all groups at once on binned data using FFT.
+    Silverman's bandwidth is used for groups where plug-in fails.
+
+    :param data:
+        Numpy array of real values.
+    :param groups:
+        Numpy array of integer group indexes of data points.
+    :param n_bins: (optional)
+        Number of bins for each group. (default: ``401``)
+    :return:
+        Numpy array of bandwidths (``nan`` for groups with less than 2 points).
+    """
+    n_groups = groups.max() + 1
+    n, scale = _grouped_scales(data, groups, n_groups)
+    lo = np.inf * np.ones(n_groups)
+    hi = -np.inf * np.ones(n_groups)
+    np.minimum.at(lo, groups, data)
+    np.maximum.at(hi, groups, data)
+    ok = (n >= 2) & (np.nan_to_num(scale) > 0) & (hi > lo)
+    delta = np.where(ok, hi - lo, 1.) / (n_bins - 1.)
+    bins = np.rint((data - lo[groups]) / delta[groups]).astype(int)
+    bins[~ok[groups]] = 0
+    counts = np.bincount(groups * n_bins + bins,
+                         minlength=n_groups * n_bins).reshape((n_groups,
+                                                               n_bins))
+    counts = counts.astype(float)
+    scale = np.where(ok, scale, 1.)
+    n_ = np.maximum(n, 1.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Normal reference for psi_8
+        psi8 = 105. / (32. * math.sqrt(math.pi) * scale ** 9)
+        g1 = (30. / (math.sqrt(2. * math.pi) * psi8 * n_)) ** (1. / 9.)
+        psi6 = _binned_psi(counts, delta, g1, 6)
+        g2 = (-6. / (math.sqrt(2. * math.pi) * psi6 * n_)) ** (1. / 7.)
+        psi4 = _binned_psi(counts, delta, np.where(psi6 < 0, g2, g1), 4)
+        h = (1. / (2. * math.sqrt(math.pi) * psi4 * n_)) ** 0.2
+    silverman = 0.9 * scale * n_ ** (-0.2)
+    h = np.where((psi6 < 0) & (psi4 > 0) & np.isfinite(h), h, silverman)
+    h[~ok] = np.nan
+    return h
+
+
 def fit_2d_kde(cdata):
     """
     Fit 2D density, representing number of points on complex plane with gaussian
@@ -298,6 +437,98 @@ def find_outliers_dbscan(data, eps, min_samples):
     return db.labels_ == -1
 
 
+def grouped_quantile(data, groups, q, n_groups=None):
+    """
+    Returns quantiles of data in each group using one sort of all data.
+
+    :param data:
+        Numpy array of real values.
+    :param groups:
+        Numpy array of integer group indexes of data points.
+    :param q:
+        Quantile in ``[0, 1]``. Linear interpolation between data points is
+        used as in ``np.percentile``.
+    :param n_groups: (optional)
+        Number of groups. If ``None`` then ``max(groups) + 1``. (default:
+        ``None``)
+    :return:
+        Numpy array of quantiles with ``nan`` for empty groups.
+    """
+    if n_groups is None:
+        n_groups = groups.max() + 1
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    sorted_data = data[np.lexsort((data, groups))]
+    result = np.nan * np.ones(n_groups)
+    nonempty = counts > 0
+    pos = (starts + q * (counts - 1))[nonempty]
+    lo = np.floor(pos).astype(int)
+    hi = np.ceil(pos).astype(int)
+    frac = pos - lo
+    result[nonempty] = (1. - frac) * sorted_data[lo] + frac * sorted_data[hi]
+    return result
+
+
+def grouped_median(data, groups, n_groups=None):
+    """
+    Returns medians of data in each group using one sort of all data. See
+    ``grouped_quantile``.
+    """
+    return grouped_quantile(data, groups, 0.5, n_groups=n_groups)
+
+
+def find_outliers_grouped(data, groups, method='mad', threshold=5.):
+    """
+    Found outliers in complex data of many groups (e.g. baselines/IFs/Stokes)
+    at once using robust statistics.
+
+    :param data:
+        Complex numpy array.
+    :param groups:
+        Numpy array of integer group indexes of data points.
+    :param method: (optional)
+        ``mad`` - data points with Re or Im further than ``threshold`` robust
+        std (estimated with MAD) from median of group are outliers.
+        ``mahalanobis`` - data points with Mahalanobis distance larger than
+        ``threshold`` are outliers. Covariance of Re & Im of group is
+        estimated using points that are not ``mad`` outliers. (default:
+        ``mad``)
+    :param threshold: (optional)
+        Threshold in units of robust std. (default: ``5``)
+    :return:
+        Boolean numpy array with outliers.
+    """
+    n_groups = groups.max() + 1
+    reim = np.vstack((data.real, data.imag))
+    deviations = list()
+    scaled = list()
+    for x in reim:
+        dx = x - grouped_median(x, groups, n_groups)[groups]
+        mad = grouped_median(np.abs(dx), groups, n_groups)[groups]
+        deviations.append(dx)
+        # Zero MAD (e.g. zero data) gives no outliers
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scaled.append(np.where(mad > 0, np.abs(dx) / (1.4826 * mad), 0.))
+    outliers = np.logical_or(scaled[0] > threshold, scaled[1] > threshold)
+    if method == 'mad':
+        return outliers
+    elif method != 'mahalanobis':
+        raise Exception("Method could be mad or mahalanobis!")
+
+    # Covariance of inliers of each group from grouped sums
+    dx, dy = deviations
+    w = (~outliers).astype(float)
+    n = np.maximum(np.bincount(groups, w, minlength=n_groups) - 1., 1.)
+    cxx = np.bincount(groups, w * dx * dx, minlength=n_groups) / n
+    cyy = np.bincount(groups, w * dy * dy, minlength=n_groups) / n
+    cxy = np.bincount(groups, w * dx * dy, minlength=n_groups) / n
+    det = cxx * cyy - cxy ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d2 = (cyy[groups] * dx ** 2 - 2. * cxy[groups] * dx * dy +
+              cxx[groups] * dy ** 2) / det[groups]
+    return np.where(det[groups] > 0, d2 > threshold ** 2, False)
+
+
 def make_ellipses(gmm, ax, colors="rgbyk"):
     """
     Add ellipses representing components of Gaussian Mixture Model.
@@ -1471,6 +1702,28 @@ def hdi_of_mcmc(sample_vec, cred_mass=0.95, return_mean_median=False):
         return hdi_min, hdi_max
 
 
+def hdi_of_samples(samples, cred_mass=0.95):
+    """
+    Highest density intervals of each column of 2D array of samples.
+    Vectorized version of ``hdi_of_mcmc``.
+
+    :param samples:
+        Numpy array with shape (#samples, #statistics).
+    :param cred_mass: (optional)
+        Credible mass of intervals. (default: ``0.95``)
+    :return:
+        Numpy arrays of lower & upper endpoints of intervals.
+    """
+    sorted_pts = np.sort(samples, axis=0)
+    n = len(sorted_pts)
+    ci_idx_inc = int(np.floor(cred_mass * n))
+    ci_width = sorted_pts[ci_idx_inc:] - sorted_pts[:n - ci_idx_inc]
+    min_idx = np.argmin(ci_width, axis=0)
+    columns = np.arange(sorted_pts.shape[1])
+    return (sorted_pts[min_idx, columns],
+            sorted_pts[min_idx + ci_idx_inc, columns])
+
+
 def bc_endpoint(sample_vec, sample_val, alpha):
     """
     Function that calculates Bias Corrected bootstrap confidence interval
@@ -45,6 +45,7 @@ class UVData(object):
 
         self._error = None
         self._scans_bl = None
+        self._scan_index = None
         self._stokes = None
         self._times = None
 
@@ -615,6 +616,31 @@ class UVData(object):
             self._scans_bl = scans_dict
         return self._scans_bl
 
+    @property
+    def scan_index(self):
+        """
+        Compact index of scans of all baselines. Scan of baseline ends where
+        gap between successive visibilities of that baseline is longer than
+        100 s (as ``eps`` of DBSCAN in ``scans_bl``). Scans are numbered in
+        order of baselines and time, so scans of each baseline have
+        successive numbers.
+
+        :return:
+            Numpy integer array with shape (#vis,) with number of scan of each
+            visibility in ``uvdata`` array.
+        """
+        if self._scan_index is None:
+            times = self.hdu.data['DATE'] + self.hdu.data['_DATE']
+            baselines = self.hdu.data['BASELINE']
+            order = np.lexsort((times, baselines))
+            new_scan = np.ones(len(order), dtype=bool)
+            new_scan[1:] = (np.diff(baselines[order]) != 0) |\
+                (np.diff(times[order]) > TimeDelta(100., format='sec').jd)
+            scan_index = np.empty(len(order), dtype=int)
+            scan_index[order] = np.cumsum(new_scan) - 1
+            self._scan_index = scan_index
+        return self._scan_index
+
     def _downscale_uvw_by_frequency(self):
         suffix = '--'
         try:
@@ -1079,7 +1105,8 @@ class UVData(object):
 
         return baselines_noises
 
-    def noise_add(self, noise=None, df=None, split_scans=False):
+    def noise_add(self, noise=None, df=None, split_scans=False,
+                  random_state=None):
         """
         Add noise to visibilities. Here std - standard deviation of
         real/imaginary component.
@@ -1100,7 +1127,13 @@ class UVData(object):
             Is parameter ``noise`` is mapping from baseline numbers to
             iterables of std of noise for each scan on baseline? (default:
             ``False``)
+
+        :param random_state: (optional)
+            Instance of ``np.random.RandomState`` to draw noise from. If
+            ``None`` then use global state. (default: ``None``)
         """
+        if random_state is None:
+            random_state = np.random
 
         # TODO: if on df before generating noise values
         for baseline, baseline_stds in noise.items():
@@ -1116,10 +1149,10 @@ class UVData(object):
                     n = len(baseline_uvdata)
                     sl = self._get_uvdata_slice(baselines=[baseline], bands=[i],
                                                 stokes=[stokes])
-                    noise_to_add = vec_complex(np.random.normal(scale=std,
-                                                                size=n),
-                                               np.random.normal(scale=std,
-                                                                size=n))
+                    noise_to_add = vec_complex(random_state.normal(scale=std,
+                                                                   size=n),
+                                               random_state.normal(scale=std,
+                                                                   size=n))
                     noise_to_add = np.reshape(noise_to_add,
                                               baseline_uvdata.shape)
                     baseline_uvdata += noise_to_add
@@ -1347,34 +1380,14 @@ class UVData(object):
 
         self_copy = copy.deepcopy(self)
 
-        assert(self.nif == np.shape(gains.nif))
-        # TODO: Now we need this to calculating gain * gains*. But try to
-        # exclude this assertion
-        assert(self.nstokes == 4)
-
-        for t in set(self.hdu.columns[self.par_dict['DATE']].array):
-
-            # Find all uv-data entries with time t:
-            indxs = np.where(self.hdu.columns[self.par_dict['DATE']].array
-                             == t)[0]
-            # Loop through uv_indxs (different baselines with the same ``t``)
-            # and multiply visibility with baseline ant1-ant2 to
-            # gain(ant1)*gain(ant2)^*.
-            for indx in indxs:
-                bl = self.hdu.columns[self.par_dict['BASELINE']].array[indx]
-                try:
-                    gains12 = gains.find_gains_for_baseline(t, bl)
-                # If gains is the instance of ``Absorber`` class
-                except AttributeError:
-                    gains12 = gains.absorbed_gains.find_gains_for_baseline(t,
-                                                                           bl)
-                # FIXME: In substitute() ['hands'] then [indxs] does return
-                # view.
-                # print "gains12 :"
-                # print gains12
-                # Doesn't it change copying? Order of indexing [][] has changed
-                self_copy.uvdata[indx] *= gains12.T
-        self_copy.sync()
+        # If gains is the instance of ``Absorber`` class
+        gains = getattr(gains, 'absorbed_gains', gains)
+        t = self.hdu.columns[self.par_dict['DATE']].array
+        baselines = self.hdu.columns[self.par_dict['BASELINE']].array
+        # Multiply visibilities of all baselines ant1-ant2 to
+        # gain(ant1)*gain(ant2)^* at once
+        self_copy.uvdata = self.uvdata * gains.baseline_gains(t, baselines,
+                                                              self.stokes)
 
         return self_copy
 
@@ -9,7 +9,8 @@ from from_fits import (create_model_from_fits_file,
                        create_image_from_fits_file,
                        get_fits_image_info)
 from bootstrap import CleanBootstrap
-from spydiff import clean_difmap
+from spydiff import clean_difmap, clean_difmap_commands
+from difmap_runner import DifmapRunner
 from utils import mas_to_rad, degree_to_rad
 from images import Images
 from image import plot
@@ -278,7 +279,8 @@ def generate_boot_data(sources, epochs, bands, stokes, n_boot=10,
 
 
 def clean_boot_data(sources, epochs, bands, stokes, base_path=None,
-                    path_to_script=None, pixels_per_beam=None, imsize=None):
+                    path_to_script=None, pixels_per_beam=None, imsize=None,
+                    runner=None):
     """
     :param sources:
         Iterable of sources names.
@@ -304,12 +306,19 @@ def clean_boot_data(sources, epochs, bands, stokes, base_path=None,
     :param mapsize_restore: (optional)
         Parameters of map for restoring CC (map size, pixel size). If
         ``None`` then use ``mapsize_clean``. (default: ``None``)
+    :param runner: (optional)
+        Instance of ``difmap_runner.DifmapRunner``. Bootstrapped data are
+        CLEANed by its ``n_jobs`` concurrent jobs (by persistent ``difmap``
+        sessions if its ``sessions`` is ``True``). If ``None`` then use
+        default ``difmap`` executable and CLEAN serially. (default: ``None``)
 
     """
     if base_path is None:
         base_path = os.getcwd()
     elif not base_path.endswith("/"):
         base_path += "/"
+    if runner is None:
+        runner = DifmapRunner()
 
     stokes = list(stokes)
     # Now ``I`` goes first
@@ -370,6 +379,7 @@ def clean_boot_data(sources, epochs, bands, stokes, base_path=None,
                                                                         band)
                     continue
                 # Cleaning bootstrapped data & restore with low resolution
+                jobs = list()
                 for i in range(n):
                     uv_fname = uv_path + 'boot_' + str(i + 1) + '.fits'
                     if not os.path.isfile(uv_fname):
@@ -381,14 +391,16 @@ def clean_boot_data(sources, epochs, bands, stokes, base_path=None,
                         print "  working with stokes parameter ", stoke
                         map_path = im_fits_path(source, band, epoch, stoke,
                                                 base_path=base_path)
-                        clean_difmap(fname='boot_' + str(i + 1) + '.fits',
-                                     outfname='cc_' + str(i + 1) + '.fits',
-                                     stokes=stoke, mapsize_clean=mapsize_clean,
-                                     path=uv_path,
-                                     path_to_script=path_to_script,
-                                     mapsize_restore=None,
-                                     beam_restore=beam_restore,
-                                     outpath=map_path)
+                        jobs.append(clean_difmap_commands(fname='boot_' + str(i + 1) + '.fits',
+                                                          outfname='cc_' + str(i + 1) + '.fits',
+                                                          stokes=stoke,
+                                                          mapsize_clean=mapsize_clean,
+                                                          path=uv_path,
+                                                          path_to_script=path_to_script,
+                                                          mapsize_restore=None,
+                                                          beam_restore=beam_restore,
+                                                          outpath=map_path))
+                runner.map(jobs)
                 # Cleaning original data & restore with low_freq resolution
                 for stoke in stokes:
                     print "  working with stokes parameter ", stoke
@@ -401,7 +413,7 @@ def clean_boot_data(sources, epochs, bands, stokes, base_path=None,
                                  path_to_script=path_to_script,
                                  mapsize_restore=None,
                                  beam_restore=beam_restore,
-                                 outpath=map_path)
+                                 outpath=map_path, runner=runner)
     os.chdir(curdir)
 
 